@@ -49,7 +49,7 @@ async def google_login(login_request: GoogleLoginRequest, db=Depends(get_db)):
         )
         
     except Exception as e:
-        logger.error(f"Google login error: {e}")
+        logger.error("Google login error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Google authentication failed"
@@ -121,7 +121,7 @@ async def chrome_extension_login(auth_request: ChromeExtensionAuthRequest, db=De
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Chrome extension login error: {e}")
+        logger.error("Chrome extension login error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Chrome extension authentication failed"
@@ -153,5 +153,5 @@ async def create_anonymous_user(db=Depends(get_db)):
                 "message": "Anonymous user created successfully"
             }
         except Exception as e:
-            logger.error(f"Error creating anonymous user: {e}")
+            logger.error("Error creating anonymous user: %s", e)
             raise HTTPException(status_code=500, detail="Failed to create user")
\ No newline at end of file
@@ -3,9 +3,8 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 import requests
 from datetime import datetime, timedelta
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
 from .models import UserInfo, AuthResponse, GoogleLoginRequest, ChromeExtensionAuthRequest
+from ..core import tracing
 import os
 import logging
 
@@ -42,7 +41,8 @@ class AuthService:
         """Verify and decode JWT token"""
         try:
             token = credentials.credentials
-            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+            with tracing.span("auth.verify_token"):
+                payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
             
             return UserInfo(
                 user_id=payload["user_id"],
@@ -73,6 +73,9 @@ class AuthService:
                     detail="Google Client ID not configured"
                 )
             
+            from google.oauth2 import id_token
+            from google.auth.transport import requests as google_requests
+            
             # Verify the token
             idinfo = id_token.verify_oauth2_token(
                 id_token_str, 
@@ -113,7 +116,7 @@ class AuthService:
             )
             return response.status_code == 200
         except Exception as e:
-            logger.error(f"Token verification error: {e}")
+            logger.error("Token verification error: %s", e)
             return False
 
     @staticmethod
@@ -0,0 +1,197 @@
+import logging
+import os
+import pickle
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+class MemoryBackend:
+    """Process-local LRU store
+
+    Holds live objects unless ``serialize`` is set, in which case values are
+    pickled so callers can never mutate a cached entry in place.
+    """
+
+    def __init__(self, max_entries: int = 10000, serialize: bool = False):
+        self.max_entries = max_entries
+        self.serialize = serialize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+        return pickle.loads(value) if self.serialize else value
+
+    def set(self, key: str, value, ttl: float):
+        if self.serialize:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        """Store a value unless a live entry exists; returns whether it was stored"""
+        if self.serialize:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.time():
+                return False
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class SQLiteBackend:
+    """Node-wide store shared by all worker processes through one SQLite file
+
+    Keep the file on tmpfs (/dev/shm) so it never touches disk. Connections are
+    opened lazily per thread, so nothing is inherited across a preload fork.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Cached data can always be rebuilt, so skip fsyncs
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            return _MISSING
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value, ttl: float):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time() + ttl),
+        )
+        if random.random() < 0.001:
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        """Store a value unless a live entry exists; atomic across processes"""
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO cache (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+            "WHERE cache.expires_at < ?",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now + ttl, now),
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+class Cache:
+    """Namespaced cache with an optional process-local tier for immutable entries
+
+    Entries that can change (e.g. a user's categories) live only in the shared
+    backend, so a delete from any worker is seen by all of them immediately.
+    Entries that never change once written (verified tokens, categorization
+    results for an exact prompt) may also be kept in the local tier with
+    ``local=True`` to skip the shared lookup.
+    """
+
+    def __init__(self, shared, local: Optional[MemoryBackend] = None):
+        self.shared = shared
+        self.local = local
+
+    def get(self, namespace: str, key: str, local: bool = False) -> Optional[Any]:
+        full_key = f"{namespace}:{key}"
+        value = _MISSING
+        if local and self.local is not None:
+            value = self.local.get(full_key)
+        if value is _MISSING:
+            try:
+                value = self.shared.get(full_key)
+            except sqlite3.Error as e:
+                logger.warning("Shared cache read failed: %s", e)
+                value = _MISSING
+            if value is not _MISSING and local and self.local is not None:
+                self.local.set(full_key, value, 60)
+        metrics.record_cache_access(namespace, value is not _MISSING)
+        return None if value is _MISSING else value
+
+    def set(self, namespace: str, key: str, value, ttl: float, local: bool = False):
+        full_key = f"{namespace}:{key}"
+        if local and self.local is not None:
+            self.local.set(full_key, value, min(ttl, 60))
+        try:
+            self.shared.set(full_key, value, ttl)
+        except sqlite3.Error as e:
+            logger.warning("Shared cache write failed: %s", e)
+
+    def add(self, namespace: str, key: str, value, ttl: float) -> bool:
+        """Store a value in the shared tier unless a live entry exists; returns whether it was stored
+
+        Lets workers claim a key: exactly one of several concurrent callers
+        gets True. If the shared tier fails, every caller gets True.
+        """
+        try:
+            return self.shared.add(f"{namespace}:{key}", value, ttl)
+        except sqlite3.Error as e:
+            logger.warning("Shared cache add failed: %s", e)
+            return True
+
+    def delete(self, namespace: str, key: str):
+        full_key = f"{namespace}:{key}"
+        if self.local is not None:
+            self.local.delete(full_key)
+        try:
+            self.shared.delete(full_key)
+        except sqlite3.Error as e:
+            logger.warning("Shared cache delete failed: %s", e)
+
+def default_shared_cache_path() -> str:
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "kg-note-cache.sqlite3")
+
+def create_cache() -> Cache:
+    """Build the cache from CACHE_BACKEND (memory/sqlite) and SHARED_CACHE_PATH"""
+    backend = os.getenv("CACHE_BACKEND", "memory")
+    if backend == "sqlite":
+        path = os.getenv("SHARED_CACHE_PATH") or default_shared_cache_path()
+        return Cache(SQLiteBackend(path), MemoryBackend())
+    # A single process needs no second tier
+    return Cache(MemoryBackend(serialize=True))
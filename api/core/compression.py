@@ -0,0 +1,102 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = (b"application/json", b"text/")
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    """Pick br or gzip from an Accept-Encoding header, honouring q-values"""
+    offered = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip()] = quality
+
+    def accepted(name):
+        return offered.get(name, offered.get("*", 0.0)) > 0
+
+    if brotli is not None and accepted("br"):
+        return "br"
+    if accepted("gzip"):
+        return "gzip"
+    return ""
+
+class CompressionMiddleware:
+    """ASGI middleware compressing large JSON and text responses with br or gzip
+
+    Only complete (non-streaming) bodies of at least ``minimum_size`` bytes are
+    compressed. Levels favour CPU over ratio since most payloads are note lists
+    that compress well anyway.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 5, brotli_quality: int = 5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        encoding = negotiate_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            response_start, start_message = start_message, None
+            body = message.get("body", b"")
+            if not self._should_compress(response_start, body, message.get("more_body", False)):
+                await send(response_start)
+                await send(message)
+                return
+
+            if encoding == "br":
+                compressed = brotli.compress(body, quality=self.brotli_quality)
+            else:
+                compressed = gzip.compress(body, compresslevel=self.gzip_level)
+            vary = [value for name, value in response_start["headers"] if name.lower() == b"vary"]
+            response_headers = [
+                (name, value) for name, value in response_start["headers"]
+                if name.lower() not in (b"content-length", b"vary")
+            ]
+            response_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", b", ".join(vary + [b"Accept-Encoding"])),
+            ]
+            await send({**response_start, "headers": response_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _should_compress(self, response_start, body: bytes, more_body: bool) -> bool:
+        if more_body or len(body) < self.minimum_size:
+            return False
+        response_headers = dict((name.lower(), value) for name, value in response_start["headers"])
+        if b"content-encoding" in response_headers:
+            return False
+        content_type = response_headers.get(b"content-type", b"")
+        return content_type.startswith(COMPRESSIBLE_TYPES)
@@ -0,0 +1,178 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+from . import metrics
+from .responses import FastJSONResponse
+
+# Priority classes, most important first
+READ = "read"
+WRITE = "write"
+LLM = "llm"
+PRIORITIES = (READ, WRITE, LLM)
+
+# Share of the limit each class may fill; the rest is headroom for the classes before it
+SHARES = {READ: 1.0, WRITE: 0.9, LLM: 0.7}
+
+# Longest a request of each class waits for a slot before it is shed
+MAX_WAIT = {READ: 2.0, WRITE: 1.0, LLM: 0.5}
+
+# Requests admitted at once per worker, to start with; 0 disables limiting
+INITIAL_LIMIT = int(os.getenv("CONCURRENCY_LIMIT", "32"))
+MIN_LIMIT = int(os.getenv("CONCURRENCY_LIMIT_MIN", "4"))
+MAX_LIMIT = int(os.getenv("CONCURRENCY_LIMIT_MAX", "256"))
+
+# Waiting requests per class beyond which new arrivals are shed at once
+MAX_QUEUE = int(os.getenv("CONCURRENCY_MAX_QUEUE", "64"))
+
+# A request slower than this multiple of its route's usual latency signals congestion
+LATENCY_TOLERANCE = 2.0
+
+# On congestion the limit is multiplied by BACKOFF, at most once per DECREASE_INTERVAL seconds
+BACKOFF = 0.9
+DECREASE_INTERVAL = 1.0
+
+# Weight of a new sample in a route's latency baseline, and samples needed before it is trusted
+BASELINE_ALPHA = 0.05
+WARMUP_SAMPLES = 20
+
+MAX_RETRY_AFTER = 30
+
+class AdaptiveConcurrencyMiddleware:
+    """ASGI middleware bounding the requests a worker handles at once, shedding the excess
+
+    The limit follows AIMD: it grows by about one for every `limit` requests
+    completed at their route's usual latency while the worker is busy, and
+    shrinks by 10% when a request takes more than twice its route's baseline.
+    Requests over the limit wait briefly in per-class queues, reads first,
+    and are rejected with 503 and Retry-After rather than queue until the
+    platform times them out. LLM-backed writes may only fill part of the
+    limit, so reads keep working while they are slow. Exempt paths (health
+    checks, metrics) are never limited.
+    """
+
+    def __init__(self, app, exempt: Iterable[str] = (), llm_paths: Iterable[str] = (),
+                 llm_prefixes: Iterable[str] = (), initial_limit: int = INITIAL_LIMIT):
+        self.app = app
+        self.exempt = set(exempt)
+        self.llm_paths = set(llm_paths)
+        self.llm_prefixes = tuple(llm_prefixes)
+        self.enabled = initial_limit > 0
+        self.limit = float(min(MAX_LIMIT, max(MIN_LIMIT, initial_limit)))
+        self.in_flight = 0
+        self._queues: Dict[str, deque] = {priority: deque() for priority in PRIORITIES}
+        # Route template -> [latency EWMA in seconds, samples]
+        self._baselines: Dict[str, List[float]] = {}
+        self._last_decrease = 0.0
+        metrics.CONCURRENCY_LIMIT.set(self.limit)
+
+    def _priority(self, scope) -> Optional[str]:
+        path = scope["path"]
+        if path in self.exempt:
+            return None
+        if scope["method"] == "POST" and (path in self.llm_paths or path.startswith(self.llm_prefixes)):
+            return LLM
+        if scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            return READ
+        return WRITE
+
+    def _fits(self, priority: str) -> bool:
+        return self.in_flight < max(1, int(self.limit * SHARES[priority]))
+
+    async def __call__(self, scope, receive, send):
+        priority = self._priority(scope) if scope["type"] == "http" and self.enabled else None
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+
+        route = metrics.resolve_route(scope)
+        queued_at = time.monotonic()
+        shed_reason = await self._acquire(priority)
+        metrics.QUEUE_TIME.labels(priority).observe(time.monotonic() - queued_at)
+        if shed_reason is not None:
+            metrics.REQUESTS_SHED.labels(priority, shed_reason).inc()
+            response = FastJSONResponse(
+                {"detail": "Server is overloaded, please retry"},
+                status_code=503,
+                headers={"Retry-After": str(self._retry_after(route))},
+            )
+            await response(scope, receive, send)
+            return
+
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._observe(route, time.monotonic() - start)
+            self.in_flight -= 1
+            self._dispatch()
+
+    async def _acquire(self, priority: str) -> Optional[str]:
+        """Take a slot, waiting if needed; the reason the request is shed, or None once admitted"""
+        # Requests of the same or a higher priority that are already waiting go first
+        ahead = any(self._queues[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        if not ahead and self._fits(priority):
+            self.in_flight += 1
+            return None
+        queue = self._queues[priority]
+        if len(queue) >= MAX_QUEUE:
+            return "queue_full"
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await asyncio.wait([waiter], timeout=MAX_WAIT[priority])
+        except asyncio.CancelledError:
+            # The client went away; give back a slot handed over meanwhile
+            if waiter.done() and not waiter.cancelled():
+                self.in_flight -= 1
+                self._dispatch()
+            else:
+                waiter.cancel()
+                queue.remove(waiter)
+            raise
+        if waiter.done():
+            # _dispatch counted it in flight
+            return None
+        waiter.cancel()
+        queue.remove(waiter)
+        return "timeout"
+
+    def _dispatch(self):
+        """Hand free slots to waiting requests, highest priority first"""
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and self._fits(priority):
+                waiter = queue.popleft()
+                self.in_flight += 1
+                waiter.set_result(None)
+            if queue:
+                # Lower classes fit in less of the limit, so they cannot fit either
+                return
+
+    def _observe(self, route: str, latency: float):
+        """Adjust the limit from a completed request's latency"""
+        baseline = self._baselines.setdefault(route, [latency, 0])
+        congested = baseline[1] >= WARMUP_SAMPLES and latency > baseline[0] * LATENCY_TOLERANCE
+        # Clamped, so a burst of slow requests moves the baseline only gradually
+        baseline[0] += BASELINE_ALPHA * (min(latency, baseline[0] * LATENCY_TOLERANCE) - baseline[0])
+        baseline[1] += 1
+
+        if congested:
+            now = time.monotonic()
+            if now - self._last_decrease >= DECREASE_INTERVAL:
+                self.limit = max(MIN_LIMIT, self.limit * BACKOFF)
+                self._last_decrease = now
+        elif self.in_flight >= self.limit / 2:
+            # Only grow while the limit is being used, or it would drift up while idle
+            self.limit = min(MAX_LIMIT, self.limit + 1 / self.limit)
+        metrics.CONCURRENCY_LIMIT.set(self.limit)
+
+    def _retry_after(self, route: str) -> int:
+        """Seconds until a slot is likely free: about one request of the route"""
+        baseline = self._baselines.get(route)
+        seconds = math.ceil(baseline[0]) if baseline else 1
+        return min(MAX_RETRY_AFTER, max(1, seconds))
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; writes are then only serialized within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class CategoryFileStore:
+    """Category list kept in a JSON file, used when Firestore is unavailable
+
+    Reads are served from memory and reloaded only when the file's inode, size
+    or mtime changes, so a write by another worker is picked up on the next
+    read. Writes hold an exclusive lock on a sidecar lock file across the
+    read-modify-write and replace the file atomically, so readers never see a
+    partial file and concurrent adds are never lost.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self._lock = threading.RLock()
+        self._signature = None
+        self._categories: List[dict] = []
+        self._names = set()
+
+    def _stat_signature(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _refresh(self):
+        signature = self._stat_signature()
+        if signature == self._signature:
+            return
+        categories = []
+        if signature is not None:
+            try:
+                with open(self.path, "r") as f:
+                    categories = json.load(f)
+            except (OSError, ValueError) as e:
+                # Keep serving the last good copy rather than failing every request
+                logger.error("Could not read categories file %s: %s", self.path, e)
+                return
+        self._set(categories, signature)
+
+    def _set(self, categories: List[dict], signature: Optional[tuple]):
+        self._categories = categories
+        self._names = {category["category"].lower() for category in categories}
+        self._signature = signature
+
+    def all(self) -> List[dict]:
+        """Current categories; the returned dicts are copies"""
+        with self._lock:
+            self._refresh()
+            return [dict(category) for category in self._categories]
+
+    def exists(self, name: str) -> bool:
+        """Whether a category name is taken (case-insensitive)"""
+        with self._lock:
+            self._refresh()
+            return name.lower() in self._names
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive across threads and, where flock is available, processes"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, categories: List[dict]):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".categories-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(categories, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._set(categories, self._stat_signature())
+
+    def add(self, category: dict) -> bool:
+        """Append a category unless its name is taken; returns whether it was added"""
+        with self._locked():
+            self._refresh()
+            if category["category"].lower() in self._names:
+                return False
+            self._write(self._categories + [dict(category)])
+            return True
+
+    def replace(self, categories: List[dict]):
+        """Overwrite the whole list"""
+        with self._locked():
+            self._write([dict(category) for category in categories])
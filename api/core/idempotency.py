@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from .responses import FastJSONResponse
+
+logger = logging.getLogger(__name__)
+
+HEADER = b"idempotency-key"
+
+# Completed responses are replayed to retries for this long
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "3600"))
+
+# An attempt's claim on its key; bounds how long retries wait on a worker that died
+PENDING_TTL = 120
+
+# How often a retry checks whether an attempt on another worker has finished
+POLL_INTERVAL = 0.1
+
+MAX_KEY_LENGTH = 255
+
+# Response headers that describe the request rather than the result
+_UNSTORED_HEADERS = {b"content-length", b"set-cookie", b"date", b"server"}
+
+class IdempotencyMiddleware:
+    """ASGI middleware replaying the response of a request retried with the same Idempotency-Key
+
+    Applies to POST requests on the configured paths that carry the header
+    and valid credentials; keys are scoped to the user. The first attempt
+    claims the key in the shared cache, so retries arriving while it runs, on
+    any worker, wait for it and then receive its response. Only successful
+    (2xx) responses are stored; after a failure the next retry runs again.
+    Reusing a key for a different request body is rejected with 422.
+    """
+
+    def __init__(self, app, cache: Callable, identify: Callable[[str], Optional[str]],
+                 paths: Iterable[str] = (), prefixes: Iterable[str] = ()):
+        self.app = app
+        # Callables, so the cache and token check can be created after the app
+        self.cache = cache
+        self.identify = identify
+        self.paths = set(paths)
+        self.prefixes = tuple(prefixes)
+        # Attempts running in this process; retries here wait on them directly
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _applies(self, scope) -> bool:
+        return (
+            scope["type"] == "http"
+            and scope["method"] == "POST"
+            and (scope["path"] in self.paths or scope["path"].startswith(self.prefixes))
+        )
+
+    async def __call__(self, scope, receive, send):
+        if not self._applies(scope):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        key = headers.get(HEADER, b"").decode("latin-1").strip()
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            await FastJSONResponse({"detail": "Idempotency-Key is too long"}, status_code=400)(scope, receive, send)
+            return
+        user_id = self.identify(headers.get(b"authorization", b"").decode("latin-1"))
+        if user_id is None:
+            # Let authentication reject it
+            await self.app(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        fingerprint = hashlib.sha256(
+            b"\n".join([scope["method"].encode(), scope["path"].encode(), scope.get("query_string", b""), body])
+        ).hexdigest()
+        record_key = hashlib.sha256(f"{user_id}\n{key}".encode()).hexdigest()
+        cache = self.cache()
+
+        deadline = time.monotonic() + PENDING_TTL
+        while True:
+            record = cache.get("idempotency", record_key)
+            if record is not None and record["fingerprint"] != fingerprint:
+                response = FastJSONResponse(
+                    {"detail": "Idempotency-Key was already used for a different request"}, status_code=422
+                )
+                await response(scope, receive, send)
+                return
+            if record is not None and record["state"] == "done":
+                await _replay(record, send)
+                return
+            if record is None and cache.add("idempotency", record_key, {"state": "pending", "fingerprint": fingerprint}, PENDING_TTL):
+                break
+            if time.monotonic() > deadline:
+                response = FastJSONResponse(
+                    {"detail": "A request with this Idempotency-Key is still in progress"}, status_code=409
+                )
+                await response(scope, receive, send)
+                return
+            inflight = self._inflight.get(record_key)
+            if inflight is not None:
+                await asyncio.wait([inflight], timeout=max(0.0, deadline - time.monotonic()))
+            else:
+                await asyncio.sleep(POLL_INTERVAL)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[record_key] = future
+        response_start = None
+        chunks = []
+
+        async def replayable_receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send_wrapper(message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, replayable_receive, send_wrapper)
+            if response_start is not None and 200 <= response_start["status"] < 300:
+                cache.set("idempotency", record_key, {
+                    "state": "done",
+                    "fingerprint": fingerprint,
+                    "status": response_start["status"],
+                    "headers": [
+                        (name, value) for name, value in response_start.get("headers", [])
+                        if name.lower() not in _UNSTORED_HEADERS
+                    ],
+                    "body": b"".join(chunks),
+                }, IDEMPOTENCY_TTL)
+                stored = True
+        finally:
+            if not stored:
+                cache.delete("idempotency", record_key)
+            del self._inflight[record_key]
+            future.set_result(None)
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+async def _replay(record: dict, send):
+    body = record["body"]
+    headers = list(record["headers"]) + [
+        (b"content-length", str(len(body)).encode()),
+        (b"idempotent-replayed", b"true"),
+    ]
+    await send({"type": "http.response.start", "status": record["status"], "headers": headers})
+    await send({"type": "http.response.body", "body": body})
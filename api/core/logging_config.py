@@ -0,0 +1,224 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from . import tracing
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "trace_id"}
+
+# Fields whose values are never logged
+REDACTED_FIELDS = {"access_token", "id_token", "token", "authorization", "password", "api_key", "secret"}
+
+# Fields that carry user content or model output and are truncated hard
+TRUNCATED_FIELDS = {"content", "note_content", "raw_response", "prompt", "user_prompt", "summary"}
+
+def _truncate(value: str, limit: int) -> str:
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}...(+{len(value) - limit} chars)"
+
+def sanitize(key: str, value, max_chars: int, content_chars: int):
+    """Redact secrets and bound the size of a logged field"""
+    lowered = key.lower()
+    if lowered in REDACTED_FIELDS:
+        return "[redacted]"
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    if not isinstance(value, str):
+        try:
+            value = json.dumps(value, default=str)
+        except (TypeError, ValueError):
+            value = repr(value)
+    return _truncate(value, content_chars if lowered in TRUNCATED_FIELDS else max_chars)
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, in the field layout Cloud Logging parses"""
+
+    def __init__(self, max_chars: int = 1000, content_chars: int = 200):
+        super().__init__()
+        self.max_chars = max_chars
+        self.content_chars = content_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "severity": record.levelname,
+            "logger": record.name,
+            "message": _truncate(self._message(record), self.max_chars),
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = sanitize(key, value, self.max_chars, self.content_chars)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+    def _message(self, record: logging.LogRecord) -> str:
+        try:
+            return record.getMessage()
+        except Exception:
+            return str(record.msg)
+
+class TextFormatter(logging.Formatter):
+    """Plain-text format for local development; extras are appended as key=value"""
+
+    def __init__(self, max_chars: int = 1000, content_chars: int = 200):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+        self.max_chars = max_chars
+        self.content_chars = content_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extras = [
+            f"{key}={sanitize(key, value, self.max_chars, self.content_chars)}"
+            for key, value in record.__dict__.items()
+            if key not in _RECORD_ATTRS and not key.startswith("_")
+        ]
+        return f"{line} {' '.join(extras)}" if extras else line
+
+class SamplingFilter(logging.Filter):
+    """Samples and rate-limits log lines per message type
+
+    The message type is the logger name plus the unformatted message template,
+    so callers should log with %-style arguments rather than f-strings.
+    Warnings and errors are never sampled, only rate-limited.
+    """
+
+    MAX_KEYS = 10000
+
+    def __init__(self, sample_rates=None, rate_per_second: float = 20.0, burst: int = 50):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.rate = rate_per_second
+        self.burst = burst
+        self._buckets = {}
+        self._suppressed = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _sample_rate(self, record: logging.LogRecord) -> float:
+        if record.levelno >= logging.WARNING:
+            return 1.0
+        rate = 1.0
+        for prefix, prefix_rate in self.sample_rates.items():
+            if record.name.startswith(prefix) or str(record.msg).startswith(prefix):
+                rate = min(rate, prefix_rate)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            rate = self._sample_rate(record)
+            if rate < 1.0:
+                # Deterministic 1-in-N sampling keeps the kept fraction exact
+                count = self._counters.get(key, 0) + 1
+                self._counters[key] = count
+                if rate <= 0 or count % max(1, round(1 / rate)) != 0:
+                    return False
+
+            if len(self._buckets) > self.MAX_KEYS:
+                # Messages with interpolated text create unbounded keys; start over
+                self._buckets.clear()
+                self._counters.clear()
+                self._suppressed.clear()
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False
+            self._buckets[key] = (tokens - 1, now)
+            suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class _TraceQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records without formatting them on the calling thread"""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        # Drop rather than block the event loop when the writer falls behind
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        span = tracing.current_span()
+        if span is not tracing.NOOP_SPAN:
+            record.trace_id = span.trace.trace_id
+        if record.exc_info and not record.exc_text:
+            # Tracebacks reference live frames; render them before handing off
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+_listener = None
+
+def _parse_sample_rates(value: str) -> dict:
+    """Parse LOG_SAMPLE_RATES like 'api.llm=0.1,api_simple=0.5'"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        prefix, _, rate = item.partition("=")
+        try:
+            rates[prefix.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+def setup_logging():
+    """Route all logging through a queue so formatting and writes happen off the event loop
+
+    Configured by LOG_LEVEL, LOG_FORMAT (json/text), LOG_SAMPLE_RATES,
+    LOG_RATE_LIMIT (lines per second per message type) and LOG_MAX_FIELD_CHARS.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    max_chars = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+    content_chars = int(os.getenv("LOG_CONTENT_CHARS", "200"))
+    formatter_class = TextFormatter if os.getenv("LOG_FORMAT", "json") == "text" else JsonFormatter
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter_class(max_chars, content_chars))
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    queue_handler = _TraceQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(
+        _parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", "")),
+        rate_per_second=float(os.getenv("LOG_RATE_LIMIT", "20")),
+    ))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(lambda: _listener.stop())
+
+    def restart_in_child():
+        # A forked worker inherits the queue but not the listener thread
+        global _listener
+        queue_handler.queue = queue.Queue(maxsize=log_queue.maxsize)
+        _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+
+    os.register_at_fork(after_in_child=restart_in_child)
@@ -0,0 +1,159 @@
+import os
+import time
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from starlette.routing import Match
+
+# Route template of the request being handled, used to attribute storage and LLM work
+current_route: ContextVar[str] = ContextVar("current_route", default="background")
+
+REQUEST_LATENCY = Histogram(
+    "kg_http_request_duration_seconds",
+    "HTTP request latency",
+    ["route", "method", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "kg_http_requests_in_flight",
+    "HTTP requests currently being handled",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+CONCURRENCY_LIMIT = Gauge(
+    "kg_http_concurrency_limit",
+    "Requests a worker admits at once, adjusted from observed latency",
+    multiprocess_mode="livesum",
+)
+QUEUE_TIME = Histogram(
+    "kg_http_queue_seconds",
+    "Time requests waited for admission, by priority class",
+    ["priority"],
+    buckets=(0.001, 0.005, 0.025, 0.1, 0.25, 0.5, 1, 2, 5),
+)
+REQUESTS_SHED = Counter(
+    "kg_http_requests_shed_total",
+    "Requests rejected with 503 under overload",
+    ["priority", "reason"],
+)
+RATE_LIMIT_DECISIONS = Counter(
+    "kg_rate_limit_decisions_total",
+    "Per-user rate limit checks by budget and result (allowed, limited, or error when the store failed open)",
+    ["budget", "result"],
+)
+STORAGE_OPS = Counter(
+    "kg_storage_operations_total",
+    "Firestore operations issued through DatabaseService (reads are documents read)",
+    ["route", "operation", "op"],
+)
+LLM_LATENCY = Histogram(
+    "kg_llm_request_duration_seconds",
+    "DeepSeek API call latency",
+    ["operation"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60),
+)
+LLM_TOKENS = Counter(
+    "kg_llm_tokens_total",
+    "Tokens reported by DeepSeek usage",
+    ["operation", "kind"],
+)
+LLM_FALLBACKS = Counter(
+    "kg_llm_fallbacks_total",
+    "LLM calls that fell back to a default result",
+    ["operation", "reason"],
+)
+LLM_CONTENT_TOKENS = Counter(
+    "kg_llm_content_tokens_total",
+    "Estimated note content tokens per LLM operation, before (original) and after (sent) budgeting",
+    ["operation", "kind"],
+)
+LLM_CONTENT_REDUCED = Counter(
+    "kg_llm_content_reduced_total",
+    "LLM calls whose content was reduced to fit the operation's token budget",
+    ["operation"],
+)
+CACHE_REQUESTS = Counter(
+    "kg_cache_requests_total",
+    "Cache lookups by result; hit ratio is hit / (hit + miss)",
+    ["cache", "result"],
+)
+
+def record_storage_op(operation: str, op: str, count: int = 1):
+    """Count Firestore work done by a DatabaseService method"""
+    if count:
+        STORAGE_OPS.labels(current_route.get(), operation, op).inc(count)
+
+def record_llm_call(operation: str, duration: float, usage=None):
+    """Record latency and token usage of a completed LLM call"""
+    LLM_LATENCY.labels(operation).observe(duration)
+    if usage is not None:
+        LLM_TOKENS.labels(operation, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+        LLM_TOKENS.labels(operation, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+def record_content_budget(operation: str, original_tokens: int, sent_tokens: int):
+    """Record content size before and after budgeting; the difference is tokens saved"""
+    LLM_CONTENT_TOKENS.labels(operation, "original").inc(original_tokens)
+    LLM_CONTENT_TOKENS.labels(operation, "sent").inc(sent_tokens)
+    if sent_tokens < original_tokens:
+        LLM_CONTENT_REDUCED.labels(operation).inc()
+
+def record_llm_fallback(operation: str, reason: str):
+    LLM_FALLBACKS.labels(operation, reason).inc()
+
+def record_cache_access(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+def resolve_route(scope) -> str:
+    """Return the path template of the route that will handle this request"""
+    app = scope.get("app")
+    router = getattr(app, "router", None)
+    for route in getattr(router, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", scope["path"])
+    return "unmatched"
+
+def render_latest():
+    """Return the exposition body and its content type
+
+    Under multiple workers (PROMETHEUS_MULTIPROC_DIR set) every worker writes
+    its samples to that directory and the scrape aggregates all of them, so
+    any worker can answer /metrics for the whole node.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency and in-flight requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = resolve_route(scope)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = current_route.set(route)
+        in_flight = REQUESTS_IN_FLIGHT.labels(route)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(route, scope["method"], str(status_code)).observe(time.perf_counter() - start)
+            in_flight.dec()
+            current_route.reset(token)
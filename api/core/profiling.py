@@ -0,0 +1,143 @@
+import cProfile
+import io
+import pstats
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+MAX_PROFILE_SECONDS = 60
+
+# Seconds an armed token stays usable, and a request profile stays readable
+ARMED_TTL = 600
+RESULT_TTL = 3600
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{code.co_name}:{frame.f_lineno}"
+
+class SamplingProfiler:
+    """Statistical profiler sampling the stacks of every thread in the process
+
+    Output uses the collapsed-stack format understood by flamegraph.pl and
+    speedscope: one ``thread;outer;...;inner count`` line per unique stack.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def profile(self, seconds: float, interval: float = 0.01) -> str:
+        """Sample all threads for the given duration; blocks the calling thread"""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already running")
+        try:
+            stacks = Counter()
+            own_id = threading.get_ident()
+            deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+            samples = 0
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    labels.append(names.get(thread_id, f"thread-{thread_id}"))
+                    stacks[";".join(reversed(labels))] += 1
+                samples += 1
+                time.sleep(interval)
+            lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+            header = f"# samples={samples} interval_ms={interval * 1000:g}"
+            return "\n".join([header] + lines) + "\n"
+        finally:
+            self._lock.release()
+
+sampler = SamplingProfiler()
+
+class RequestProfiler:
+    """Runs cProfile over a single request flagged with an armed one-time token
+
+    An admin arms a token, then replays a real request with the
+    ``X-Profile-Request`` header set to it. cProfile only sees the event-loop
+    thread, so work of other requests interleaved on the loop shows up too.
+
+    Tokens and results live in the cache, so arming, the profiled request and
+    fetching the result may each land on a different worker when the cache is
+    shared (CACHE_BACKEND=sqlite).
+    """
+
+    HEADER = b"x-profile-request"
+
+    def __init__(self, cache: Callable):
+        # Callable, so the cache can be created after the app
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._active = False
+
+    def arm(self) -> str:
+        token = secrets.token_urlsafe(16)
+        self.cache().set("profile_armed", token, True, ARMED_TTL)
+        return token
+
+    def claim(self, token: str) -> bool:
+        """Consume an armed token; each worker profiles one request at a time"""
+        with self._lock:
+            if self._active:
+                return False
+            self._active = True
+        cache = self.cache()
+        # Of several workers seeing the token, only the one whose add succeeds profiles
+        if cache.get("profile_armed", token) is None or not cache.add("profile_claimed", token, True, ARMED_TTL):
+            with self._lock:
+                self._active = False
+            return False
+        cache.delete("profile_armed", token)
+        return True
+
+    def store(self, token: str, profile: cProfile.Profile, description: str, limit: int = 60):
+        output = io.StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats("cumulative").print_stats(limit)
+        try:
+            self.cache().set("profile_results", token, f"{description}\n{output.getvalue()}", RESULT_TTL)
+        finally:
+            with self._lock:
+                self._active = False
+
+    def result(self, token: str) -> Optional[str]:
+        return self.cache().get("profile_results", token)
+
+class RequestProfilerMiddleware:
+    """ASGI middleware profiling requests that carry an armed token"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = dict(scope.get("headers") or []).get(RequestProfiler.HEADER, b"").decode("latin-1")
+        if not token or not self.profiler.claim(token):
+            await self.app(scope, receive, send)
+            return
+
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profile.enable()
+            await self.app(scope, receive, send)
+        finally:
+            profile.disable()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.profiler.store(token, profile, f"# {scope['method']} {scope['path']} {elapsed_ms:.1f} ms")
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from . import metrics
+from .cache import default_shared_cache_path
+from .responses import FastJSONResponse
+
+logger = logging.getLogger(__name__)
+
+# Budget names; requests are classed like the concurrency limiter's priorities
+LLM = "llm"
+READ = "read"
+WRITE = "write"
+
+DEFAULT_RATE_LIMITS = "llm=30/60,write=120/60,read=600/60"
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[int, float]]:
+    """Parse `name=requests/seconds,...` into {name: (requests, seconds)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, spec = item.partition("=")
+        requests, _, seconds = spec.partition("/")
+        limits[name.strip()] = (int(requests), float(seconds or 60))
+    return limits
+
+# Requests each user may make per route within a window, per budget; the full
+# allowance may be used in a burst, then it refills evenly over the window
+RATE_LIMITS = {**parse_rate_limits(DEFAULT_RATE_LIMITS), **parse_rate_limits(os.getenv("RATE_LIMITS", ""))}
+
+# Seconds a blocking store may take before the request is let through unchecked
+RATE_LIMIT_TIMEOUT = float(os.getenv("RATE_LIMIT_TIMEOUT", "0.25"))
+
+class MemoryBucketStore:
+    """Token buckets held by one process; each worker enforces its own limits"""
+
+    # take only holds an in-memory lock, so it runs on the event loop
+    blocking = False
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        """Take a token from a bucket; 0 if taken, else the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            self._buckets.move_to_end(key)
+            # An evicted bucket starts over full, so eviction only ever lets requests through
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return wait
+
+class SQLiteBucketStore:
+    """Token buckets shared by all worker processes on a node through one SQLite file
+
+    Each take is one IMMEDIATE transaction, so concurrent workers never spend
+    the same token. Connections are opened lazily per thread, as in the cache;
+    take waits for the write lock for at most `timeout` seconds.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, timeout: float = RATE_LIMIT_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, full_at REAL NOT NULL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        """Take a token from a bucket; 0 if taken, else the seconds until one is available"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if wait == 0:
+                tokens -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (capacity - tokens) / rate),
+            )
+            if random.random() < 0.001:
+                # A bucket that has refilled is the same as a missing one
+                conn.execute("DELETE FROM rate_buckets WHERE full_at < ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+def create_bucket_store():
+    """Build the bucket store from RATE_LIMIT_STORE (memory/sqlite), defaulting to CACHE_BACKEND"""
+    backend = os.getenv("RATE_LIMIT_STORE") or os.getenv("CACHE_BACKEND", "memory")
+    if backend == "sqlite":
+        return SQLiteBucketStore(os.getenv("SHARED_CACHE_PATH") or default_shared_cache_path())
+    return MemoryBucketStore()
+
+class RateLimitMiddleware:
+    """ASGI middleware limiting each user's request rate per route, with a token bucket per user and route
+
+    Requests are charged to the budget of their class: POSTs to the
+    LLM-backed paths (llm), other writes (write) or reads (read). The user comes from the
+    bearer token; requests without valid credentials pass through for
+    authentication to reject. Over the limit, the response is 429 with the
+    seconds until the next request would be allowed in Retry-After. If the
+    store fails or takes longer than `timeout`, requests are let through.
+
+    The store is any object with take(key, capacity, rate) -> seconds to wait;
+    share one across workers (SQLiteBucketStore, or a network store) for
+    limits that hold per node rather than per process. take runs in a worker
+    thread unless the store sets `blocking = False`.
+    """
+
+    def __init__(self, app, store: Callable, identify: Callable[[str], Optional[str]],
+                 limits: Dict[str, Tuple[int, float]] = RATE_LIMITS, exempt: Iterable[str] = (),
+                 llm_paths: Iterable[str] = (), llm_prefixes: Iterable[str] = (),
+                 timeout: float = RATE_LIMIT_TIMEOUT):
+        self.app = app
+        # Callables, so the store and token check can be created after the app
+        self.store = store
+        self.identify = identify
+        self.limits = limits
+        self.exempt = set(exempt)
+        self.llm_paths = set(llm_paths)
+        self.llm_prefixes = tuple(llm_prefixes)
+        self.timeout = timeout
+
+    def _budget(self, scope) -> Optional[str]:
+        path = scope["path"]
+        if path in self.exempt or scope["method"] == "OPTIONS":
+            return None
+        if scope["method"] == "POST" and (path in self.llm_paths or path.startswith(self.llm_prefixes)):
+            budget = LLM
+        elif scope["method"] in ("GET", "HEAD"):
+            budget = READ
+        else:
+            budget = WRITE
+        return budget if budget in self.limits else None
+
+    async def __call__(self, scope, receive, send):
+        budget = self._budget(scope) if scope["type"] == "http" else None
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        user_id = self.identify(headers.get(b"authorization", b"").decode("latin-1"))
+        if user_id is None:
+            await self.app(scope, receive, send)
+            return
+
+        requests, seconds = self.limits[budget]
+        key = f"{budget}:{user_id}:{scope['method']} {metrics.resolve_route(scope)}"
+        try:
+            store = self.store()
+            if getattr(store, "blocking", True):
+                wait = await asyncio.wait_for(
+                    asyncio.to_thread(store.take, key, requests, requests / seconds), self.timeout
+                )
+            else:
+                wait = store.take(key, requests, requests / seconds)
+        except asyncio.TimeoutError:
+            logger.warning("Rate limit store timed out after %.2fs", self.timeout)
+            metrics.RATE_LIMIT_DECISIONS.labels(budget, "error").inc()
+            await self.app(scope, receive, send)
+            return
+        except Exception as e:
+            logger.warning("Rate limit store failed: %s", e)
+            metrics.RATE_LIMIT_DECISIONS.labels(budget, "error").inc()
+            await self.app(scope, receive, send)
+            return
+
+        if wait > 0:
+            metrics.RATE_LIMIT_DECISIONS.labels(budget, "limited").inc()
+            logger.info("Rate limited request", extra={"user_id": user_id, "budget": budget, "path": scope["path"]})
+            response = FastJSONResponse(
+                {"detail": "Too many requests, please retry later"},
+                status_code=429,
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+            await response(scope, receive, send)
+            return
+        metrics.RATE_LIMIT_DECISIONS.labels(budget, "allowed").inc()
+        await self.app(scope, receive, send)
@@ -0,0 +1,52 @@
+import hashlib
+from datetime import date, datetime
+from typing import Optional
+
+import orjson
+from fastapi.responses import JSONResponse, Response
+
+# Clients may keep the body but must revalidate it on every use
+CONDITIONAL_CACHE_CONTROL = "private, no-cache"
+
+def _default(obj):
+    # orjson only encodes exact datetime types natively; Firestore returns
+    # DatetimeWithNanoseconds, a subclass, which lands here
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded with orjson
+
+    Return it directly from an endpoint to skip FastAPI's jsonable_encoder pass,
+    which copies every storage row before encoding. Output matches the stdlib
+    encoder for the types stored in Firestore (datetimes as ISO 8601).
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+def make_etag(user_id: str, version: int, *variant) -> str:
+    """Weak ETag for a user's data at a version, distinct per query variant
+
+    The user id is part of the tag because browsers key their cache by URL
+    only; without it a switched account could revalidate another user's body.
+    """
+    key = ":".join(str(part) for part in (user_id, version) + variant)
+    return f'W/"{hashlib.sha256(key.encode()).hexdigest()[:20]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches the given ETag (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith("W/") else candidate) == wanted:
+            return True
+    return False
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
@@ -0,0 +1,167 @@
+import logging
+import os
+import threading
+import time
+
+from .cache import create_cache
+from .rate_limit import create_bucket_store
+
+logger = logging.getLogger(__name__)
+
+_UNSET = object()
+
+class ServiceRegistry:
+    """Creates the Firestore client, DatabaseService and LLMService on first use
+
+    Importing firebase_admin/openai and building their clients dominates cold
+    start, so nothing heavy happens at import time. warmup() builds everything
+    and opens the Firestore and DeepSeek connections in the background; until
+    it finishes the first request that needs a client pays for it instead.
+    """
+
+    def __init__(self, credential_path: str = "config/kg-note-credential.json", database_id: str = "kg-note"):
+        self.credential_path = credential_path
+        self.database_id = database_id
+        self._lock = threading.RLock()
+        self._db = _UNSET
+        self._db_service = _UNSET
+        self._llm_service = _UNSET
+        self._jobs = _UNSET
+        # Shared by all workers on the node when CACHE_BACKEND=sqlite
+        self.cache = create_cache()
+        # Per-user rate limit buckets, node-wide like the cache by default
+        self.rate_limits = create_bucket_store()
+        self.ready = False
+        self.warmup_seconds = None
+
+    @property
+    def db(self):
+        if self._db is _UNSET:
+            with self._lock:
+                if self._db is _UNSET:
+                    self._db = self._create_db()
+        return self._db
+
+    @property
+    def db_service(self):
+        if self._db_service is _UNSET:
+            with self._lock:
+                if self._db_service is _UNSET:
+                    self._db_service = self._create_db_service()
+        return self._db_service
+
+    @property
+    def llm_service(self):
+        if self._llm_service is _UNSET:
+            with self._lock:
+                if self._llm_service is _UNSET:
+                    self._llm_service = self._create_llm_service()
+        return self._llm_service
+
+    @property
+    def jobs(self):
+        if self._jobs is _UNSET:
+            with self._lock:
+                if self._jobs is _UNSET:
+                    self._jobs = self._create_jobs()
+        return self._jobs
+
+    def _create_db(self):
+        try:
+            import firebase_admin
+            from firebase_admin import credentials, firestore
+
+            # Use service account file (local) or service account from environment (Cloud Run)
+            if os.path.exists(self.credential_path):
+                cred = credentials.Certificate(self.credential_path)
+            else:
+                # Use default service account in Cloud Run
+                cred = credentials.ApplicationDefault()
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                firebase_admin.initialize_app(cred)
+            db = firestore.client(database_id=self.database_id)
+            logger.info("Firebase Admin SDK initialized successfully")
+            return db
+        except Exception as e:
+            logger.error("Failed to initialize Firebase Admin SDK: %s", e)
+            return None
+
+    def _create_db_service(self):
+        db = self.db
+        if db is None:
+            return None
+        try:
+            from ..database.category_jobs import INDEX_JOB
+            from ..database.db_service import DatabaseService
+            service = DatabaseService(db, cache=self.cache)
+            # Reads of a missing or outdated category index start its rebuild job
+            service.category_index.request_rebuild = lambda user_id: self.jobs.submit(user_id, INDEX_JOB, {})
+            return service
+        except ImportError as e:
+            logger.warning("Could not load database service: %s", e)
+            return None
+
+    def _create_jobs(self):
+        db_service = self.db_service
+        if db_service is None:
+            return None
+        from ..database.category_jobs import register_category_jobs
+        from ..database.dedup import register_dedup_jobs
+        from ..database.jobs import JobManager
+        from ..database.lookup import register_lookup_jobs
+        from ..database.related import register_related_jobs
+
+        jobs = JobManager(db_service)
+        register_category_jobs(jobs, lambda: self.llm_service)
+        register_dedup_jobs(jobs)
+        register_related_jobs(jobs)
+        register_lookup_jobs(jobs)
+        return jobs
+
+    def _create_llm_service(self):
+        if not os.getenv("DEEPSEEK_API_KEY"):
+            return None
+        try:
+            from ..llm.llm_service import LLMService
+            return LLMService(cache=self.cache)
+        except ImportError as e:
+            logger.warning("Could not load LLM service: %s", e)
+            return None
+
+    def describe(self) -> dict:
+        """Service status without triggering initialization"""
+        def state(value, up: str, down: str) -> str:
+            if value is _UNSET:
+                return "initializing"
+            return up if value else down
+
+        return {
+            "firebase": state(self._db, "connected", "disconnected"),
+            "llm": state(self._llm_service, "available", "unavailable"),
+            "database": state(self._db_service, "available", "unavailable"),
+        }
+
+    def warmup(self):
+        """Build all clients and pre-establish their network connections"""
+        start = time.perf_counter()
+        if self.db_service is not None:
+            try:
+                # An empty query fetches credentials and opens the gRPC channel
+                for _ in self.db.collection("_warmup").limit(1).stream():
+                    pass
+            except Exception as e:
+                logger.warning("Firestore warmup failed: %s", e)
+
+        llm_service = self.llm_service
+        if llm_service is not None:
+            try:
+                # Opens the pooled HTTPS connection to DeepSeek
+                llm_service.client.models.list()
+            except Exception as e:
+                logger.warning("LLM warmup failed: %s", e)
+
+        self.warmup_seconds = time.perf_counter() - start
+        self.ready = True
+        logger.info("Warmup finished in %.2fs", self.warmup_seconds)
@@ -0,0 +1,349 @@
+import abc
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+from .metrics import resolve_route
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "kg-note-api")
+
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "attributes",
+                 "start_ns", "end_ns", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: int = KIND_INTERNAL, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        trace.spans.append(self)
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns or time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def to_otlp(self) -> dict:
+        """Encode as an OTLP/JSON span"""
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [_otlp_attribute(k, v) for k, v in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+    def to_summary(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "offset_ms": round((self.start_ns - self.trace.root.start_ns) / 1e6, 3),
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+        self.root: Optional[Span] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms if self.root else 0.0
+
+    def to_summary(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "duration_ms": round(self.duration_ms, 3),
+            "start": self.root.start_ns / 1e9,
+            "spans": [span.to_summary() for span in sorted(self.spans, key=lambda s: s.start_ns)],
+        }
+
+class _NoopSpan:
+    """Returned when the current request is not sampled"""
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def record_error(self, error: BaseException):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+def otlp_payload(traces: List[Trace]) -> dict:
+    """Wrap finished traces in an OTLP/JSON ExportTraceServiceRequest"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{
+                "scope": {"name": "kg-note"},
+                "spans": [span.to_otlp() for trace in traces for span in trace.spans],
+            }],
+        }]
+    }
+
+class RingBufferExporter:
+    """Keeps the most recent finished traces in memory for /debug/traces
+
+    The buffer is per worker process: each gunicorn worker only sees the
+    requests it served. Use the file or OTLP exporters for a complete view.
+    """
+
+    def __init__(self, size: int = 500):
+        self._traces = deque(maxlen=size)
+
+    def export(self, trace: Trace):
+        self._traces.append(trace)
+
+    def slowest(self, limit: int = 20, min_duration_ms: float = 0.0) -> List[Trace]:
+        candidates = [t for t in list(self._traces) if t.duration_ms >= min_duration_ms]
+        return sorted(candidates, key=lambda t: t.duration_ms, reverse=True)[:limit]
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        for trace in list(self._traces):
+            if trace.trace_id == trace_id:
+                return trace
+        return None
+
+class _BackgroundExporter(abc.ABC):
+    """Exports traces from a daemon thread so requests never wait on I/O"""
+
+    def __init__(self, max_queue: int = 1000, batch_size: int = 50):
+        self._max_queue = max_queue
+        self._batch_size = batch_size
+        self.dropped = 0
+        self._start()
+        # Threads do not survive fork; restart in each preloaded worker
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self._max_queue)
+        threading.Thread(target=self._run, name=type(self).__name__, daemon=True).start()
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.error("Trace export failed: %s", e)
+
+    @abc.abstractmethod
+    def write(self, traces: List[Trace]):
+        """Send one batch of finished traces; runs on the exporter thread"""
+
+class FileExporter(_BackgroundExporter):
+    """Appends OTLP/JSON lines, readable by the collector's otlpjsonfile receiver"""
+
+    def __init__(self, path: str):
+        self.path = path
+        super().__init__()
+
+    def write(self, traces: List[Trace]):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(otlp_payload(traces)) + "\n")
+
+class OTLPHttpExporter(_BackgroundExporter):
+    """Posts OTLP/JSON to an OpenTelemetry collector"""
+
+    def __init__(self, endpoint: str):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        super().__init__()
+
+    def write(self, traces: List[Trace]):
+        import requests
+        requests.post(self.url, json=otlp_payload(traces), timeout=5)
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.1, exporters=None, ring_size: int = 500):
+        self.sample_rate = sample_rate
+        self.recent = RingBufferExporter(ring_size)
+        self.exporters = [self.recent] + list(exporters or [])
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        """Configure from TRACE_SAMPLE_RATE, TRACE_EXPORTERS (file,otlp), TRACE_FILE and OTEL_EXPORTER_OTLP_ENDPOINT"""
+        exporters = []
+        for name in filter(None, (n.strip() for n in os.getenv("TRACE_EXPORTERS", "").split(","))):
+            if name == "file":
+                exporters.append(FileExporter(os.getenv("TRACE_FILE", "traces.jsonl")))
+            elif name == "otlp":
+                exporters.append(OTLPHttpExporter(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")))
+            else:
+                logger.warning("Unknown trace exporter: %s", name)
+        return cls(
+            sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0.1")),
+            exporters=exporters,
+            ring_size=int(os.getenv("TRACE_BUFFER_SIZE", "500")),
+        )
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, attributes=None) -> Optional[Span]:
+        """Start a root span if this request is sampled, honouring a W3C traceparent"""
+        parent_id = None
+        match = TRACEPARENT_RE.match(traceparent or "")
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            if not int(flags, 16) & 1:
+                return None
+        elif random.random() < self.sample_rate:
+            trace_id = f"{random.getrandbits(128):032x}"
+        else:
+            return None
+
+        trace = Trace(trace_id)
+        trace.root = Span(trace, name, parent_id, KIND_SERVER, attributes)
+        return trace.root
+
+    def finish(self, root: Span):
+        root.end()
+        for exporter in self.exporters:
+            exporter.export(root.trace)
+
+tracer = Tracer.from_env()
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+@contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, **attributes):
+    """Record a child span of the current request; a no-op when not sampled"""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    child = Span(parent.trace, name, parent.span_id, kind, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        child.end()
+        _current_span.reset(token)
+
+def traced(name: str, kind: int = KIND_INTERNAL):
+    """Decorator wrapping a sync or async function in a span"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, kind):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TracingMiddleware:
+    """ASGI middleware opening a root span per sampled request"""
+
+    def __init__(self, app, tracer: Tracer = tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(b"traceparent", b"").decode("latin-1") or None
+        route = resolve_route(scope)
+        root = self.tracer.start_trace(
+            f"{scope['method']} {route}",
+            traceparent,
+            {"http.method": scope["method"], "http.route": route},
+        )
+        if root is None:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+                message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", root.trace.trace_id.encode())]
+            await send(message)
+
+        token = _current_span.set(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            self.tracer.finish(root)
@@ -0,0 +1,372 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from ..core import tracing
+from .common import BATCH_LIMIT, delete_field, increment, utc
+
+logger = logging.getLogger(__name__)
+
+INDEX_COLLECTION = 'category_index'
+COUNTS_DOC = '_counts'
+COOCCURRENCE_DOC = '_cooccurrence'
+
+# Bumped when the index gains data, so indexes built before are rebuilt on first use
+INDEX_VERSION = 3
+
+# Passes a rebuild makes before giving up on notes that change while it runs
+REBUILD_ATTEMPTS = 3
+
+# Joins the two category names of a co-occurrence pair key
+PAIR_SEPARATOR = '\x1f'
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Larger than any timestamp in microseconds, so inverted keys stay positive
+_MAX_MICROS = 10 ** 17
+
+def sort_key(note_id: str, created_at: Optional[datetime]) -> str:
+    """Index key of a note; keys sort newest first, then by id"""
+    micros = 0
+    if created_at is not None:
+        micros = (utc(created_at) - _EPOCH) // timedelta(microseconds=1)
+    return f"{_MAX_MICROS - micros:017d}:{note_id}"
+
+def note_id_from_key(key: str) -> str:
+    return key.split(':', 1)[1]
+
+def pair_key(a: str, b: str) -> str:
+    return PAIR_SEPARATOR.join(sorted((a, b)))
+
+def category_pairs(categories: Iterable[str]) -> set:
+    """Pair keys of every two categories of a note"""
+    return {pair_key(a, b) for a, b in itertools.combinations(sorted(set(categories)), 2)}
+
+def intersect_sorted(lists: List[List[str]]) -> List[str]:
+    """Keys present in every sorted list, walking the shortest list"""
+    if not lists:
+        return []
+    lists = sorted(lists, key=len)
+    positions = [0] * len(lists)
+    result = []
+    for key in lists[0]:
+        for i in range(1, len(lists)):
+            other = lists[i]
+            positions[i] = bisect.bisect_left(other, key, positions[i])
+            if positions[i] == len(other) or other[positions[i]] != key:
+                break
+        else:
+            result.append(key)
+    return result
+
+def union_sorted(lists: List[List[str]]) -> List[str]:
+    """Sorted, de-duplicated merge of sorted lists"""
+    result = []
+    for key in heapq.merge(*lists):
+        if not result or result[-1] != key:
+            result.append(key)
+    return result
+
+class IndexNotReady(Exception):
+    """Raised while a user's index is missing or outdated and a rebuild job is building it"""
+
+class CategoryIndex:
+    """Category-to-notes index maintained on every note write
+
+    Each category has a document under users/{uid}/category_index whose
+    `members` map holds the sort keys of its notes. A single `_counts`
+    document holds the note count of every category. Both are updated in the
+    same batch as the note write, so the index never disagrees with the notes.
+
+    A `_cooccurrence` document counts the notes of every pair of categories,
+    and `_counts` also holds the number of notes and of categorized notes, so
+    a note write costs O(k²) index updates for its k categories, whatever the
+    note count.
+
+    A missing or outdated index is rebuilt by a background job, started
+    through `request_rebuild`; reads raise IndexNotReady until it finishes.
+
+    A members map is bounded by Firestore's 1 MiB document limit, roughly
+    25k notes per category.
+    """
+
+    def __init__(self, db_service):
+        self.db_service = db_service
+        # Starts the rebuild job for a user; set when the job manager is created
+        self.request_rebuild: Optional[Callable[[str], Awaitable]] = None
+
+    @property
+    def db(self):
+        return self.db_service.db
+
+    def _index(self, user_id: str):
+        return self.db.collection('users').document(user_id).collection(INDEX_COLLECTION)
+
+    def _category_ref(self, user_id: str, category: str):
+        doc_id = hashlib.sha1(category.encode('utf-8')).hexdigest()
+        return self._index(user_id).document(doc_id)
+
+    def on_note_change(self, batch, user_id: str, note_id: str, before: Optional[dict], after: Optional[dict]):
+        """Note listener adding the index updates for a note write to its batch"""
+        old_key = sort_key(note_id, before.get('createdAt')) if before else None
+        new_key = sort_key(note_id, after.get('createdAt')) if after else None
+        old_categories = set(before.get('categories') or []) if before else set()
+        new_categories = set(after.get('categories') or []) if after else set()
+
+        removed = old_categories - new_categories
+        added = new_categories - old_categories
+        moved = old_categories & new_categories if old_key != new_key else set()
+
+        for category in removed | moved:
+            batch.set(self._category_ref(user_id, category), {'members': {old_key: delete_field()}}, merge=True)
+        for category in added | moved:
+            batch.set(self._category_ref(user_id, category), {'category': category, 'members': {new_key: True}}, merge=True)
+
+        deltas = {category: increment(-1) for category in removed}
+        deltas.update({category: increment(1) for category in added})
+        counts_update = {'counts': deltas} if deltas else {}
+        categorized = bool(new_categories) - bool(old_categories)
+        if categorized:
+            counts_update['notes'] = increment(categorized)
+        created = bool(after) - bool(before)
+        if created:
+            counts_update['total'] = increment(created)
+        if counts_update:
+            batch.set(self._index(user_id).document(COUNTS_DOC), counts_update, merge=True)
+
+        old_pairs = category_pairs(old_categories)
+        new_pairs = category_pairs(new_categories)
+        pair_deltas = {pair: increment(-1) for pair in old_pairs - new_pairs}
+        pair_deltas.update({pair: increment(1) for pair in new_pairs - old_pairs})
+        if pair_deltas:
+            batch.set(self._index(user_id).document(COOCCURRENCE_DOC), {'pairs': pair_deltas}, merge=True)
+
+    def change_writes(self, before: Optional[dict], after: Optional[dict]) -> int:
+        """Number of writes on_note_change adds to a batch for a note write"""
+        old_key = sort_key('', before.get('createdAt')) if before else None
+        new_key = sort_key('', after.get('createdAt')) if after else None
+        old_categories = set(before.get('categories') or []) if before else set()
+        new_categories = set(after.get('categories') or []) if after else set()
+        moved = old_categories & new_categories if old_key != new_key else set()
+        counts = bool(old_categories ^ new_categories) or bool(after) != bool(before)
+        pairs = category_pairs(old_categories) != category_pairs(new_categories)
+        return len(old_categories ^ new_categories) + 2 * len(moved) + counts + pairs
+
+    def _current_counts(self, user_id: str) -> Optional[dict]:
+        """The counts document, or None if the index is missing or outdated"""
+        doc = self.db_service._get(self._index(user_id).document(COUNTS_DOC), 'category_index.counts')
+        data = doc.to_dict() if doc.exists else None
+        if not data or data.get('version') != INDEX_VERSION:
+            return None
+        return data
+
+    async def _counts_doc(self, user_id: str) -> dict:
+        data = self._current_counts(user_id)
+        if data is None:
+            if self.request_rebuild is not None:
+                await self.request_rebuild(user_id)
+            raise IndexNotReady("Category index is being rebuilt")
+        return data
+
+    async def ensure_built(self, user_id: str) -> Tuple[Dict[str, int], int]:
+        """Like summary(), but rebuilds a missing or outdated index in the caller
+
+        For background jobs: waiting on the rebuild job instead could hold
+        every job thread while the rebuild is queued behind them.
+        """
+        if self._current_counts(user_id) is None:
+            await self.rebuild(user_id)
+        return await self.summary(user_id)
+
+    async def _members(self, user_id: str, category: str) -> List[str]:
+        doc = self.db_service._get(self._category_ref(user_id, category), 'category_index.members')
+        if not doc.exists:
+            return []
+        return sorted((doc.to_dict() or {}).get('members', {}))
+
+    @tracing.traced("db.category_index.counts")
+    async def counts(self, user_id: str) -> Dict[str, int]:
+        """Number of notes in each category, from one document read"""
+        return (await self.summary(user_id))[0]
+
+    async def summary(self, user_id: str) -> Tuple[Dict[str, int], int]:
+        """Number of notes in each category and in total, from one document read"""
+        data = await self._counts_doc(user_id)
+        counts = {category: count for category, count in data.get('counts', {}).items() if count > 0}
+        return counts, data.get('total', 0)
+
+    async def _pair_counts(self, user_id: str) -> Tuple[Dict[str, int], int, Dict[Tuple[str, str], int]]:
+        """Category counts, categorized note count and pair counts, from two document reads"""
+        data = await self._counts_doc(user_id)
+        counts = {category: count for category, count in data.get('counts', {}).items() if count > 0}
+        doc = self.db_service._get(self._index(user_id).document(COOCCURRENCE_DOC), 'category_index.cooccurrence')
+        pairs = {}
+        for key, count in ((doc.to_dict() or {}).get('pairs') or {} if doc.exists else {}).items():
+            a, _, b = key.partition(PAIR_SEPARATOR)
+            if count > 0 and a in counts and b in counts:
+                pairs[(a, b)] = count
+        return counts, data.get('notes', 0), pairs
+
+    @staticmethod
+    def _pmi(together: int, a: int, b: int, notes: int) -> Tuple[float, float]:
+        """Pointwise mutual information of two categories and its normalized form in [-1, 1]"""
+        p_ab = together / notes
+        pmi = math.log(p_ab / ((a / notes) * (b / notes)))
+        npmi = 1.0 if p_ab >= 1 else pmi / -math.log(p_ab)
+        return pmi, npmi
+
+    @tracing.traced("db.category_index.cooccurrence")
+    async def cooccurrence(self, user_id: str, category: Optional[str] = None, limit: int = 50,
+                           min_count: int = 1) -> dict:
+        """Category pairs that share notes, most strongly associated first
+
+        Pairs are ranked by normalized PMI: 1 when two categories always occur
+        together, 0 when they co-occur as often as chance predicts. Pass
+        `category` to only list pairs including it.
+        """
+        counts, notes, pairs = await self._pair_counts(user_id)
+        results = []
+        for (a, b), together in pairs.items():
+            if together < min_count or (category is not None and category not in (a, b)):
+                continue
+            pmi, npmi = self._pmi(together, counts[a], counts[b], max(notes, together))
+            results.append({'categories': [a, b], 'count': together, 'pmi': round(pmi, 4), 'npmi': round(npmi, 4)})
+        results.sort(key=lambda pair: (pair['npmi'], pair['count']), reverse=True)
+        return {'pairs': results[:limit], 'total': len(results), 'notes': notes}
+
+    @tracing.traced("db.category_index.suggest")
+    async def suggest(self, user_id: str, categories: Iterable[str], limit: int = 5, min_count: int = 2) -> List[dict]:
+        """Other categories often used together with `categories`, best first
+
+        A suggestion's score is the share of the notes in the given categories
+        that also have it. Only categories co-occurring more often than chance
+        (positive PMI) and on at least `min_count` notes are suggested.
+        """
+        given = set(categories)
+        if not given:
+            return []
+        counts, notes, pairs = await self._pair_counts(user_id)
+        base = sum(counts.get(category, 0) for category in given)
+        together: Dict[str, int] = {}
+        associated = set()
+        for (a, b), count in pairs.items():
+            for source, other in ((a, b), (b, a)):
+                if source in given and other not in given:
+                    together[other] = together.get(other, 0) + count
+                    if count >= min_count and self._pmi(count, counts[a], counts[b], max(notes, count))[0] > 0:
+                        associated.add(other)
+        suggestions = [
+            {'category': other, 'score': round(count / base, 4), 'count': count}
+            for other, count in together.items() if other in associated
+        ]
+        suggestions.sort(key=lambda suggestion: (suggestion['score'], suggestion['count']), reverse=True)
+        return suggestions[:limit]
+
+    @tracing.traced("db.category_index.query")
+    async def query(self, user_id: str, all_of: Iterable[str] = (), any_of: Iterable[str] = (),
+                    none_of: Iterable[str] = (), limit: int = 50, cursor: Optional[str] = None) -> dict:
+        """Note ids in every `all_of`, at least one `any_of` and no `none_of` category
+
+        Results are newest first. Pass the returned `next` as `cursor` for the
+        following page; `total` counts all matches.
+        """
+        all_of, any_of, none_of = list(all_of), list(any_of), list(none_of)
+        if not all_of and not any_of:
+            raise ValueError("At least one category to include is required")
+
+        await self._counts_doc(user_id)
+        members = {}
+        for category in dict.fromkeys(all_of + any_of + none_of):
+            members[category] = await self._members(user_id, category)
+
+        if all_of:
+            matches = intersect_sorted([members[category] for category in all_of])
+            if any_of:
+                allowed = set().union(*(members[category] for category in any_of))
+                matches = [key for key in matches if key in allowed]
+        else:
+            matches = union_sorted([members[category] for category in any_of])
+        if none_of:
+            excluded = set().union(*(members[category] for category in none_of))
+            matches = [key for key in matches if key not in excluded]
+
+        start = bisect.bisect_right(matches, cursor) if cursor else 0
+        page = matches[start:start + limit]
+        return {
+            'note_ids': [note_id_from_key(key) for key in page],
+            'total': len(matches),
+            'next': page[-1] if page and start + limit < len(matches) else None,
+        }
+
+    @tracing.traced("db.category_index.rebuild")
+    async def rebuild(self, user_id: str) -> dict:
+        """Rebuild a user's index from their notes; returns the counts document
+
+        Run by the rebuild job rather than inline. Every note write bumps the
+        user's data version, so a pass that overlapped one is run again
+        instead of keeping index documents the write's updates may have lost.
+        """
+        for _ in range(REBUILD_ATTEMPTS):
+            version = await self.db_service.get_data_version(user_id)
+            counts = self._rebuild_pass(user_id)
+            if await self.db_service.get_data_version(user_id) == version:
+                logger.info("Rebuilt category index", extra={"user_id": user_id, "categories": len(counts['counts'])})
+                return counts
+        raise RuntimeError("Notes kept changing while the category index was rebuilt")
+
+    def _rebuild_pass(self, user_id: str) -> dict:
+        notes = self.db.collection('users').document(user_id).collection('notes')
+        members: Dict[str, dict] = {}
+        pairs: Dict[str, int] = {}
+        categorized = 0
+        total = 0
+        for doc in self.db_service._stream(notes.select(['categories', 'createdAt']), 'category_index.rebuild'):
+            data = doc.to_dict() or {}
+            key = sort_key(doc.id, data.get('createdAt'))
+            categories = set(data.get('categories') or [])
+            total += 1
+            categorized += bool(categories)
+            for category in categories:
+                members.setdefault(category, {})[key] = True
+            for pair in category_pairs(categories):
+                pairs[pair] = pairs.get(pair, 0) + 1
+
+        stale = [
+            doc.reference for doc in self.db_service._stream(self._index(user_id).select([]), 'category_index.rebuild')
+            if doc.id not in (COUNTS_DOC, COOCCURRENCE_DOC)
+        ]
+        live = {self._category_ref(user_id, category).id for category in members}
+
+        batch = self.db_service._batch('category_index.rebuild')
+        pending = 0
+        
+        def add_write(write):
+            nonlocal batch, pending
+            if pending >= BATCH_LIMIT - 1:
+                batch.commit()
+                batch = self.db_service._batch('category_index.rebuild')
+                pending = 0
+            write(batch)
+            pending += 1
+        
+        for reference in stale:
+            if reference.id not in live:
+                add_write(lambda b, reference=reference: b.delete(reference))
+        for category, keys in members.items():
+            category_ref = self._category_ref(user_id, category)
+            add_write(lambda b, ref=category_ref, data={'category': category, 'members': keys}: b.set(ref, data))
+
+        counts = {
+            'counts': {category: len(keys) for category, keys in members.items()},
+            'notes': categorized,
+            'total': total,
+            'version': INDEX_VERSION,
+        }
+        add_write(lambda b: b.set(self._index(user_id).document(COOCCURRENCE_DOC), {'pairs': pairs}))
+        batch.set(self._index(user_id).document(COUNTS_DOC), counts)
+        batch.commit()
+        return counts
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from .common import BATCH_LIMIT, DOCUMENT_ID
+from .jobs import JobContext, JobManager, lower_thread_priority
+
+logger = logging.getLogger(__name__)
+
+REWRITE_JOB = 'category_rewrite'
+RECATEGORIZE_JOB = 'recategorize'
+INDEX_JOB = 'category_index_rebuild'
+
+# Notes fetched from the category index per pass
+PAGE_SIZE = 500
+
+# Batches committed at once per job
+WRITE_CONCURRENCY = 4
+
+# Notes categorized per LLM prompt when re-categorizing
+RECATEGORIZE_BATCH = int(os.getenv('RECATEGORIZE_BATCH', '8'))
+
+# LLM calls in flight per re-categorization job
+RECATEGORIZE_CONCURRENCY = int(os.getenv('RECATEGORIZE_CONCURRENCY', '2'))
+
+# Notes read per page when re-categorizing; small enough that progress (the
+# job's heartbeat and checkpoint) is saved every few rounds of LLM calls
+_RECATEGORIZE_PAGE = RECATEGORIZE_BATCH * RECATEGORIZE_CONCURRENCY * 4
+
+_NOTE_FIELDS = ['content', 'metadata.title', 'metadata.url', 'metadata.domain', 'categories', 'createdAt']
+
+def notes_per_batch(sources: List[str]) -> int:
+    """Notes per batch that keep it under the write limit
+
+    Each note costs its own update, a removal from the index of every source it
+    had, an addition to the target's index, a counts update and a co-occurrence
+    update; the batch also bumps the data version.
+    """
+    return max(1, (BATCH_LIMIT - 1) // (len(sources) + 4))
+
+def rewrite_params(sources: List[str], target: Optional[str]) -> dict:
+    """Parameters of a job moving notes from `sources` to `target` (None removes them)"""
+    return {'sources': sorted(set(sources) - {target}), 'target': target}
+
+async def rewrite_note_categories(job: JobContext):
+    """Rewrite every note in a source category; safe to re-run after a failure
+
+    Work is found through the category index, so a note drops out as soon as
+    its batch commits and a resumed job only sees what is left. Notes the
+    index lists but no longer match are skipped, and a rebuild of the index
+    is requested once the job is done. Batches commit on low-priority threads.
+    """
+    db_service = job.db_service
+    index = db_service.category_index
+    sources, target = job.params['sources'], job.params['target']
+    if not sources:
+        job.progress(total=job.processed)
+        return
+
+    await index.ensure_built(job.user_id)
+    remaining = (await index.query(job.user_id, any_of=sources, limit=0))['total']
+    job.progress(total=job.processed + remaining)
+
+    chunk_size = notes_per_batch(sources)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(WRITE_CONCURRENCY, thread_name_prefix='category-rewrite',
+                                  initializer=lower_thread_priority)
+
+    async def sweep():
+        """One pass over the index, newest first; the notes changed and the index entries skipped"""
+        changed, skipped, cursor = 0, 0, None
+        while True:
+            page = await index.query(job.user_id, any_of=sources, limit=PAGE_SIZE, cursor=cursor)
+            if not page['note_ids']:
+                break
+            notes = await db_service.get_notes_by_ids(job.user_id, page['note_ids'], fields=['categories', 'createdAt'])
+            notes = [note for note in notes if set(note.get('categories') or []) & set(sources)]
+            skipped += len(page['note_ids']) - len(notes)
+
+            chunks = [notes[start:start + chunk_size] for start in range(0, len(notes), chunk_size)]
+            results = await asyncio.gather(*(
+                loop.run_in_executor(executor, db_service.rewrite_note_categories, job.user_id, chunk, sources, target)
+                for chunk in chunks
+            ))
+            changed += sum(results)
+            job.progress(processed=job.processed + sum(results))
+            cursor = page['next']
+            if cursor is None:
+                break
+        return changed, skipped
+
+    try:
+        # Notes moved into a source behind the cursor are picked up by another pass
+        while True:
+            changed, skipped = await sweep()
+            if not changed:
+                break
+    finally:
+        executor.shutdown(wait=False)
+
+    if skipped:
+        logger.warning("Category index lists notes outside their categories", extra={
+            "user_id": job.user_id, "sources": sources, "skipped": skipped,
+        })
+        if index.request_rebuild is not None:
+            await index.request_rebuild(job.user_id)
+    job.result = {'skipped': skipped}
+    logger.info("Rewrote note categories", extra={
+        "user_id": job.user_id, "sources": sources, "target": target, "notes": job.processed,
+    })
+
+async def recategorize_notes(job: JobContext, llm_service):
+    """Re-run every note through the LLM against the user's current categories
+
+    Notes are read oldest first, a page at a time; the checkpoint holds the
+    createdAt and id of the last note written, so a resumed or cancelled job
+    carries on after it, even past notes sharing its timestamp. Notes the
+    model gives no usable answer for keep their categories. LLM calls run on
+    low-priority threads, a few at a time.
+    """
+    if llm_service is None:
+        raise RuntimeError("LLM service not available")
+    db_service = job.db_service
+    categories = await db_service.get_user_categories(job.user_id)
+    if not categories:
+        raise ValueError("The user has no categories to assign")
+
+    checkpoint = dict(job.checkpoint or {})
+    stats = {key: checkpoint.get(key, 0) for key in ('changed', 'unchanged', 'failed')}
+    if job.total is None:
+        _, total = await job.db_service.category_index.ensure_built(job.user_id)
+        job.progress(total=total)
+
+    notes_collection = db_service.db.collection('users').document(job.user_id).collection('notes')
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(RECATEGORIZE_CONCURRENCY)
+    executor = ThreadPoolExecutor(RECATEGORIZE_CONCURRENCY, thread_name_prefix='recategorize',
+                                  initializer=lower_thread_priority)
+
+    async def categorize(batch):
+        prompts = [{
+            'content': note.get('content', ''),
+            'title': (note.get('metadata') or {}).get('title', ''),
+            'url': (note.get('metadata') or {}).get('url', ''),
+            'domain': (note.get('metadata') or {}).get('domain', ''),
+        } for note in batch]
+        async with semaphore:
+            # The service's blocking client call runs on its own loop in the pool thread
+            return await loop.run_in_executor(executor, asyncio.run, llm_service.categorize_notes(prompts, categories))
+
+    try:
+        while True:
+            query = notes_collection.order_by('createdAt').order_by(DOCUMENT_ID).select(_NOTE_FIELDS)
+            query = query.limit(_RECATEGORIZE_PAGE)
+            if 'after' in checkpoint:
+                cursor = {'createdAt': checkpoint['after']}
+                if 'afterId' in checkpoint:
+                    cursor[DOCUMENT_ID] = checkpoint['afterId']
+                query = query.start_after(cursor)
+            notes = []
+            for doc in db_service._stream(query, 'recategorize_notes'):
+                note = doc.to_dict() or {}
+                note['id'] = doc.id
+                notes.append(note)
+            if not notes:
+                break
+
+            batches = [notes[start:start + RECATEGORIZE_BATCH] for start in range(0, len(notes), RECATEGORIZE_BATCH)]
+            answers = await asyncio.gather(*(categorize(batch) for batch in batches))
+            assigned = {}
+            for batch, results in zip(batches, answers):
+                for note, result in zip(batch, results):
+                    if result is None:
+                        stats['failed'] += 1
+                    else:
+                        assigned[note['id']] = result
+
+            changed = await asyncio.to_thread(db_service.set_note_categories, job.user_id, notes, assigned)
+            stats['changed'] += changed
+            stats['unchanged'] += len(assigned) - changed
+
+            checkpoint = {'after': notes[-1]['createdAt'], 'afterId': notes[-1]['id'], **stats}
+            processed = job.processed + len(notes)
+            job.progress(processed=processed, total=max(job.total or 0, processed), checkpoint=checkpoint)
+    finally:
+        executor.shutdown(wait=False)
+
+    job.progress(total=job.processed)
+    job.result = stats
+    logger.info("Re-categorized notes", extra={"user_id": job.user_id, "notes": job.processed, **stats})
+
+async def rebuild_category_index(job: JobContext):
+    """Build a user's category index from their notes; started when a read finds it missing or outdated"""
+    counts = await job.db_service.category_index.rebuild(job.user_id)
+    job.progress(processed=counts['total'], total=counts['total'])
+    job.result = {'categories': len(counts['counts']), 'notes': counts['total']}
+
+def register_category_jobs(manager: JobManager, llm_service: Callable[[], object] = lambda: None):
+    """Register the category jobs; `llm_service` returns the service when re-categorizing runs"""
+    manager.register(REWRITE_JOB, rewrite_note_categories)
+    manager.register(RECATEGORIZE_JOB, lambda job: recategorize_notes(job, llm_service()))
+    manager.register(INDEX_JOB, rebuild_category_index)
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+# Firestore batches hold at most 500 writes; batches from
+# DatabaseService._write_batch spend one of them on the data version
+BATCH_LIMIT = 500
+
+# Same value as firestore.FieldPath.document_id(), for ordering and cursors on document ids
+DOCUMENT_ID = '__name__'
+
+def increment(amount: int):
+    # Imported on first write; the client module is loaded by then anyway
+    from google.cloud.firestore import Increment
+    return Increment(amount)
+
+def delete_field():
+    from google.cloud.firestore import DELETE_FIELD
+    return DELETE_FIELD
+
+def utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Firestore stores naive datetimes as UTC and returns them timezone-aware; compare them that way"""
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
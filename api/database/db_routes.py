@@ -1,15 +1,27 @@
 from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel
+from datetime import datetime
 from typing import List, Optional
-from .db_service import DatabaseService
+from .category_index import IndexNotReady
+from .db_service import DatabaseService, parse_note_fields
 from ..auth.auth_service import AuthService
 from ..auth.models import UserInfo
+from ..core.responses import FastJSONResponse
 import logging
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/db", tags=["database"])
 
+FIELDS_DESCRIPTION = "Comma-separated note fields to return, e.g. summary,preview (default: full notes)"
+
+# Seconds clients are asked to wait while a user's category index is rebuilt
+INDEX_RETRY_AFTER = 5
+
+def index_not_ready() -> HTTPException:
+    return HTTPException(status_code=503, detail="Category index is being rebuilt, please retry",
+                         headers={"Retry-After": str(INDEX_RETRY_AFTER)})
+
 class SearchRequest(BaseModel):
     query: str
     limit: Optional[int] = 20
@@ -18,45 +30,130 @@ class CategoryFilterRequest(BaseModel):
     category: str
     limit: Optional[int] = 50
 
-# Database service will be initialized when the main app starts
+# Database service will be initialized when the main app starts; a callable
+# returning the service may be set instead when it is created lazily
 db_service = None
 
 def set_db_service(service: DatabaseService):
     global db_service
     db_service = service
 
+def get_db_service() -> Optional[DatabaseService]:
+    return db_service() if callable(db_service) else db_service
+
 @router.get("/notes/search")
 async def search_notes(
     query: str = Query(..., description="Search query"),
     limit: int = Query(20, description="Maximum number of results"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Search user's notes"""
+    db_service = get_db_service()
     if not db_service:
         raise HTTPException(status_code=503, detail="Database service not available")
     
     try:
-        notes = await db_service.search_notes(current_user.user_id, query, limit)
-        return {"notes": notes}
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        notes = await db_service.search_notes(current_user.user_id, query, limit, fields=field_paths)
+        return FastJSONResponse({"notes": notes})
     except Exception as e:
-        logger.error(f"Error searching notes: {e}")
+        logger.error("Error searching notes: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/notes/by-category")
 async def get_notes_by_category(
     category: str = Query(..., description="Category to filter by"),
     limit: int = Query(50, description="Maximum number of results"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Get notes filtered by category"""
+    db_service = get_db_service()
     if not db_service:
         raise HTTPException(status_code=503, detail="Database service not available")
     
     try:
-        notes = await db_service.get_notes_by_category(current_user.user_id, category, limit)
-        return {"notes": notes}
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        notes = await db_service.get_notes_by_category(current_user.user_id, category, limit, fields=field_paths)
+        return FastJSONResponse({"notes": notes})
+    except IndexNotReady:
+        raise index_not_ready()
+    except Exception as e:
+        logger.error("Error getting notes by category: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/notes/by-categories")
+async def query_notes_by_categories(
+    all_of: Optional[List[str]] = Query(None, alias="all", description="Notes must have every one of these categories"),
+    any_of: Optional[List[str]] = Query(None, alias="any", description="Notes must have at least one of these categories"),
+    none_of: Optional[List[str]] = Query(None, alias="none", description="Notes must have none of these categories"),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of results"),
+    cursor: Optional[str] = Query(None, description="The `next` value of the previous page"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get notes matching a combination of categories, newest first"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        result = await db_service.query_notes_by_categories(
+            current_user.user_id, all_of or [], any_of or [], none_of or [], limit, cursor, fields=field_paths
+        )
+        return FastJSONResponse(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except IndexNotReady:
+        raise index_not_ready()
+    except Exception as e:
+        logger.error("Error querying notes by categories: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/notes/query")
+async def query_notes(
+    since: Optional[datetime] = Query(None, alias="from", description="Notes created at or after this time"),
+    until: Optional[datetime] = Query(None, alias="to", description="Notes created before this time"),
+    domain: Optional[str] = Query(None, description="Notes from this domain; www. is ignored"),
+    url: Optional[str] = Query(None, description="Notes of this page; scheme, fragment and tracking parameters are ignored"),
+    limit: int = Query(50, ge=1, le=500, description="Maximum number of results"),
+    cursor: Optional[str] = Query(None, description="The `next` value of the previous page"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get notes by creation time range and domain or page URL, newest first"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        result = await db_service.query_notes(
+            current_user.user_id, since, until, domain, url, limit, cursor, fields=field_paths
+        )
+        return FastJSONResponse(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        logger.error(f"Error getting notes by category: {e}")
+        logger.error("Error querying notes: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/notes/{note_id}")
@@ -65,6 +162,7 @@ async def get_note_by_id(
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Get a specific note by ID"""
+    db_service = get_db_service()
     if not db_service:
         raise HTTPException(status_code=503, detail="Database service not available")
     
@@ -72,11 +170,103 @@ async def get_note_by_id(
         note = await db_service.get_note_by_id(current_user.user_id, note_id)
         if not note:
             raise HTTPException(status_code=404, detail="Note not found")
-        return {"note": note}
+        return FastJSONResponse({"note": note})
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error getting note by ID: {e}")
+        logger.error("Error getting note by ID: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/notes/{note_id}/related")
+async def get_related_notes(
+    note_id: str,
+    limit: int = Query(10, ge=1, le=50, description="Maximum number of related notes"),
+    fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get the notes most related to a note by categories, content terms and source, best first"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        notes = await db_service.related.get(current_user.user_id, note_id, limit, fields=field_paths)
+        if notes is None:
+            raise HTTPException(status_code=404, detail="Note not found")
+        return FastJSONResponse({"notes": notes, "count": len(notes)})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error getting related notes: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/graph/neighborhood")
+async def get_graph_neighborhood(
+    node: str = Query(..., description="category:<name>, domain:<name> or note:<id>"),
+    depth: int = Query(2, ge=1, le=6, description="Edges to travel; categories sharing a note are 2 apart"),
+    include_notes: bool = Query(False, description="Return notes as nodes rather than linking categories and domains directly"),
+    limit: int = Query(200, ge=1, le=2000, description="Maximum number of nodes"),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get the categories, domains and optionally notes around a node, nearest first"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        result = await db_service.graph.neighborhood(current_user.user_id, node, depth, include_notes, limit)
+        return FastJSONResponse(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Node not found")
+    except Exception as e:
+        logger.error("Error getting graph neighborhood: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/graph/path")
+async def get_graph_path(
+    source: str = Query(..., alias="from", description="category:<name>, domain:<name> or note:<id>"),
+    target: str = Query(..., alias="to", description="category:<name>, domain:<name> or note:<id>"),
+    max_depth: int = Query(12, ge=1, le=40, description="Longest path searched, in edges"),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get a shortest chain of notes, categories and domains connecting two nodes"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        path = await db_service.graph.path(current_user.user_id, source, target, max_depth)
+        return FastJSONResponse({"connected": path is not None, "path": path or [], "length": len(path) - 1 if path else None})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Node not found")
+    except Exception as e:
+        logger.error("Error getting graph path: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/graph/components")
+async def get_graph_components(
+    limit: int = Query(20, ge=1, le=500, description="Maximum number of clusters"),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get clusters of notes connected through shared categories or domains, largest first"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        result = await db_service.graph.components(current_user.user_id, limit)
+        return FastJSONResponse(result)
+    except Exception as e:
+        logger.error("Error getting graph components: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/statistics")
@@ -84,12 +274,75 @@ async def get_user_statistics(
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Get statistics about user's notes"""
+    db_service = get_db_service()
     if not db_service:
         raise HTTPException(status_code=503, detail="Database service not available")
     
     try:
-        stats = await db_service.get_notes_statistics(current_user.user_id)
-        return stats
+        version = await db_service.get_data_version(current_user.user_id)
+        stats = await db_service.get_notes_statistics(current_user.user_id, version)
+        return FastJSONResponse(stats)
+    except IndexNotReady:
+        raise index_not_ready()
+    except Exception as e:
+        logger.error("Error getting statistics: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/categories/counts")
+async def get_category_counts(
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get the number of notes in each category"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        counts = await db_service.category_index.counts(current_user.user_id)
+        return FastJSONResponse({"counts": counts})
+    except IndexNotReady:
+        raise index_not_ready()
     except Exception as e:
-        logger.error(f"Error getting statistics: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        logger.error("Error getting category counts: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/categories/cooccurrence")
+async def get_category_cooccurrence(
+    category: Optional[str] = Query(None, description="Only pairs including this category"),
+    limit: int = Query(50, ge=1, le=1000, description="Maximum number of pairs"),
+    min_count: int = Query(1, ge=1, description="Fewest shared notes for a pair to be listed"),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get category pairs that share notes, with PMI scores, most strongly associated first"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        result = await db_service.category_index.cooccurrence(current_user.user_id, category, limit, min_count)
+        return FastJSONResponse(result)
+    except IndexNotReady:
+        raise index_not_ready()
+    except Exception as e:
+        logger.error("Error getting category co-occurrence: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/categories/suggestions")
+async def get_category_suggestions(
+    categories: List[str] = Query(..., alias="category", description="Categories already chosen"),
+    limit: int = Query(5, ge=1, le=50, description="Maximum number of suggestions"),
+    current_user: UserInfo = Depends(AuthService.verify_token)
+):
+    """Get categories often used together with the given ones"""
+    db_service = get_db_service()
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available")
+
+    try:
+        suggestions = await db_service.category_index.suggest(current_user.user_id, categories, limit)
+        return FastJSONResponse({"suggestions": suggestions})
+    except IndexNotReady:
+        raise index_not_ready()
+    except Exception as e:
+        logger.error("Error getting category suggestions: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,29 +1,320 @@
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
-from firebase_admin import firestore
+from ..core import metrics, tracing
+from .category_index import CategoryIndex, IndexNotReady
+from .common import BATCH_LIMIT, delete_field, increment, utc
+from .dedup import DuplicateIndex, note_fingerprint
+from .graph import KnowledgeGraph
+from .lookup import decode_cursor, domain_key, encode_cursor, lookup_keys, url_key
+from .related import RelatedNotes, note_terms
 
 logger = logging.getLogger(__name__)
 
+# Same value as firestore.Query.DESCENDING, without importing firebase_admin at startup
+DESCENDING = 'DESCENDING'
+
+# A user's categories are read on every note save and categorization; they are
+# invalidated on every category write, the TTL only bounds staleness from writes
+# made by other instances
+CATEGORY_CACHE_TTL = 300
+
+# Recent-note pages and statistics are cached under the user's data version,
+# which every note write bumps; the TTL only bounds how long dead entries linger
+NOTES_CACHE_TTL = 300
+
+# Size of the recent-notes page clients load first, prefetched at login
+PREFETCH_NOTES_LIMIT = 50
+
+# Note fields that may be requested with ?fields=; the id is always returned
+NOTE_FIELDS = {
+    'content', 'contentPreview', 'categories', 'createdAt', 'updatedAt',
+    'metadata', 'metadata.title', 'metadata.url', 'metadata.domain', 'metadata.summary', 'terms',
+}
+
+# Named projections usable in ?fields= alongside plain field names
+NOTE_FIELD_ALIASES = {
+    'summary': ['metadata.title', 'metadata.url', 'metadata.domain', 'categories', 'createdAt'],
+    'preview': ['contentPreview'],
+}
+
+# Tombstones kept for delta sync; clients with older sync tokens must resync fully
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+# Length of the content preview stored with each note at write time
+CONTENT_PREVIEW_CHARS = 200
+
+def parse_note_fields(value: Optional[str]) -> Optional[List[str]]:
+    """Parse a ?fields= value into field paths; None means the full note"""
+    if not value:
+        return None
+    fields = []
+    for name in filter(None, (part.strip() for part in value.split(','))):
+        if name in NOTE_FIELD_ALIASES:
+            fields.extend(NOTE_FIELD_ALIASES[name])
+        elif name in NOTE_FIELDS:
+            fields.append(name)
+        elif name != 'id':
+            raise ValueError(f"Unknown note field: {name}")
+    return list(dict.fromkeys(fields))
+
+def content_preview(content: str, max_chars: int = CONTENT_PREVIEW_CHARS) -> str:
+    """Leading text of a note, cut at a word boundary"""
+    text = ' '.join(content.split())
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(' ', 0, max_chars)
+    return text[:cut if cut > 0 else max_chars].rstrip() + '...'
+
+def rewrite_categories(categories: List[str], sources: List[str], target: Optional[str]) -> List[str]:
+    """Categories with every source replaced by target, or removed when target is None"""
+    rewritten = []
+    for category in categories:
+        if category in sources:
+            category = target
+        if category is not None and category not in rewritten:
+            rewritten.append(category)
+    return rewritten
+
+class _RecordedBatch:
+    """Write batch that records its writes and deletes in storage metrics on commit"""
+    
+    def __init__(self, batch, operation: str):
+        self._batch = batch
+        self.operation = operation
+        self.writes = 0
+        self.deletes = 0
+        self._after_commit = []
+    
+    def set(self, reference, data: dict, merge: bool = False):
+        self._batch.set(reference, data, merge=merge)
+        self.writes += 1
+    
+    def update(self, reference, data: dict):
+        self._batch.update(reference, data)
+        self.writes += 1
+    
+    def delete(self, reference):
+        self._batch.delete(reference)
+        self.deletes += 1
+    
+    def after_commit(self, callback):
+        """Run callback() once the batch has committed; its errors are logged, not raised"""
+        self._after_commit.append(callback)
+    
+    def commit(self):
+        self._batch.commit()
+        metrics.record_storage_op(self.operation, 'write', self.writes)
+        metrics.record_storage_op(self.operation, 'delete', self.deletes)
+        for callback in self._after_commit:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Error in after-commit callback of %s: %s", self.operation, e)
+
 class DatabaseService:
-    def __init__(self, db_client):
+    def __init__(self, db_client, cache=None):
         self.db = db_client
+        self.cache = cache
+        self._note_listeners = []
+        self.category_index = CategoryIndex(self)
+        self.add_note_listener(self.category_index.on_note_change)
+        self.duplicates = DuplicateIndex(self)
+        self.add_note_listener(self.duplicates.on_note_change)
+        self.related = RelatedNotes(self)
+        self.add_note_listener(self.related.on_note_change)
+        self.graph = KnowledgeGraph(self)
+    
+    def add_note_listener(self, listener):
+        """Register listener(batch, user_id, note_id, before, after) for note writes
+        
+        Listeners run before the batch commits and may add their own writes to
+        it. `before` is None on create and `after` is None on delete.
+        """
+        self._note_listeners.append(listener)
+    
+    def _notify_note_change(self, batch, user_id: str, note_id: str, before: Optional[dict], after: Optional[dict]):
+        for listener in self._note_listeners:
+            listener(batch, user_id, note_id, before, after)
+    
+    def _listener_writes(self, before: Optional[dict], after: Optional[dict]) -> int:
+        """Number of writes the note listeners add to a batch for a note write"""
+        return self.category_index.change_writes(before, after) + self.duplicates.change_writes(before, after)
+    
+    def _stream(self, query, operation: str):
+        """Stream a query, counting every document read"""
+        metrics.record_storage_op(operation, 'query')
+        reads = 0
+        try:
+            for doc in query.stream():
+                reads += 1
+                yield doc
+        finally:
+            metrics.record_storage_op(operation, 'read', reads)
+    
+    def _get(self, doc_ref, operation: str):
+        """Fetch a single document, counting the read"""
+        metrics.record_storage_op(operation, 'read')
+        return doc_ref.get()
     
+    def _get_all(self, references: list, operation: str, field_paths: Optional[List[str]] = None):
+        """Fetch several documents in one round trip, counting the reads"""
+        metrics.record_storage_op(operation, 'read', len(references))
+        return self.db.get_all(references, field_paths=field_paths)
+    
+    def _batch(self, operation: str) -> _RecordedBatch:
+        return _RecordedBatch(self.db.batch(), operation)
+    
+    def _write_batch(self, user_id: str, operation: str) -> _RecordedBatch:
+        """Start a batch that also bumps the user's data version when committed"""
+        batch = self._batch(operation)
+        user_ref = self.db.collection('users').document(user_id)
+        batch.set(user_ref, {'dataVersion': increment(1)}, merge=True)
+        return batch
+    
+    def _read_note(self, note_ref, operation: str) -> Optional[dict]:
+        """Current state of a note before a write, for note listeners"""
+        doc = self._get(note_ref, operation)
+        if not doc.exists:
+            return None
+        note_data = doc.to_dict()
+        note_data['id'] = doc.id
+        return note_data
+    
+    def _write_tombstone(self, batch, user_id: str, kind: str, doc_id: str):
+        """Record a deletion so delta sync can report it"""
+        tombstone_ref = self.db.collection('users').document(user_id).collection('tombstones').document(f"{kind}_{doc_id}")
+        batch.set(tombstone_ref, {'kind': kind, 'id': doc_id, 'deletedAt': datetime.now()})
+    
+    @tracing.traced("db.get_data_version")
+    async def get_data_version(self, user_id: str) -> int:
+        """Version of a user's notes and categories, increased by every write to them"""
+        try:
+            user_ref = self.db.collection('users').document(user_id)
+            metrics.record_storage_op('get_data_version', 'read')
+            doc = user_ref.get(field_paths=['dataVersion'])
+            return (doc.to_dict() or {}).get('dataVersion', 0)
+        except Exception as e:
+            logger.error("Error getting data version: %s", e)
+            raise
+    
+    @tracing.traced("db.get_sync_state")
+    async def get_sync_state(self, user_id: str) -> dict:
+        """Data version and tombstone compaction state of a user"""
+        try:
+            user_ref = self.db.collection('users').document(user_id)
+            metrics.record_storage_op('get_sync_state', 'read')
+            doc = user_ref.get(field_paths=['dataVersion', 'tombstoneHorizon', 'tombstonesCompactedAt'])
+            return doc.to_dict() or {}
+        except Exception as e:
+            logger.error("Error getting sync state: %s", e)
+            raise
+    
+    @tracing.traced("db.get_changes")
+    async def get_changes(self, user_id: str, collection: str, since=None, seen_ids=(), limit: int = 200,
+                          fields: Optional[List[str]] = None, time_field: str = 'updatedAt') -> List[dict]:
+        """Documents of a user collection changed at or after `since`, oldest first
+        
+        Documents in `seen_ids` (already returned at exactly `since`) are skipped,
+        so a cursor can sit on a timestamp shared by several documents.
+        """
+        try:
+            query = self.db.collection('users').document(user_id).collection(collection)
+            if since is not None:
+                query = query.where(time_field, '>=', since)
+            query = query.order_by(time_field).limit(limit + len(seen_ids))
+            if fields:
+                query = query.select(list(dict.fromkeys(fields + [time_field])))
+            
+            seen = set(seen_ids)
+            changes = []
+            for doc in self._stream(query, f'get_changes.{collection}'):
+                if doc.id in seen:
+                    continue
+                data = doc.to_dict()
+                data['id'] = doc.id
+                changes.append(data)
+                if len(changes) >= limit:
+                    break
+            return changes
+        except Exception as e:
+            logger.error("Error getting changes: %s", e)
+            raise
+    
+    @tracing.traced("db.compact_tombstones")
+    async def compact_tombstones(self, user_id: str, retention: timedelta = TOMBSTONE_RETENTION, batch_size: int = BATCH_LIMIT - 1):
+        """Delete tombstones older than the retention period and return the new horizon
+        
+        Sync tokens older than the horizon can no longer be served incrementally.
+        """
+        try:
+            now = datetime.now()
+            cutoff = now - retention
+            tombstones = self.db.collection('users').document(user_id).collection('tombstones')
+            query = tombstones.where('deletedAt', '<', cutoff).order_by('deletedAt').limit(batch_size)
+            
+            batch = self._batch('compact_tombstones')
+            deleted = 0
+            last_deleted_at = None
+            for doc in self._stream(query, 'compact_tombstones'):
+                batch.delete(doc.reference)
+                deleted += 1
+                last_deleted_at = doc.get('deletedAt')
+            
+            state = {'tombstonesCompactedAt': now}
+            horizon = None
+            if deleted:
+                # A partial pass only guarantees tombstones up to the last one removed
+                horizon = cutoff if deleted < batch_size else last_deleted_at
+                state['tombstoneHorizon'] = horizon
+            batch.set(self.db.collection('users').document(user_id), state, merge=True)
+            batch.commit()
+            return horizon
+        except Exception as e:
+            logger.error("Error compacting tombstones: %s", e)
+            raise
+    
+    @tracing.traced("db.create_note")
     async def create_note(self, user_id: str, note_data: dict) -> str:
         """Create a new note for a user"""
         try:
             notes_collection = self.db.collection('users').document(user_id).collection('notes')
-            doc_ref = notes_collection.add(note_data)
-            return doc_ref[1].id
+            note_data['contentPreview'] = content_preview(note_data.get('content', ''))
+            if 'fingerprint' not in note_data:
+                fingerprint = note_fingerprint(note_data.get('content', ''), (note_data.get('metadata') or {}).get('url', ''))
+                if fingerprint:
+                    note_data['fingerprint'] = fingerprint
+            note_data['terms'] = note_terms(note_data.get('content', ''), (note_data.get('metadata') or {}).get('title', ''))
+            note_data.update({field: value for field, value in lookup_keys(note_data.get('metadata')).items() if value})
+            note_data.setdefault('updatedAt', datetime.now())
+            doc_ref = notes_collection.document()
+            batch = self._write_batch(user_id, 'create_note')
+            batch.set(doc_ref, note_data)
+            self._notify_note_change(batch, user_id, doc_ref.id, None, {**note_data, 'id': doc_ref.id})
+            batch.commit()
+            return doc_ref.id
         except Exception as e:
-            logger.error(f"Error creating note: {e}")
+            logger.error("Error creating note: %s", e)
             raise
     
-    async def get_user_notes(self, user_id: str, limit: int = 50, offset: int = 0) -> List[dict]:
-        """Get notes for a user with pagination"""
+    @tracing.traced("db.get_user_notes")
+    async def get_user_notes(self, user_id: str, limit: int = 50, offset: int = 0, fields: Optional[List[str]] = None,
+                             version: Optional[int] = None) -> List[dict]:
+        """Get notes for a user with pagination, optionally projected to the given fields
+        
+        When the user's data version is given, the first page is cached under it.
+        """
         try:
+            cache_key = None
+            if self.cache is not None and version is not None and offset == 0:
+                cache_key = f"{user_id}:{version}:{limit}:{','.join(fields or [])}"
+                cached = self.cache.get('notes_page', cache_key)
+                if cached is not None:
+                    return cached
+            
             notes_collection = self.db.collection('users').document(user_id).collection('notes')
-            notes_query = notes_collection.order_by('createdAt', direction=firestore.Query.DESCENDING)
+            notes_query = notes_collection.order_by('createdAt', direction=DESCENDING)
             
             if offset > 0:
                 # For pagination, we'd need to implement proper cursor-based pagination
@@ -31,23 +322,28 @@ class DatabaseService:
                 notes_query = notes_query.offset(offset)
             
             notes_query = notes_query.limit(limit)
+            if fields:
+                notes_query = notes_query.select(fields)
             
             notes = []
-            for doc in notes_query.stream():
+            for doc in self._stream(notes_query, 'get_user_notes'):
                 note_data = doc.to_dict()
                 note_data['id'] = doc.id
                 notes.append(note_data)
             
+            if cache_key is not None:
+                self.cache.set('notes_page', cache_key, notes, NOTES_CACHE_TTL)
             return notes
         except Exception as e:
-            logger.error(f"Error getting notes: {e}")
+            logger.error("Error getting notes: %s", e)
             raise
     
+    @tracing.traced("db.get_note_by_id")
     async def get_note_by_id(self, user_id: str, note_id: str) -> Optional[dict]:
         """Get a specific note by ID"""
         try:
             note_ref = self.db.collection('users').document(user_id).collection('notes').document(note_id)
-            doc = note_ref.get()
+            doc = self._get(note_ref, 'get_note_by_id')
             
             if doc.exists:
                 note_data = doc.to_dict()
@@ -55,45 +351,80 @@ class DatabaseService:
                 return note_data
             return None
         except Exception as e:
-            logger.error(f"Error getting note by ID: {e}")
+            logger.error("Error getting note by ID: %s", e)
             raise
     
+    @tracing.traced("db.update_note")
     async def update_note(self, user_id: str, note_id: str, update_data: dict) -> bool:
         """Update a note"""
         try:
             note_ref = self.db.collection('users').document(user_id).collection('notes').document(note_id)
             update_data['updatedAt'] = datetime.now()
-            note_ref.update(update_data)
+            if 'content' in update_data:
+                update_data['contentPreview'] = content_preview(update_data['content'])
+            if 'metadata' in update_data:
+                # The metadata map is replaced whole, so the keys follow from it alone
+                for field, value in lookup_keys(update_data['metadata']).items():
+                    update_data[field] = value or delete_field()
+            before = self._read_note(note_ref, 'update_note') if self._note_listeners else None
+            if before is not None and ('content' in update_data or 'metadata' in update_data):
+                merged = {**before, **update_data}
+                fingerprint = note_fingerprint(merged.get('content', ''), (merged.get('metadata') or {}).get('url', ''))
+                update_data['fingerprint'] = fingerprint or delete_field()
+                update_data['terms'] = note_terms(merged.get('content', ''), (merged.get('metadata') or {}).get('title', ''))
+            batch = self._write_batch(user_id, 'update_note')
+            batch.update(note_ref, update_data)
+            if before is not None:
+                after = {**before, **update_data}
+                for field in ('fingerprint', 'urlKey', 'domainKey'):
+                    if field in update_data and not isinstance(update_data[field], str):
+                        after.pop(field)
+                self._notify_note_change(batch, user_id, note_id, before, after)
+            batch.commit()
             return True
         except Exception as e:
-            logger.error(f"Error updating note: {e}")
+            logger.error("Error updating note: %s", e)
             raise
     
+    @tracing.traced("db.delete_note")
     async def delete_note(self, user_id: str, note_id: str) -> bool:
         """Delete a note"""
         try:
             note_ref = self.db.collection('users').document(user_id).collection('notes').document(note_id)
-            note_ref.delete()
+            batch = self._write_batch(user_id, 'delete_note')
+            batch.delete(note_ref)
+            self._write_tombstone(batch, user_id, 'note', note_id)
+            before = self._read_note(note_ref, 'delete_note') if self._note_listeners else None
+            if before is not None:
+                self._notify_note_change(batch, user_id, note_id, before, None)
+            batch.commit()
             return True
         except Exception as e:
-            logger.error(f"Error deleting note: {e}")
+            logger.error("Error deleting note: %s", e)
             raise
     
-    async def search_notes(self, user_id: str, query: str, limit: int = 20) -> List[dict]:
+    @tracing.traced("db.search_notes")
+    async def search_notes(self, user_id: str, query: str, limit: int = 20, fields: Optional[List[str]] = None) -> List[dict]:
         """Search notes by content (basic implementation)"""
         try:
             # This is a simple implementation. For full-text search, you'd want to use
             # a service like Algolia, Elasticsearch, or Firebase's text search extensions
             notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            notes_query = notes_collection
+            if fields:
+                # Content is needed for matching even when it is not returned
+                notes_query = notes_collection.select(list(dict.fromkeys(fields + ['content'])))
             
             # Get all notes and filter in memory (not efficient for large datasets)
             all_notes = []
-            for doc in notes_collection.stream():
+            for doc in self._stream(notes_query, 'search_notes'):
                 note_data = doc.to_dict()
                 note_data['id'] = doc.id
                 
                 # Simple text search in content
                 if query.lower() in note_data.get('content', '').lower():
+                    if fields and 'content' not in fields:
+                        note_data.pop('content', None)
                     all_notes.append(note_data)
                     
                 if len(all_notes) >= limit:
@@ -101,82 +432,372 @@ class DatabaseService:
             
             return all_notes
         except Exception as e:
-            logger.error(f"Error searching notes: {e}")
+            logger.error("Error searching notes: %s", e)
             raise
     
-    async def get_notes_by_category(self, user_id: str, category: str, limit: int = 50) -> List[dict]:
-        """Get notes filtered by category"""
+    @tracing.traced("db.get_notes_by_ids")
+    async def get_notes_by_ids(self, user_id: str, note_ids: List[str], fields: Optional[List[str]] = None) -> List[dict]:
+        """Fetch notes in one batched read, in the order of `note_ids`; missing notes are skipped"""
         try:
+            if not note_ids:
+                return []
             notes_collection = self.db.collection('users').document(user_id).collection('notes')
-            notes_query = notes_collection.where('categories', 'array_contains', category)\
-                                        .order_by('createdAt', direction=firestore.Query.DESCENDING)\
-                                        .limit(limit)
-            
+            references = [notes_collection.document(note_id) for note_id in note_ids]
+            found = {}
+            for doc in self._get_all(references, 'get_notes_by_ids', field_paths=fields):
+                if doc.exists:
+                    note_data = doc.to_dict()
+                    note_data['id'] = doc.id
+                    found[doc.id] = note_data
+            return [found[note_id] for note_id in note_ids if note_id in found]
+        except Exception as e:
+            logger.error("Error getting notes by ids: %s", e)
+            raise
+    
+    @tracing.traced("db.get_notes_by_category")
+    async def get_notes_by_category(self, user_id: str, category: str, limit: int = 50, fields: Optional[List[str]] = None) -> List[dict]:
+        """Get notes filtered by category, optionally projected to the given fields"""
+        try:
+            # Served from the category index; no composite index on categories + createdAt needed
+            result = await self.category_index.query(user_id, all_of=[category], limit=limit)
+            return await self.get_notes_by_ids(user_id, result['note_ids'], fields)
+        except IndexNotReady:
+            raise
+        except Exception as e:
+            logger.error("Error getting notes by category: %s", e)
+            raise
+    
+    @tracing.traced("db.query_notes_by_categories")
+    async def query_notes_by_categories(self, user_id: str, all_of: List[str] = (), any_of: List[str] = (),
+                                        none_of: List[str] = (), limit: int = 50, cursor: Optional[str] = None,
+                                        fields: Optional[List[str]] = None) -> dict:
+        """Notes matching a boolean category filter, newest first, with a page cursor and total count"""
+        try:
+            result = await self.category_index.query(user_id, all_of, any_of, none_of, limit, cursor)
+            notes = await self.get_notes_by_ids(user_id, result['note_ids'], fields)
+            return {'notes': notes, 'total': result['total'], 'next': result['next']}
+        except (ValueError, IndexNotReady):
+            raise
+        except Exception as e:
+            logger.error("Error querying notes by categories: %s", e)
+            raise
+
+    @tracing.traced("db.query_notes")
+    async def query_notes(self, user_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                          domain: Optional[str] = None, url: Optional[str] = None, limit: int = 50,
+                          cursor: Optional[str] = None, fields: Optional[List[str]] = None) -> dict:
+        """Notes created in [since, until), optionally from one domain or canonical URL, newest first
+
+        Domain and URL match the urlKey and domainKey stored at write time, each
+        backed by a composite index with createdAt (firestore.indexes.json).
+        The cursor holds the last createdAt returned and the ids returned at
+        that time, so pages split cleanly between notes created together.
+        """
+        try:
+            if domain and url:
+                raise ValueError("Filter by domain or by url, not both")
+            query = self.db.collection('users').document(user_id).collection('notes')
+            if url:
+                key = url_key(url)
+                if key is None:
+                    raise ValueError("Invalid url")
+                query = query.where('urlKey', '==', key)
+            elif domain:
+                key = domain_key(domain)
+                if key is None:
+                    raise ValueError("Invalid domain")
+                query = query.where('domainKey', '==', key)
+
+            seen_ids = []
+            if cursor:
+                cursor_time, seen_ids = decode_cursor(cursor)
+                if until is None or cursor_time < utc(until):
+                    # Notes at exactly the cursor time may remain; they are re-read and skipped
+                    query = query.where('createdAt', '<=', cursor_time)
+                    until = None
+            if since is not None:
+                query = query.where('createdAt', '>=', since)
+            if until is not None:
+                query = query.where('createdAt', '<', until)
+            query = query.order_by('createdAt', direction=DESCENDING).limit(limit + len(seen_ids) + 1)
+            if fields:
+                query = query.select(list(dict.fromkeys(fields + ['createdAt'])))
+
+            seen = set(seen_ids)
             notes = []
-            for doc in notes_query.stream():
+            has_more = False
+            for doc in self._stream(query, 'query_notes'):
+                if doc.id in seen:
+                    continue
+                if len(notes) == limit:
+                    has_more = True
+                    break
                 note_data = doc.to_dict()
                 note_data['id'] = doc.id
                 notes.append(note_data)
-            
-            return notes
+
+            next_cursor = None
+            if has_more:
+                last = utc(notes[-1]['createdAt'])
+                ids = [note['id'] for note in notes if utc(note['createdAt']) == last]
+                if cursor and last == cursor_time:
+                    ids = seen_ids + ids
+                next_cursor = encode_cursor(last, ids)
+            if fields and 'createdAt' not in fields:
+                for note in notes:
+                    note.pop('createdAt', None)
+            return {'notes': notes, 'next': next_cursor}
+        except ValueError:
+            raise
         except Exception as e:
-            logger.error(f"Error getting notes by category: {e}")
+            logger.error("Error querying notes: %s", e)
             raise
-    
+
+    @tracing.traced("db.get_user_categories")
     async def get_user_categories(self, user_id: str) -> List[dict]:
         """Get all categories for a user"""
         try:
+            if self.cache is not None:
+                cached = self.cache.get('categories', user_id)
+                if cached is not None:
+                    return cached
+
             categories_collection = self.db.collection('users').document(user_id).collection('categories')
             
             categories = []
-            for doc in categories_collection.stream():
+            for doc in self._stream(categories_collection, 'get_user_categories'):
                 category_data = doc.to_dict()
                 category_data['id'] = doc.id
                 categories.append(category_data)
             
+            if self.cache is not None:
+                self.cache.set('categories', user_id, categories, CATEGORY_CACHE_TTL)
             return categories
         except Exception as e:
-            logger.error(f"Error getting categories: {e}")
+            logger.error("Error getting categories: %s", e)
             raise
     
+    @tracing.traced("db.create_category")
     async def create_category(self, user_id: str, category_data: dict) -> str:
         """Create a new category for a user"""
         try:
             category_data['createdAt'] = datetime.now()
             category_data['updatedAt'] = datetime.now()
             categories_collection = self.db.collection('users').document(user_id).collection('categories')
-            doc_ref = categories_collection.add(category_data)
-            return doc_ref[1].id
+            doc_ref = categories_collection.document()
+            batch = self._write_batch(user_id, 'create_category')
+            batch.set(doc_ref, category_data)
+            batch.commit()
+            self._invalidate_categories(user_id)
+            return doc_ref.id
         except Exception as e:
-            logger.error(f"Error creating category: {e}")
+            logger.error("Error creating category: %s", e)
             raise
     
+    @tracing.traced("db.update_category")
     async def update_category(self, user_id: str, category_id: str, update_data: dict) -> bool:
         """Update a category"""
         try:
             category_ref = self.db.collection('users').document(user_id).collection('categories').document(category_id)
             update_data['updatedAt'] = datetime.now()
-            category_ref.update(update_data)
+            batch = self._write_batch(user_id, 'update_category')
+            batch.update(category_ref, update_data)
+            batch.commit()
+            self._invalidate_categories(user_id)
             return True
         except Exception as e:
-            logger.error(f"Error updating category: {e}")
+            logger.error("Error updating category: %s", e)
             raise
     
+    @tracing.traced("db.delete_category")
     async def delete_category(self, user_id: str, category_id: str) -> bool:
         """Delete a category"""
         try:
             category_ref = self.db.collection('users').document(user_id).collection('categories').document(category_id)
-            category_ref.delete()
+            batch = self._write_batch(user_id, 'delete_category')
+            batch.delete(category_ref)
+            self._write_tombstone(batch, user_id, 'category', category_id)
+            batch.commit()
+            self._invalidate_categories(user_id)
             return True
         except Exception as e:
-            logger.error(f"Error deleting category: {e}")
+            logger.error("Error deleting category: %s", e)
+            raise
+    
+    @tracing.traced("db.rewrite_note_categories")
+    def rewrite_note_categories(self, user_id: str, notes: List[dict], sources: List[str], target: Optional[str]) -> int:
+        """Replace the `sources` categories of notes with `target` (or drop them if None)
+
+        Notes need at least `categories` and `createdAt`. All rewrites commit in
+        one batch; returns the number of notes changed. Blocking, so bulk jobs
+        can run several batches on worker threads.
+        """
+        try:
+            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            batch = self._write_batch(user_id, 'rewrite_note_categories')
+            changed = 0
+            now = datetime.now()
+            for note in notes:
+                categories = note.get('categories') or []
+                rewritten = rewrite_categories(categories, sources, target)
+                if rewritten == categories:
+                    continue
+                update_data = {'categories': rewritten, 'updatedAt': now}
+                batch.update(notes_collection.document(note['id']), update_data)
+                self._notify_note_change(batch, user_id, note['id'], note, {**note, **update_data})
+                changed += 1
+            if changed:
+                batch.commit()
+            return changed
+        except Exception as e:
+            logger.error("Error rewriting note categories: %s", e)
+            raise
+
+    def set_note_categories(self, user_id: str, notes: List[dict], categories: Dict[str, List[str]]) -> int:
+        """Replace the categories of notes, given as {note id: categories}
+
+        Notes need at least `categories` and `createdAt`. Changes commit in as
+        few batches as the write limit allows; returns the number of notes
+        changed. Blocking, like rewrite_note_categories.
+        """
+        try:
+            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            batch = self._write_batch(user_id, 'set_note_categories')
+            pending = 0
+            changed = 0
+            now = datetime.now()
+            for note in notes:
+                old_categories = note.get('categories') or []
+                new_categories = categories.get(note['id'])
+                if new_categories is None or new_categories == old_categories:
+                    continue
+                update_data = {'categories': new_categories, 'updatedAt': now}
+                writes = 1 + self._listener_writes(note, {**note, **update_data})
+                if pending and batch.writes + batch.deletes + writes > BATCH_LIMIT:
+                    batch.commit()
+                    batch = self._write_batch(user_id, 'set_note_categories')
+                    pending = 0
+                batch.update(notes_collection.document(note['id']), update_data)
+                self._notify_note_change(batch, user_id, note['id'], note, {**note, **update_data})
+                pending += 1
+                changed += 1
+            if pending:
+                batch.commit()
+            return changed
+        except Exception as e:
+            logger.error("Error setting note categories: %s", e)
+            raise
+
+    @tracing.traced("db.set_note_fingerprints")
+    async def set_note_fingerprints(self, user_id: str, fingerprints: Dict[str, Optional[str]]):
+        """Store recomputed fingerprints on notes; the duplicate index is not updated"""
+        try:
+            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            items = list(fingerprints.items())
+            for start in range(0, len(items), BATCH_LIMIT - 1):
+                batch = self._write_batch(user_id, 'set_note_fingerprints')
+                for note_id, fingerprint in items[start:start + BATCH_LIMIT - 1]:
+                    batch.update(notes_collection.document(note_id), {'fingerprint': fingerprint or delete_field()})
+                batch.commit()
+        except Exception as e:
+            logger.error("Error setting note fingerprints: %s", e)
             raise
     
+    @tracing.traced("db.set_note_terms")
+    async def set_note_terms(self, user_id: str, terms: Dict[str, List[str]]):
+        """Store recomputed terms on notes; neighbor lists are not updated"""
+        try:
+            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            items = list(terms.items())
+            for start in range(0, len(items), BATCH_LIMIT - 1):
+                batch = self._write_batch(user_id, 'set_note_terms')
+                for note_id, words in items[start:start + BATCH_LIMIT - 1]:
+                    batch.update(notes_collection.document(note_id), {'terms': words})
+                batch.commit()
+        except Exception as e:
+            logger.error("Error setting note terms: %s", e)
+            raise
+    
+    @tracing.traced("db.link_duplicate_notes")
+    async def link_duplicate_notes(self, user_id: str, links: Dict[str, str]):
+        """Mark notes as duplicates of others, given as {duplicate id: original id}"""
+        try:
+            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            items = list(links.items())
+            now = datetime.now()
+            for start in range(0, len(items), BATCH_LIMIT - 1):
+                batch = self._write_batch(user_id, 'link_duplicate_notes')
+                for note_id, original_id in items[start:start + BATCH_LIMIT - 1]:
+                    batch.update(notes_collection.document(note_id), {'duplicateOf': original_id, 'updatedAt': now})
+                batch.commit()
+        except Exception as e:
+            logger.error("Error linking duplicate notes: %s", e)
+            raise
+    
+    @tracing.traced("db.merge_duplicate_notes")
+    async def merge_duplicate_notes(self, user_id: str, original: dict, duplicates: List[dict]):
+        """Add the categories of duplicates to the original note and delete them
+        
+        Notes need at least `categories`, `createdAt` and `fingerprint`.
+        """
+        try:
+            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            categories = list(dict.fromkeys(
+                category for note in [original] + duplicates for category in (note.get('categories') or [])
+            ))
+            batch = self._write_batch(user_id, 'merge_duplicate_notes')
+            pending = 0
+
+            def reserve(writes: int):
+                """Commit and start a new batch if `writes` more would pass the limit"""
+                nonlocal batch, pending
+                if pending and batch.writes + batch.deletes + writes > BATCH_LIMIT:
+                    batch.commit()
+                    batch = self._write_batch(user_id, 'merge_duplicate_notes')
+                    pending = 0
+                pending += 1
+
+            if categories != (original.get('categories') or []):
+                update_data = {'categories': categories, 'updatedAt': datetime.now()}
+                after = {**original, **update_data}
+                reserve(1 + self._listener_writes(original, after))
+                batch.update(notes_collection.document(original['id']), update_data)
+                self._notify_note_change(batch, user_id, original['id'], original, after)
+            for note in duplicates:
+                # The deletion, its tombstone and the index entries it drops
+                reserve(2 + self._listener_writes(note, None))
+                batch.delete(notes_collection.document(note['id']))
+                self._write_tombstone(batch, user_id, 'note', note['id'])
+                self._notify_note_change(batch, user_id, note['id'], note, None)
+            if pending:
+                batch.commit()
+        except Exception as e:
+            logger.error("Error merging duplicate notes: %s", e)
+            raise
+    
+    def _invalidate_categories(self, user_id: str):
+        if self.cache is not None:
+            self.cache.delete('categories', user_id)
+    
+    @tracing.traced("db.category_name_exists")
+    async def category_name_exists(self, user_id: str, name: str, exclude_id: Optional[str] = None) -> bool:
+        """Check whether a category name is already used by a user (case-insensitive)"""
+        try:
+            wanted = name.lower()
+            for existing in await self.get_user_categories(user_id):
+                if existing["id"] != exclude_id and existing["category"].lower() == wanted:
+                    return True
+            return False
+        except Exception as e:
+            logger.error("Error checking category name: %s", e)
+            raise
+    
+    @tracing.traced("db.get_category_by_id")
     async def get_category_by_id(self, user_id: str, category_id: str) -> Optional[dict]:
         """Get a specific category by ID"""
         try:
             category_ref = self.db.collection('users').document(user_id).collection('categories').document(category_id)
-            doc = category_ref.get()
+            doc = self._get(category_ref, 'get_category_by_id')
             
             if doc.exists:
                 category_data = doc.to_dict()
@@ -184,28 +805,21 @@ class DatabaseService:
                 return category_data
             return None
         except Exception as e:
-            logger.error(f"Error getting category by ID: {e}")
+            logger.error("Error getting category by ID: %s", e)
             raise
     
-    async def get_notes_statistics(self, user_id: str) -> dict:
-        """Get statistics about user's notes"""
+    @tracing.traced("db.get_notes_statistics")
+    async def get_notes_statistics(self, user_id: str, version: Optional[int] = None) -> dict:
+        """Get statistics about user's notes; cached under the data version when it is given"""
         try:
-            notes_collection = self.db.collection('users').document(user_id).collection('notes')
+            if self.cache is not None and version is not None:
+                cached = self.cache.get('statistics', f"{user_id}:{version}")
+                if cached is not None:
+                    return cached
             
-            # Count total notes
-            total_notes = 0
-            category_counts = {}
-            
-            for doc in notes_collection.stream():
-                note_data = doc.to_dict()
-                total_notes += 1
-                
-                # Count categories
-                categories = note_data.get('categories', [])
-                for category in categories:
-                    category_counts[category] = category_counts.get(category, 0) + 1
-            
-            return {
+            # Maintained by the category index with every note write; no note is read
+            category_counts, total_notes = await self.category_index.summary(user_id)
+            stats = {
                 'total_notes': total_notes,
                 'category_distribution': category_counts,
                 'most_used_categories': sorted(
@@ -214,6 +828,37 @@ class DatabaseService:
                     reverse=True
                 )[:5]
             }
+            if self.cache is not None and version is not None:
+                self.cache.set('statistics', f"{user_id}:{version}", stats, NOTES_CACHE_TTL)
+            return stats
+        except IndexNotReady:
+            raise
+        except Exception as e:
+            logger.error("Error getting statistics: %s", e)
+            raise
+    
+    @tracing.traced("db.prefetch_user_data")
+    async def prefetch_user_data(self, user_id: str):
+        """Load a user's categories, first page of notes and statistics into the cache
+        
+        Called after login, so the requests a client makes next, and the
+        categories read by its first note save, find them cached.
+        """
+        if self.cache is None:
+            return
+        try:
+            start = time.perf_counter()
+            version = await self.get_data_version(user_id)
+            await self.get_user_categories(user_id)
+            await self.get_user_notes(user_id, PREFETCH_NOTES_LIMIT, version=version)
+            try:
+                await self.get_notes_statistics(user_id, version)
+            except IndexNotReady:
+                # Reading them started the index rebuild; the first request after it caches them
+                pass
+            logger.info("Prefetched user data", extra={
+                "user_id": user_id, "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+            })
         except Exception as e:
-            logger.error(f"Error getting statistics: {e}")
+            logger.error("Error prefetching user data: %s", e)
             raise
\ No newline at end of file
@@ -0,0 +1,252 @@
+import hashlib
+import logging
+import os
+import random
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+from ..core import tracing
+from .common import BATCH_LIMIT, delete_field
+from .lookup import canonical_url
+
+logger = logging.getLogger(__name__)
+
+INDEX_COLLECTION = 'dedup_index'
+
+DEDUP_JOB = 'dedup_notes'
+
+# What to do with a note that nearly duplicates an existing one:
+#   off   - save it as usual
+#   link  - save it with the existing note's categories (no LLM call) and a duplicateOf link
+#   merge - don't save it; the existing note stands in for it
+POLICIES = ('off', 'link', 'merge')
+# Off by default, so POST /notes keeps saving every note as before unless enabled
+DEDUP_POLICY = os.getenv('DEDUP_POLICY', 'off')
+
+# Notes at least this similar (estimated Jaccard similarity of their shingles) are duplicates
+SIMILARITY_THRESHOLD = float(os.getenv('DEDUP_SIMILARITY', '0.8'))
+
+# MinHash signature of NUM_HASHES values, split into BANDS bands of ROWS rows.
+# A pair becomes a candidate when a whole band matches: likely (>98%) at
+# similarity 0.8, unlikely (<7%) at 0.3.
+NUM_HASHES = 32
+BANDS = 8
+ROWS = NUM_HASHES // BANDS
+
+# Notes this short have too few shingles for a stable signature
+MIN_CHARS = 20
+
+# Shorter texts are shingled by characters, longer ones by words
+SHORT_TEXT_CHARS = 500
+
+_MASK = (1 << 64) - 1
+_rng = random.Random(0x6b676e6f7465)
+# Fixed seeds: signatures are stored, so they must not change between runs
+_PERMUTATIONS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(NUM_HASHES)]
+
+_WORD = re.compile(r'\w+')
+
+def normalize_text(text: str) -> str:
+    return ' '.join(_WORD.findall(text.lower()))
+
+def shingles(text: str) -> Set[str]:
+    if len(text) < SHORT_TEXT_CHARS:
+        return {text[i:i + 5] for i in range(max(1, len(text) - 4))}
+    words = text.split()
+    return {' '.join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+def minhash(features: Iterable[str]) -> List[int]:
+    """MinHash signature: the minimum of each of NUM_HASHES hash functions over the features"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for feature in features
+    ]
+    return [min(((a * value + b) & _MASK) >> 32 for value in hashes) for a, b in _PERMUTATIONS]
+
+def note_fingerprint(content: str, url: str = '') -> Optional[str]:
+    """Fingerprint stored with a note: MinHash of its content and a key of its URL
+
+    None for notes too short to fingerprint reliably.
+    """
+    text = normalize_text(content or '')
+    if len(text) < MIN_CHARS:
+        return None
+    canonical = canonical_url(url)
+    url_hash = hashlib.blake2b(canonical.encode('utf-8'), digest_size=4).hexdigest() if canonical else ''
+    return ''.join(f"{value:08x}" for value in minhash(shingles(text))) + ':' + url_hash
+
+def _parse(fingerprint: str):
+    signature, _, url_hash = fingerprint.partition(':')
+    return [signature[i:i + 8] for i in range(0, len(signature), 8)], url_hash
+
+def similarity(a: str, b: str) -> float:
+    """Estimated similarity of two fingerprinted notes; 0 if their URLs differ"""
+    signature_a, url_a = _parse(a)
+    signature_b, url_b = _parse(b)
+    if url_a != url_b or len(signature_a) != len(signature_b):
+        return 0.0
+    return sum(x == y for x, y in zip(signature_a, signature_b)) / len(signature_a)
+
+def _bands(fingerprint: str) -> List[str]:
+    signature = fingerprint.partition(':')[0]
+    width = ROWS * 8
+    return [
+        f"{band}-{hashlib.blake2b(signature[band * width:(band + 1) * width].encode(), digest_size=8).hexdigest()}"
+        for band in range(BANDS)
+    ]
+
+class DuplicateIndex:
+    """Locality-sensitive index of note fingerprints, maintained on every note write
+
+    Each band value is a document under users/{uid}/dedup_index mapping note
+    ids to fingerprints, so finding the candidates for a new note takes BANDS
+    document reads (one round trip) however many notes the user has.
+    """
+
+    def __init__(self, db_service):
+        self.db_service = db_service
+
+    @property
+    def db(self):
+        return self.db_service.db
+
+    def _index(self, user_id: str):
+        return self.db.collection('users').document(user_id).collection(INDEX_COLLECTION)
+
+    def on_note_change(self, batch, user_id: str, note_id: str, before: Optional[dict], after: Optional[dict]):
+        """Note listener moving a note between bands when its fingerprint changes"""
+        old = before.get('fingerprint') if before else None
+        new = after.get('fingerprint') if after else None
+        if old == new:
+            return
+        if old:
+            for band in _bands(old):
+                batch.set(self._index(user_id).document(band), {'members': {note_id: delete_field()}}, merge=True)
+        if new:
+            for band in _bands(new):
+                batch.set(self._index(user_id).document(band), {'members': {note_id: new}}, merge=True)
+
+    def change_writes(self, before: Optional[dict], after: Optional[dict]) -> int:
+        """Number of writes on_note_change adds to a batch for a note write"""
+        old = before.get('fingerprint') if before else None
+        new = after.get('fingerprint') if after else None
+        if old == new:
+            return 0
+        return BANDS * (bool(old) + bool(new))
+
+    @tracing.traced("db.dedup.find")
+    async def find(self, user_id: str, fingerprint: Optional[str], exclude_id: Optional[str] = None) -> Optional[str]:
+        """Id of the closest existing note duplicating a fingerprint, if any"""
+        if not fingerprint:
+            return None
+        references = [self._index(user_id).document(band) for band in _bands(fingerprint)]
+        best_id, best_similarity = None, SIMILARITY_THRESHOLD
+        for doc in self.db_service._get_all(references, 'dedup.find'):
+            for note_id, other in ((doc.to_dict() or {}).get('members') or {}).items():
+                if note_id == exclude_id:
+                    continue
+                score = similarity(fingerprint, other)
+                if score >= best_similarity:
+                    best_id, best_similarity = note_id, score
+        return best_id
+
+    @tracing.traced("db.dedup.rebuild")
+    async def rebuild(self, user_id: str, notes: List[dict]):
+        """Replace a user's index with the fingerprints of `notes`"""
+        bands: Dict[str, dict] = {}
+        for note in notes:
+            if note.get('fingerprint'):
+                for band in _bands(note['fingerprint']):
+                    bands.setdefault(band, {})[note['id']] = note['fingerprint']
+
+        stale = [doc.reference for doc in self.db_service._stream(self._index(user_id).select([]), 'dedup.rebuild')]
+        writes = [lambda b, ref=ref: b.delete(ref) for ref in stale if ref.id not in bands]
+        writes += [
+            lambda b, ref=self._index(user_id).document(band), members=members: b.set(ref, {'members': members})
+            for band, members in bands.items()
+        ]
+        for start in range(0, len(writes), BATCH_LIMIT):
+            batch = self.db_service._batch('dedup.rebuild')
+            for write in writes[start:start + BATCH_LIMIT]:
+                write(batch)
+            batch.commit()
+
+def find_clusters(notes: List[dict]) -> List[List[dict]]:
+    """Groups of near-duplicate notes, each sorted oldest first"""
+    parent = list(range(len(notes)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets: Dict[str, List[int]] = {}
+    for i, note in enumerate(notes):
+        if note.get('fingerprint'):
+            for band in _bands(note['fingerprint']):
+                buckets.setdefault(band, []).append(i)
+    for members in buckets.values():
+        for n, i in enumerate(members):
+            for j in members[n + 1:]:
+                if root(i) != root(j) and similarity(notes[i]['fingerprint'], notes[j]['fingerprint']) >= SIMILARITY_THRESHOLD:
+                    parent[root(j)] = root(i)
+
+    clusters: Dict[int, List[dict]] = {}
+    for i, note in enumerate(notes):
+        clusters.setdefault(root(i), []).append(note)
+    return [
+        sorted(cluster, key=lambda note: (str(note.get('createdAt') or ''), note['id']))
+        for cluster in clusters.values() if len(cluster) > 1
+    ]
+
+async def dedup_notes(job):
+    """Offline pass: fingerprint every note, rebuild the index and resolve duplicates
+
+    With the `link` policy later copies get a duplicateOf link to the oldest;
+    with `merge` their categories are added to the oldest and they are
+    deleted. Re-running it is harmless.
+    """
+    db_service = job.db_service
+    policy = job.params.get('policy', 'link')
+    notes_collection = db_service.db.collection('users').document(job.user_id).collection('notes')
+    query = notes_collection.select(['content', 'metadata.url', 'fingerprint', 'duplicateOf', 'categories', 'createdAt'])
+
+    notes, backfill = [], {}
+    for doc in db_service._stream(query, 'dedup.scan'):
+        data = doc.to_dict() or {}
+        fingerprint = note_fingerprint(data.get('content', ''), (data.get('metadata') or {}).get('url', ''))
+        if fingerprint != data.get('fingerprint'):
+            backfill[doc.id] = fingerprint
+        notes.append({
+            'id': doc.id,
+            'fingerprint': fingerprint,
+            'duplicateOf': data.get('duplicateOf'),
+            'categories': data.get('categories') or [],
+            'createdAt': data.get('createdAt'),
+        })
+    job.progress(total=len(notes))
+
+    await db_service.set_note_fingerprints(job.user_id, backfill)
+    await db_service.duplicates.rebuild(job.user_id, notes)
+    job.progress(processed=len(notes) // 2)
+
+    clusters = find_clusters(notes)
+    duplicates = 0
+    for cluster in clusters:
+        original, copies = cluster[0], cluster[1:]
+        duplicates += len(copies)
+        if policy == 'merge':
+            await db_service.merge_duplicate_notes(job.user_id, original, copies)
+    if policy == 'link':
+        await db_service.link_duplicate_notes(job.user_id, {
+            copy['id']: cluster[0]['id'] for cluster in clusters for copy in cluster[1:]
+            if copy.get('duplicateOf') != cluster[0]['id']
+        })
+
+    job.result = {'clusters': len(clusters), 'duplicates': duplicates, 'fingerprinted': len(backfill)}
+    job.progress(processed=len(notes))
+    logger.info("Deduplicated notes", extra={"user_id": job.user_id, "policy": policy, **job.result})
+
+def register_dedup_jobs(manager):
+    manager.register(DEDUP_JOB, dedup_notes)
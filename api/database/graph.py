@@ -0,0 +1,327 @@
+import asyncio
+import logging
+import os
+import time
+from array import array
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from ..core import tracing
+from ..core.cache import MemoryBackend
+from .lookup import domain_key
+
+logger = logging.getLogger(__name__)
+
+NODE_TYPES = ('note', 'category', 'domain')
+
+# Users whose graphs are kept in memory per worker, least recently used evicted
+GRAPH_CACHE_USERS = int(os.getenv('GRAPH_CACHE_USERS', '32'))
+
+# A cached graph is dropped after this long even if the user's data is unchanged
+GRAPH_CACHE_TTL = 3600
+
+# A cached graph is served for this long after it was built even if the user's
+# data has changed since, so a busy account is rescanned at most this often
+GRAPH_MAX_STALENESS = float(os.getenv('GRAPH_MAX_STALENESS', '60'))
+
+# Most nodes a neighborhood returns
+MAX_NEIGHBORHOOD_NODES = 2000
+
+def parse_node(value: str) -> Tuple[str, str]:
+    """Split a node reference such as `category:Machine Learning` into type and name"""
+    node_type, _, name = (value or '').partition(':')
+    if node_type not in NODE_TYPES or not name:
+        raise ValueError(f"Node must look like category:<name>, domain:<name> or note:<id>, got {value!r}")
+    return node_type, (domain_key(name) or name) if node_type == 'domain' else name
+
+class CSRGraph:
+    """Undirected graph linking notes to their categories and domains
+
+    Nodes are numbered notes first, then categories, then domains, so a node's
+    type follows from its number. The neighbors of node i are
+    targets[offsets[i]:offsets[i + 1]], held in compact integer arrays.
+    """
+
+    def __init__(self, notes: List[Tuple[str, List[str], str]], version: int = 0):
+        """Build from (note id, categories, domain) tuples"""
+        self.version = version
+        self.built_at = time.time()
+        self.names: List[str] = []
+        self.index: Dict[Tuple[str, str], int] = {}
+
+        for note_id, _, _ in notes:
+            self._add_node('note', note_id)
+        self.first_category = len(self.names)
+        for _, categories, _ in notes:
+            for category in categories:
+                self._add_node('category', category)
+        self.first_domain = len(self.names)
+        for _, _, domain in notes:
+            if domain:
+                self._add_node('domain', domain)
+
+        adjacency: List[List[int]] = [[] for _ in self.names]
+        for i, (_, categories, domain) in enumerate(notes):
+            for j in {self.index[('category', category)] for category in categories}:
+                adjacency[i].append(j)
+                adjacency[j].append(i)
+            if domain:
+                j = self.index[('domain', domain)]
+                adjacency[i].append(j)
+                adjacency[j].append(i)
+
+        self.offsets = array('l', [0])
+        self.targets = array('l')
+        for neighbors in adjacency:
+            self.targets.extend(neighbors)
+            self.offsets.append(len(self.targets))
+
+    def _add_node(self, node_type: str, name: str):
+        if (node_type, name) not in self.index:
+            self.index[(node_type, name)] = len(self.names)
+            self.names.append(name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.targets) // 2
+
+    def node_type(self, i: int) -> str:
+        if i < self.first_category:
+            return 'note'
+        return 'category' if i < self.first_domain else 'domain'
+
+    def neighbors(self, i: int):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def degree(self, i: int) -> int:
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def ref(self, i: int) -> str:
+        return f"{self.node_type(i)}:{self.names[i]}"
+
+    def node(self, i: int) -> dict:
+        return {'type': self.node_type(i), 'id': self.names[i], 'degree': self.degree(i)}
+
+    def lookup(self, node_type: str, name: str) -> Optional[int]:
+        return self.index.get((node_type, name))
+
+    def bfs(self, start: int, max_depth: int, include_notes: bool = True, limit: Optional[int] = None) -> Dict[int, int]:
+        """Distance in edges of every node within max_depth of start
+
+        Notes are always traversed; with include_notes=False they do not
+        count toward the limit. Stops once `limit` nodes have been found.
+        """
+        distances = {start: 0}
+        found = 1
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            depth = distances[i]
+            if depth == max_depth:
+                continue
+            for j in self.neighbors(i):
+                if j in distances:
+                    continue
+                distances[j] = depth + 1
+                queue.append(j)
+                if include_notes or j >= self.first_category:
+                    found += 1
+                    if limit is not None and found >= limit:
+                        return distances
+        return distances
+
+    def shortest_path(self, source: int, target: int, max_depth: int) -> Optional[List[int]]:
+        """Nodes of a shortest path from source to target, searching from both ends"""
+        if source == target:
+            return [source]
+        parents = [{source: None}, {target: None}]
+        frontiers = [[source], [target]]
+        depth = 0
+        while frontiers[0] and frontiers[1] and depth < max_depth:
+            # Expand the smaller frontier
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other = parents[side], parents[1 - side]
+            next_frontier = []
+            for i in frontiers[side]:
+                for j in self.neighbors(i):
+                    if j in seen:
+                        continue
+                    seen[j] = i
+                    if j in other:
+                        return self._join(parents, j)
+                    next_frontier.append(j)
+            frontiers[side] = next_frontier
+            depth += 1
+        return None
+
+    @staticmethod
+    def _join(parents: List[dict], meeting: int) -> List[int]:
+        path = []
+        node = meeting
+        while node is not None:
+            path.append(node)
+            node = parents[0][node]
+        path.reverse()
+        node = parents[1][meeting]
+        while node is not None:
+            path.append(node)
+            node = parents[1][node]
+        return path
+
+    def components(self) -> List[List[int]]:
+        """Connected components, largest first"""
+        component = array('l', [-1]) * len(self)
+        groups = []
+        for start in range(len(self)):
+            if component[start] != -1:
+                continue
+            members = [start]
+            component[start] = len(groups)
+            for i in members:
+                for j in self.neighbors(i):
+                    if component[j] == -1:
+                        component[j] = len(groups)
+                        members.append(j)
+            groups.append(members)
+        groups.sort(key=len, reverse=True)
+        return groups
+
+class KnowledgeGraph:
+    """Graph queries over a user's notes, categories and domains
+
+    Each worker builds a user's graph from one projected scan of their notes
+    the first time it is queried and keeps it in memory. The user's data
+    version is checked on every query (one read); a graph older than
+    GRAPH_MAX_STALENESS seconds is rebuilt when it has changed, so results may
+    trail note writes by up to that long. Builds run on a worker thread.
+    """
+
+    def __init__(self, db_service):
+        self.db_service = db_service
+        self._graphs = MemoryBackend(max_entries=GRAPH_CACHE_USERS)
+        self._builds: Dict[str, asyncio.Future] = {}
+
+    @property
+    def db(self):
+        return self.db_service.db
+
+    @tracing.traced("db.graph.load")
+    async def load(self, user_id: str) -> CSRGraph:
+        version = await self.db_service.get_data_version(user_id)
+        graph = self._graphs.get(user_id)
+        if isinstance(graph, CSRGraph) and (
+                graph.version == version or time.time() - graph.built_at < GRAPH_MAX_STALENESS):
+            return graph
+
+        # Requests arriving while a build runs wait for it rather than scan again
+        build = self._builds.get(user_id)
+        if build is None:
+            build = asyncio.ensure_future(asyncio.to_thread(self._build, user_id, version))
+            self._builds[user_id] = build
+            build.add_done_callback(lambda _: self._builds.pop(user_id, None))
+        graph = await asyncio.shield(build)
+        self._graphs.set(user_id, graph, GRAPH_CACHE_TTL)
+        return graph
+
+    def _build(self, user_id: str, version: int) -> CSRGraph:
+        """Scan a user's notes and build their graph; blocking"""
+        start = time.perf_counter()
+        notes_collection = self.db.collection('users').document(user_id).collection('notes')
+        notes = []
+        query = notes_collection.select(['categories', 'metadata.domain', 'metadata.url'])
+        for doc in self.db_service._stream(query, 'graph.load'):
+            data = doc.to_dict() or {}
+            metadata = data.get('metadata') or {}
+            domain = domain_key(metadata.get('domain') or '', metadata.get('url') or '') or ''
+            notes.append((doc.id, list(data.get('categories') or []), domain))
+        graph = CSRGraph(notes, version)
+        logger.info("Built knowledge graph", extra={
+            "user_id": user_id, "nodes": len(graph), "edges": graph.edge_count,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+        })
+        return graph
+
+    def _resolve(self, graph: CSRGraph, node: str) -> int:
+        node_type, name = parse_node(node)
+        i = graph.lookup(node_type, name)
+        if i is None:
+            raise KeyError(node)
+        return i
+
+    async def neighborhood(self, user_id: str, node: str, depth: int = 2, include_notes: bool = False,
+                           limit: int = 200) -> dict:
+        """Nodes within `depth` edges of a node, nearest first, and the edges between them
+
+        Notes sit between categories and domains, so two categories sharing a
+        note are two edges apart. Without notes, categories and domains are
+        linked directly, weighted by the number of notes they share within
+        the neighborhood. Raises KeyError if the node does not exist.
+        """
+        graph = await self.load(user_id)
+        start = self._resolve(graph, node)
+        limit = min(limit, MAX_NEIGHBORHOOD_NODES)
+        distances = graph.bfs(start, depth, include_notes, limit)
+        selected = [i for i in distances if include_notes or i >= graph.first_category or i == start]
+        truncated = len(selected) >= limit
+        selected = sorted(selected, key=lambda i: (distances[i], -graph.degree(i)))[:limit]
+
+        chosen = set(selected)
+        if include_notes:
+            edges = [
+                {'from': graph.ref(i), 'to': graph.ref(j), 'weight': 1}
+                for i in selected for j in graph.neighbors(i) if j in chosen and i < j
+            ]
+        else:
+            shared: Dict[Tuple[int, int], int] = {}
+            for note in (i for i in distances if i < graph.first_category):
+                linked = sorted(j for j in graph.neighbors(note) if j in chosen)
+                for a in range(len(linked)):
+                    for b in range(a + 1, len(linked)):
+                        pair = (linked[a], linked[b])
+                        shared[pair] = shared.get(pair, 0) + 1
+            edges = [{'from': graph.ref(i), 'to': graph.ref(j), 'weight': weight} for (i, j), weight in shared.items()]
+        nodes = []
+        for i in selected:
+            entry = graph.node(i)
+            entry['distance'] = distances[i]
+            nodes.append(entry)
+        return {'nodes': nodes, 'edges': edges, 'truncated': truncated}
+
+    async def path(self, user_id: str, source: str, target: str, max_depth: int = 12) -> Optional[List[dict]]:
+        """Nodes on a shortest path between two nodes, or None if they are not connected"""
+        graph = await self.load(user_id)
+        path = graph.shortest_path(self._resolve(graph, source), self._resolve(graph, target), max_depth)
+        return [graph.node(i) for i in path] if path is not None else None
+
+    async def components(self, user_id: str, limit: int = 20, top: int = 10) -> dict:
+        """Clusters of notes connected through shared categories or domains, largest first"""
+        graph = await self.load(user_id)
+        clusters = []
+        total = isolated = 0
+        for members in graph.components():
+            if len(members) == 1 and members[0] < graph.first_category:
+                isolated += 1
+                continue
+            total += 1
+            if len(clusters) == limit:
+                continue
+            by_type = {'note': [], 'category': [], 'domain': []}
+            for i in members:
+                by_type[graph.node_type(i)].append(i)
+            clusters.append({
+                'notes': len(by_type['note']),
+                'categories': [graph.names[i] for i in sorted(by_type['category'], key=graph.degree, reverse=True)[:top]],
+                'categoryCount': len(by_type['category']),
+                'domains': [graph.names[i] for i in sorted(by_type['domain'], key=graph.degree, reverse=True)[:top]],
+                'domainCount': len(by_type['domain']),
+            })
+        return {
+            'clusters': clusters,
+            'clusterCount': total,
+            'isolatedNotes': isolated,
+            'nodes': len(graph),
+            'edges': graph.edge_count,
+        }
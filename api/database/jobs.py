@@ -0,0 +1,307 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from ..core import metrics
+from .common import utc
+from .db_service import DESCENDING
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = 'jobs'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+# A job's worker touches its document while it is queued or running; one
+# untouched for this long was abandoned by a worker that died and may be
+# resumed elsewhere. This is the only liveness signal, so all workers agree
+STALE_AFTER = timedelta(minutes=2)
+HEARTBEAT_INTERVAL = STALE_AFTER.total_seconds() / 4
+
+# Jobs run on this many threads per worker process, off the event loop
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '2'))
+
+# Scheduling niceness added to job threads, so request handling gets the CPU first
+JOB_NICENESS = int(os.getenv('JOB_NICENESS', '10'))
+
+class JobCancelled(Exception):
+    """Raised inside a handler once its job has been asked to stop"""
+
+def lower_thread_priority():
+    """Lower the scheduling priority of the calling thread; a thread pool initializer
+
+    Linux schedules threads individually, so this leaves the threads serving
+    requests untouched. Elsewhere it does nothing.
+    """
+    if JOB_NICENESS <= 0 or not hasattr(os, 'setpriority'):
+        return
+    try:
+        tid = threading.get_native_id()
+        os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + JOB_NICENESS))
+    except OSError as e:
+        logger.debug("Could not lower job thread priority: %s", e)
+
+def job_id_for(kind: str, params: dict) -> str:
+    """Deterministic job id, so submitting the same operation twice finds the same job"""
+    key = json.dumps({'kind': kind, 'params': params}, sort_keys=True, separators=(',', ':'))
+    return f"{kind}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}"
+
+class JobContext:
+    """A running job's view of its document; handlers report progress through it"""
+
+    def __init__(self, manager: "JobManager", user_id: str, job_id: str, data: dict):
+        self.manager = manager
+        self.user_id = user_id
+        self.job_id = job_id
+        self.params = data.get('params', {})
+        self.processed = data.get('processed', 0)
+        self.total = data.get('total')
+        # Where a resumed job picks up; saved with every progress update
+        self.checkpoint = data.get('checkpoint')
+        # Summary stored with the job when it succeeds
+        self.result = None
+
+    @property
+    def db_service(self):
+        return self.manager.db_service
+
+    def progress(self, processed: Optional[int] = None, total: Optional[int] = None, checkpoint=None):
+        """Record progress and optionally a checkpoint; also serves as the job's heartbeat
+
+        Raises JobCancelled if the job has been cancelled, so handlers stop at
+        their next progress update with everything before it saved.
+        """
+        if processed is not None:
+            self.processed = processed
+        if total is not None:
+            self.total = total
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        self.manager._update(self.user_id, self.job_id, {
+            'processed': self.processed,
+            'total': self.total,
+            'checkpoint': self.checkpoint,
+        }, 'jobs.progress')
+        if self.manager._cancel_requested(self.user_id, self.job_id):
+            raise JobCancelled()
+
+class JobManager:
+    """Runs long operations in the background and tracks them in Firestore
+
+    Jobs live under users/{uid}/jobs, so their status can be read from any
+    worker. Handlers must be idempotent: a failed or abandoned job is resumed by
+    running its handler again with the progress it had recorded.
+    """
+
+    def __init__(self, db_service, max_workers: int = MAX_CONCURRENT_JOBS):
+        self.db_service = db_service
+        self.max_workers = max_workers
+        self._handlers: Dict[str, Callable[[JobContext], Awaitable[None]]] = {}
+        # (user_id, job_id) of jobs queued or running here, kept fresh by the heartbeat
+        self._running = set()
+        self._lock = threading.Lock()
+        # Created on first use so no threads exist before gunicorn forks
+        self._executor = None
+        self._heartbeat_thread = None
+
+    @property
+    def db(self):
+        return self.db_service.db
+
+    def register(self, kind: str, handler: Callable[[JobContext], Awaitable[None]]):
+        self._handlers[kind] = handler
+
+    def _jobs(self, user_id: str):
+        return self.db.collection('users').document(user_id).collection(JOBS_COLLECTION)
+
+    def _update(self, user_id: str, job_id: str, data: dict, operation: str):
+        data['updatedAt'] = datetime.now()
+        self._jobs(user_id).document(job_id).set(data, merge=True)
+        metrics.record_storage_op(operation, 'write')
+
+    def _cancel_requested(self, user_id: str, job_id: str) -> bool:
+        metrics.record_storage_op('jobs.cancel_check', 'read')
+        doc = self._jobs(user_id).document(job_id).get(field_paths=['cancelRequested'])
+        return bool((doc.to_dict() or {}).get('cancelRequested'))
+
+    def _heartbeat(self):
+        """Touch every job this worker holds, so long steps and queued jobs never look abandoned"""
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self._lock:
+                held = list(self._running)
+            for user_id, job_id in held:
+                try:
+                    self._update(user_id, job_id, {}, 'jobs.heartbeat')
+                except Exception as e:
+                    logger.warning("Job heartbeat failed: %s", e)
+
+    def _is_stale(self, job: dict) -> bool:
+        updated_at = utc(job.get('updatedAt'))
+        return updated_at is None or updated_at < utc(datetime.now()) - STALE_AFTER
+
+    @staticmethod
+    def _add_rate(job: dict):
+        """Add throughput (items per second) since the last start and the ETA in seconds"""
+        started_at = utc(job.get('startedAt'))
+        until = utc(job.get('finishedAt') or job.get('updatedAt'))
+        if started_at is None or until is None or until <= started_at:
+            return
+        done = (job.get('processed') or 0) - (job.get('startProcessed') or 0)
+        throughput = done / (until - started_at).total_seconds()
+        job['throughput'] = round(throughput, 2)
+        if job['status'] == RUNNING and throughput > 0 and job.get('total') is not None:
+            job['eta'] = round(max(0, job['total'] - (job.get('processed') or 0)) / throughput)
+
+    def _to_job(self, doc) -> dict:
+        job = doc.to_dict()
+        job['id'] = doc.id
+        if job['status'] in ACTIVE_STATUSES and self._is_stale(job):
+            # Its worker is gone; report it so the client can resume it
+            job['status'] = FAILED
+            job['error'] = job.get('error') or "Job was abandoned"
+        self._add_rate(job)
+        return job
+
+    async def submit(self, user_id: str, kind: str, params: dict) -> dict:
+        """Start a job, or return the matching one if it is already running
+
+        Re-submitting a failed, cancelled or abandoned job resumes it from its
+        recorded progress; re-submitting a finished one runs it again.
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = job_id_for(kind, params)
+        return await self._start(user_id, job_id, kind, params)
+
+    async def resume(self, user_id: str, job_id: str) -> Optional[dict]:
+        """Restart a failed, cancelled or abandoned job; None if there is no such job"""
+        job = await self.get(user_id, job_id)
+        if job is None:
+            return None
+        return await self._start(user_id, job_id, job['kind'], job.get('params', {}))
+
+    async def _start(self, user_id: str, job_id: str, kind: str, params: dict) -> dict:
+        existing = await self.get(user_id, job_id)
+        with self._lock:
+            if existing is not None and existing['status'] in ACTIVE_STATUSES and not self._is_stale(existing):
+                return existing
+
+            resuming = existing is not None and existing['status'] != SUCCEEDED
+            now = datetime.now()
+            job = {
+                'kind': kind,
+                'params': params,
+                'status': QUEUED,
+                'processed': existing.get('processed', 0) if resuming else 0,
+                'total': existing.get('total') if resuming else None,
+                'checkpoint': existing.get('checkpoint') if resuming else None,
+                'error': None,
+                'attempts': (existing.get('attempts', 0) if existing else 0) + 1,
+                'createdAt': existing['createdAt'] if existing and resuming else now,
+                'startedAt': None,
+                'finishedAt': None,
+                'updatedAt': now,
+            }
+            self._jobs(user_id).document(job_id).set(job)
+            metrics.record_storage_op('jobs.submit', 'write')
+
+            self._running.add((user_id, job_id))
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix='job', initializer=lower_thread_priority
+                )
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+                self._heartbeat_thread.start()
+            self._executor.submit(self._run, user_id, job_id)
+
+        logger.info("Submitted job", extra={"user_id": user_id, "job_id": job_id, "kind": kind, "resuming": resuming})
+        return {**job, 'id': job_id}
+
+    def _run(self, user_id: str, job_id: str):
+        try:
+            asyncio.run(self._execute(user_id, job_id))
+        finally:
+            with self._lock:
+                self._running.discard((user_id, job_id))
+
+    async def _execute(self, user_id: str, job_id: str):
+        job = await self.get(user_id, job_id)
+        if job is None:
+            return
+        if self._cancel_requested(user_id, job_id):
+            self._update(user_id, job_id, {'status': CANCELLED, 'finishedAt': datetime.now()}, 'jobs.finish')
+            return
+        self._update(user_id, job_id, {
+            'status': RUNNING,
+            'startedAt': datetime.now(),
+            'startProcessed': job.get('processed', 0),
+        }, 'jobs.start')
+        context = JobContext(self, user_id, job_id, job)
+        try:
+            await self._handlers[job['kind']](context)
+        except JobCancelled:
+            self._update(user_id, job_id, {'status': CANCELLED, 'finishedAt': datetime.now()}, 'jobs.finish')
+            logger.info("Job cancelled", extra={"user_id": user_id, "job_id": job_id, "processed": context.processed})
+            return
+        except Exception as e:
+            logger.exception("Job failed", extra={"user_id": user_id, "job_id": job_id, "kind": job['kind']})
+            self._update(user_id, job_id, {'status': FAILED, 'error': str(e), 'finishedAt': datetime.now()}, 'jobs.finish')
+            return
+        self._update(user_id, job_id, {
+            'status': SUCCEEDED,
+            'processed': context.processed,
+            'total': context.total,
+            'result': context.result,
+            'finishedAt': datetime.now(),
+        }, 'jobs.finish')
+        logger.info("Job finished", extra={"user_id": user_id, "job_id": job_id, "processed": context.processed})
+
+    async def cancel(self, user_id: str, job_id: str) -> Optional[dict]:
+        """Ask a job to stop; None if there is no such job
+
+        A running job stops at its next progress update and may be resumed
+        later from there. Finished jobs are returned unchanged.
+        """
+        job = await self.get(user_id, job_id)
+        if job is None or job['status'] not in ACTIVE_STATUSES:
+            return job
+        with self._lock:
+            if not self._is_stale(job):
+                update = {'cancelRequested': True}
+            else:
+                # Nobody is running it to notice the request
+                update = {'status': CANCELLED, 'finishedAt': datetime.now()}
+            self._update(user_id, job_id, update, 'jobs.cancel')
+        logger.info("Job cancellation requested", extra={"user_id": user_id, "job_id": job_id})
+        return {**job, **update}
+
+    async def get(self, user_id: str, job_id: str) -> Optional[dict]:
+        """A job's status and progress"""
+        try:
+            doc = self.db_service._get(self._jobs(user_id).document(job_id), 'jobs.get')
+            return self._to_job(doc) if doc.exists else None
+        except Exception as e:
+            logger.error("Error getting job: %s", e)
+            raise
+
+    async def list(self, user_id: str, limit: int = 20) -> List[dict]:
+        """A user's most recently updated jobs"""
+        try:
+            query = self._jobs(user_id).order_by('updatedAt', direction=DESCENDING).limit(limit)
+            return [self._to_job(doc) for doc in self.db_service._stream(query, 'jobs.list')]
+        except Exception as e:
+            logger.error("Error listing jobs: %s", e)
+            raise
@@ -0,0 +1,115 @@
+import base64
+import hashlib
+import json
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from .common import BATCH_LIMIT, delete_field, utc
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_JOB = 'lookup_backfill'
+
+# Query parameters that track the visit rather than identify the page
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid', 'yclid',
+    '_ga', '_gl', 'ref', 'ref_src', 'spm', 'si',
+}
+TRACKING_PREFIXES = ('utm_', 'pk_', 'hsa_')
+
+DEFAULT_PORTS = {'80', '443'}
+
+def canonical_url(url: str) -> str:
+    """A page's address without scheme, www., default port, fragment, tracking parameters or trailing slash
+
+    Remaining query parameters are sorted, so links to the same page from
+    different places share one canonical form. URL lookups, duplicate
+    fingerprints and related-note scores all compare URLs in this form.
+    """
+    if not url or not url.strip():
+        return ''
+    parts = urlsplit(url.strip() if '//' in url else '//' + url.strip())
+    host = (parts.hostname or '').rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port is not None and str(port) not in DEFAULT_PORTS:
+        host = f"{host}:{port}"
+    params = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in TRACKING_PARAMS and not name.lower().startswith(TRACKING_PREFIXES)
+    )
+    query = urlencode(params)
+    return host + parts.path.rstrip('/') + (f"?{query}" if query else '')
+
+def url_key(url: str) -> Optional[str]:
+    """Indexed key of a URL's canonical form; hashed, as URLs can outgrow Firestore's index entry limit"""
+    canonical = canonical_url(url)
+    if not canonical:
+        return None
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def domain_key(domain: str = '', url: str = '') -> Optional[str]:
+    """Lowercased domain without www., taken from the URL when no domain is given"""
+    domain = (domain or '').strip().lower() or (urlsplit(url if '//' in (url or '') else '//' + (url or '')).hostname or '')
+    domain = domain.rstrip('.')
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    return domain or None
+
+def lookup_keys(metadata: Optional[dict]) -> dict:
+    """The urlKey and domainKey fields stored with a note at write time; None for missing ones"""
+    metadata = metadata or {}
+    return {
+        'urlKey': url_key(metadata.get('url', '')),
+        'domainKey': domain_key(metadata.get('domain', ''), metadata.get('url', '')),
+    }
+
+def encode_cursor(created_at: datetime, ids: List[str]) -> str:
+    payload = [utc(created_at).isoformat(), ids]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, List[str]]:
+    """A page cursor as (createdAt of the last note returned, ids returned at that time)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, ids = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return utc(datetime.fromisoformat(created_at)), [str(note_id) for note_id in ids]
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+async def backfill_lookup_keys(job):
+    """Store urlKey and domainKey on notes written before they existed, or with outdated ones"""
+    db_service = job.db_service
+    notes_collection = db_service.db.collection('users').document(job.user_id).collection('notes')
+    query = notes_collection.select(['metadata.url', 'metadata.domain', 'urlKey', 'domainKey'])
+
+    updates = {}
+    scanned = 0
+    for doc in db_service._stream(query, 'lookup.backfill'):
+        data = doc.to_dict() or {}
+        scanned += 1
+        keys = lookup_keys(data.get('metadata'))
+        if any(data.get(field) != value for field, value in keys.items()):
+            updates[doc.id] = keys
+    job.progress(0, len(updates))
+
+    items = list(updates.items())
+    per_batch = BATCH_LIMIT - 1
+    for start in range(0, len(items), per_batch):
+        batch = db_service._write_batch(job.user_id, 'lookup.backfill')
+        for note_id, keys in items[start:start + per_batch]:
+            batch.update(notes_collection.document(note_id), {
+                field: value if value is not None else delete_field() for field, value in keys.items()
+            })
+        batch.commit()
+        job.progress(min(start + per_batch, len(items)))
+    job.result = {'scanned': scanned, 'updated': len(items)}
+
+def register_lookup_jobs(manager):
+    manager.register(LOOKUP_JOB, backfill_lookup_keys)
@@ -0,0 +1,282 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from ..core import tracing
+from ..llm.budget import STOPWORDS
+from .common import BATCH_LIMIT, delete_field
+from .lookup import canonical_url, domain_key
+
+logger = logging.getLogger(__name__)
+
+RELATED_COLLECTION = 'related'
+
+RELATED_JOB = 'related_rebuild'
+
+# Neighbors kept per note
+NEIGHBORS = 20
+
+# Weakest relation worth listing
+MIN_SCORE = 0.15
+
+# Relatedness is a weighted sum of these similarities, each between 0 and 1
+WEIGHTS = {
+    'categories': 0.45,
+    'terms': 0.35,
+    'domain': 0.1,
+    'url': 0.1,
+}
+
+# Most frequent content words stored with each note as its `terms`
+TERMS_PER_NOTE = 12
+
+# Most recent notes of each of a note's categories scored when it is written
+CANDIDATES_PER_CATEGORY = 100
+
+# In the rebuild, postings (notes sharing a category, term or domain) larger
+# than this are too common to suggest a relation
+MAX_POSTING = 1000
+
+# Fields read from candidate notes to score them
+FEATURE_FIELDS = ['categories', 'terms', 'metadata.url', 'metadata.domain']
+
+# Neighbor lists are refreshed on this many threads per worker, off the request path
+REFRESH_WORKERS = int(os.getenv('RELATED_REFRESH_WORKERS', '1'))
+
+_WORD = re.compile(r'[^\W\d_]{3,}')
+
+def note_terms(content: str, title: str = '') -> List[str]:
+    """The most frequent meaningful words of a note; title words count double"""
+    counts = Counter(word for word in _WORD.findall((content or '').lower()) if word not in STOPWORDS)
+    for word in _WORD.findall((title or '').lower()):
+        if word not in STOPWORDS:
+            counts[word] += 2
+    return [word for word, _ in counts.most_common(TERMS_PER_NOTE)]
+
+def _features(note: dict) -> dict:
+    metadata = note.get('metadata') or {}
+    return {
+        'categories': set(note.get('categories') or []),
+        'terms': set(note.get('terms') or []),
+        'domain': domain_key(metadata.get('domain') or '', metadata.get('url') or '') or '',
+        'url': canonical_url(metadata.get('url') or ''),
+    }
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def score(a: dict, b: dict) -> float:
+    """Relatedness of two notes' features, between 0 and 1"""
+    return (
+        WEIGHTS['categories'] * _jaccard(a['categories'], b['categories'])
+        + WEIGHTS['terms'] * _jaccard(a['terms'], b['terms'])
+        + WEIGHTS['domain'] * (a['domain'] != '' and a['domain'] == b['domain'])
+        + WEIGHTS['url'] * (a['url'] != '' and a['url'] == b['url'])
+    )
+
+class RelatedNotes:
+    """Top related notes of every note, kept under users/{uid}/related
+
+    A note's list is recomputed after each create or content/category update
+    commits, on a background thread: its candidates are the most recent notes
+    of its categories, found through the category index. The note is also
+    added to its new neighbors' lists. Lists may hold a few more than
+    NEIGHBORS entries between trims; readers take the top ones.
+    """
+
+    # Batches whose note changes refresh neighbor lists; bulk rewrites rely on the rebuild job
+    REFRESH_OPERATIONS = ('create_note', 'update_note')
+
+    def __init__(self, db_service):
+        self.db_service = db_service
+        # Created on first use so no threads exist before gunicorn forks
+        self._executor = None
+
+    @property
+    def db(self):
+        return self.db_service.db
+
+    def _related(self, user_id: str):
+        return self.db.collection('users').document(user_id).collection(RELATED_COLLECTION)
+
+    def _notes(self, user_id: str):
+        return self.db.collection('users').document(user_id).collection('notes')
+
+    def on_note_change(self, batch, user_id: str, note_id: str, before: Optional[dict], after: Optional[dict]):
+        """Note listener scheduling a neighbor refresh once the write commits"""
+        if after is None:
+            batch.after_commit(lambda: self._schedule(self.forget, user_id, note_id))
+        elif batch.operation in self.REFRESH_OPERATIONS and (
+                before is None or any(before.get(field) != after.get(field) for field in ('categories', 'terms', 'metadata'))):
+            batch.after_commit(lambda: self._schedule(self.refresh, user_id, note_id))
+
+    def _schedule(self, method, user_id: str, note_id: str):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(REFRESH_WORKERS, thread_name_prefix='related')
+        return self._executor.submit(self._run, method, user_id, note_id)
+
+    @staticmethod
+    def _run(method, user_id: str, note_id: str):
+        try:
+            asyncio.run(method(user_id, note_id))
+        except Exception:
+            logger.exception("Related notes update failed", extra={"user_id": user_id, "note_id": note_id})
+
+    def _neighbors(self, user_id: str, note_id: str, operation: str) -> Dict[str, float]:
+        doc = self.db_service._get(self._related(user_id).document(note_id), operation)
+        return ((doc.to_dict() or {}).get('neighbors') or {}) if doc.exists else {}
+
+    @tracing.traced("db.related.refresh")
+    async def refresh(self, user_id: str, note_id: str) -> Dict[str, float]:
+        """Recompute a note's neighbors and return them"""
+        note = self.db_service._read_note(self._notes(user_id).document(note_id), 'related.refresh')
+        if note is None:
+            await self.forget(user_id, note_id)
+            return {}
+        features = _features(note)
+
+        candidates = set()
+        for category in features['categories']:
+            keys = await self.db_service.category_index._members(user_id, category)
+            candidates.update(key.split(':', 1)[1] for key in keys[:CANDIDATES_PER_CATEGORY])
+        candidates.discard(note_id)
+
+        scored = []
+        if candidates:
+            references = [self._notes(user_id).document(candidate) for candidate in candidates]
+            for doc in self.db_service._get_all(references, 'related.refresh', field_paths=FEATURE_FIELDS):
+                if doc.exists:
+                    relatedness = score(features, _features(doc.to_dict() or {}))
+                    if relatedness >= MIN_SCORE:
+                        scored.append((relatedness, doc.id))
+        neighbors = {other: round(relatedness, 4) for relatedness, other in heapq.nlargest(NEIGHBORS, scored)}
+
+        previous = self._neighbors(user_id, note_id, 'related.refresh')
+        batch = self.db_service._batch('related.refresh')
+        batch.set(self._related(user_id).document(note_id), {'neighbors': neighbors, 'updatedAt': datetime.now()})
+        for other, relatedness in neighbors.items():
+            batch.set(self._related(user_id).document(other), {'neighbors': {note_id: relatedness}}, merge=True)
+        for other in previous.keys() - neighbors.keys():
+            batch.set(self._related(user_id).document(other), {'neighbors': {note_id: delete_field()}}, merge=True)
+        batch.commit()
+        return neighbors
+
+    @tracing.traced("db.related.forget")
+    async def forget(self, user_id: str, note_id: str):
+        """Drop a deleted note's list and remove it from its neighbors' lists"""
+        previous = self._neighbors(user_id, note_id, 'related.forget')
+        batch = self.db_service._batch('related.forget')
+        batch.delete(self._related(user_id).document(note_id))
+        for other in previous:
+            batch.set(self._related(user_id).document(other), {'neighbors': {note_id: delete_field()}}, merge=True)
+        batch.commit()
+
+    @tracing.traced("db.related.get")
+    async def get(self, user_id: str, note_id: str, limit: int = 10, fields: Optional[List[str]] = None) -> Optional[List[dict]]:
+        """Most related notes, each with its `score`; None if the note does not exist
+
+        One read for the list plus one per returned note. A note without a
+        list yet (written before lists existed) gets one computed now.
+        """
+        doc = self.db_service._get(self._related(user_id).document(note_id), 'related.get')
+        if doc.exists:
+            neighbors = (doc.to_dict() or {}).get('neighbors') or {}
+        else:
+            if self.db_service._read_note(self._notes(user_id).document(note_id), 'related.get') is None:
+                return None
+            neighbors = await self.refresh(user_id, note_id)
+
+        ranked = sorted(neighbors.items(), key=lambda item: item[1], reverse=True)
+        top = ranked[:limit]
+        notes = await self.db_service.get_notes_by_ids(user_id, [other for other, _ in top], fields)
+        scores = dict(top)
+        for note in notes:
+            note['score'] = scores[note['id']]
+
+        missing = [other for other, _ in top if other not in {note['id'] for note in notes}]
+        if missing or len(ranked) > 2 * NEIGHBORS:
+            # Trim lists grown by neighbors' updates and drop deleted notes
+            kept = {other: relatedness for other, relatedness in ranked[:NEIGHBORS + len(missing)] if other not in missing}
+            batch = self.db_service._batch('related.get')
+            batch.update(self._related(user_id).document(note_id), {'neighbors': kept})
+            batch.commit()
+        return notes
+
+def _rebuild_neighbors(notes: List[dict]) -> Dict[str, Dict[str, float]]:
+    """Top neighbors of every note, scoring only notes that share a feature"""
+    features = [_features(note) for note in notes]
+    postings: Dict[str, List[int]] = {}
+    for i, feature in enumerate(features):
+        keys = [f"c:{category}" for category in feature['categories']] + [f"t:{term}" for term in feature['terms']]
+        if feature['domain']:
+            keys.append(f"d:{feature['domain']}")
+        for key in keys:
+            postings.setdefault(key, []).append(i)
+
+    shared = [Counter() for _ in notes]
+    for members in postings.values():
+        if len(members) > MAX_POSTING:
+            continue
+        for i in members:
+            shared[i].update(members)
+
+    neighbors = {}
+    for i, note in enumerate(notes):
+        shared[i].pop(i, None)
+        candidates = [j for j, _ in shared[i].most_common(CANDIDATES_PER_CATEGORY * 2)]
+        scored = [(score(features[i], features[j]), notes[j]['id']) for j in candidates]
+        neighbors[note['id']] = {
+            other: round(relatedness, 4)
+            for relatedness, other in heapq.nlargest(NEIGHBORS, scored) if relatedness >= MIN_SCORE
+        }
+    return neighbors
+
+async def rebuild_related_notes(job):
+    """Recompute every neighbor list of a user, backfilling note terms"""
+    db_service = job.db_service
+    related = db_service.related
+    notes_collection = related._notes(job.user_id)
+    query = notes_collection.select(['content', 'metadata.title', 'metadata.url', 'metadata.domain', 'categories', 'terms'])
+
+    notes, backfill = [], {}
+    for doc in db_service._stream(query, 'related.rebuild'):
+        data = doc.to_dict() or {}
+        terms = note_terms(data.get('content', ''), (data.get('metadata') or {}).get('title', ''))
+        if terms != data.get('terms'):
+            backfill[doc.id] = terms
+        notes.append({'id': doc.id, 'categories': data.get('categories'), 'terms': terms, 'metadata': data.get('metadata')})
+    job.progress(total=len(notes))
+
+    await db_service.set_note_terms(job.user_id, backfill)
+    neighbors = _rebuild_neighbors(notes)
+
+    stale = [
+        doc.reference for doc in db_service._stream(related._related(job.user_id).select([]), 'related.rebuild')
+        if doc.id not in neighbors
+    ]
+    now = datetime.now()
+    writes = [lambda b, ref=ref: b.delete(ref) for ref in stale]
+    writes += [
+        lambda b, ref=related._related(job.user_id).document(note_id), data=data: b.set(ref, {'neighbors': data, 'updatedAt': now})
+        for note_id, data in neighbors.items()
+    ]
+    for start in range(0, len(writes), BATCH_LIMIT):
+        batch = db_service._batch('related.rebuild')
+        for write in writes[start:start + BATCH_LIMIT]:
+            write(batch)
+        batch.commit()
+        job.progress(processed=min(len(notes), start + BATCH_LIMIT))
+
+    job.result = {'notes': len(notes), 'termsBackfilled': len(backfill)}
+    logger.info("Rebuilt related notes", extra={"user_id": job.user_id, **job.result})
+
+def register_related_jobs(manager):
+    manager.register(RELATED_JOB, rebuild_related_notes)
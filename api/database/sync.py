@@ -0,0 +1,111 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from .common import utc
+from .db_service import DatabaseService
+
+# Writes are stamped by the app server before they commit, so a change can
+# become visible with a timestamp slightly behind the newest one already
+# served. The final page of a sync holds its cursor back by this much; those
+# changes are sent again next time and clients apply them by id.
+SAFETY_WINDOW = timedelta(seconds=5)
+
+# Run tombstone compaction for a user at most this often
+COMPACTION_INTERVAL = timedelta(days=1)
+
+STREAMS = ('notes', 'categories', 'deleted')
+
+class InvalidSyncToken(ValueError):
+    pass
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def encode_token(cursors: dict) -> str:
+    payload = {
+        stream: [cursor[0].isoformat() if cursor[0] else None, cursor[1]]
+        for stream, cursor in cursors.items()
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_token(token: str) -> dict:
+    """Cursors as {stream: (time or None, ids already returned at that time)}"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        cursors = {}
+        for stream in STREAMS:
+            time_value, ids = payload[stream]
+            cursors[stream] = (utc(datetime.fromisoformat(time_value)) if time_value else None, list(ids))
+        return cursors
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidSyncToken("Invalid sync token") from e
+
+def _advance(cursor, rows: List[dict], time_field: str, has_more: bool):
+    """Next cursor for a stream after returning rows"""
+    since, seen_ids = cursor
+    if not rows:
+        return cursor
+
+    newest = utc(rows[-1][time_field])
+    ids_at_newest = [row['id'] for row in rows if utc(row[time_field]) == newest]
+    if newest == since:
+        ids_at_newest = seen_ids + ids_at_newest
+    held_back = _now() - SAFETY_WINDOW
+    if has_more or newest <= held_back:
+        return newest, ids_at_newest
+    # Re-send recent changes next time rather than risk skipping a late commit
+    if since is not None and since > held_back:
+        return cursor
+    return held_back, []
+
+async def sync_changes(db_service: DatabaseService, user_id: str, token: Optional[str] = None,
+                       limit: int = 200, fields: Optional[List[str]] = None) -> dict:
+    """Notes and categories changed, and ids deleted, since a sync token
+
+    Without a token every note and category is returned (paged), and deletion
+    tracking starts now. Follow `next` while `has_more` is true.
+    """
+    state = await db_service.get_sync_state(user_id)
+    compacted_at = utc(state.get('tombstonesCompactedAt'))
+    horizon = utc(state.get('tombstoneHorizon'))
+    if compacted_at is None or compacted_at < _now() - COMPACTION_INTERVAL:
+        horizon = utc(await db_service.compact_tombstones(user_id)) or horizon
+
+    if token:
+        cursors = decode_token(token)
+        deleted_since = cursors['deleted'][0]
+        if horizon is not None and (deleted_since is None or deleted_since < horizon):
+            # Deletions older than the horizon are gone; the client must start over
+            return {"full_resync": True, "version": state.get('dataVersion', 0)}
+    else:
+        cursors = {'notes': (None, []), 'categories': (None, []), 'deleted': (_now() - SAFETY_WINDOW, [])}
+
+    notes = await db_service.get_changes(user_id, 'notes', *cursors['notes'], limit=limit + 1, fields=fields)
+    categories = await db_service.get_changes(user_id, 'categories', *cursors['categories'], limit=limit + 1)
+    deleted = []
+    if token:
+        deleted = await db_service.get_changes(user_id, 'tombstones', *cursors['deleted'], limit=limit + 1, time_field='deletedAt')
+
+    more = {'notes': len(notes) > limit, 'categories': len(categories) > limit, 'deleted': len(deleted) > limit}
+    notes, categories, deleted = notes[:limit], categories[:limit], deleted[:limit]
+    next_cursors = {
+        'notes': _advance(cursors['notes'], notes, 'updatedAt', more['notes']),
+        'categories': _advance(cursors['categories'], categories, 'updatedAt', more['categories']),
+        'deleted': _advance(cursors['deleted'], deleted, 'deletedAt', more['deleted']),
+    }
+
+    return {
+        "notes": notes,
+        "categories": categories,
+        "deleted": {
+            "notes": [row['id'].split('_', 1)[1] for row in deleted if row.get('kind') == 'note'],
+            "categories": [row['id'].split('_', 1)[1] for row in deleted if row.get('kind') == 'category'],
+        },
+        "next": encode_token(next_cursors),
+        "has_more": any(more.values()),
+        "full_resync": False,
+        "version": state.get('dataVersion', 0),
+    }
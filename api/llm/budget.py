@@ -0,0 +1,127 @@
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, NamedTuple
+
+# Content tokens allowed per LLM operation; the fixed prompt text comes on top.
+# Override with LLM_TOKEN_BUDGETS, e.g. "categorize_note=1000,generate_summary=6000"
+DEFAULT_TOKEN_BUDGETS = {
+    'categorize_note': 2000,
+    'generate_summary': 4000,
+    'extract_keywords': 3000,
+    'generate_questions': 4000,
+    # Per note; several notes share one prompt
+    'recategorize_notes': 800,
+}
+
+# Share of the budget always given to the opening of the content
+HEAD_SHARE = 0.25
+
+# Marks where sentences were left out
+GAP = ' [...] '
+
+_SENTENCE_END = re.compile(r'(?<=[.!?。！？])\s+|\n+')
+_WORD = re.compile(r'\w+')
+
+# Words too common to say what a sentence is about
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below
+between both but by can could did do does doing down during each few for from further had has have
+having he her here hers herself him himself his how i if in into is it its itself just me more most my
+myself no nor not now of off on once only or other our ours ourselves out over own same she should so
+some such than that the their theirs them themselves then there these they this those through to too
+under until up very was we were what when where which while who whom why will with would you your
+yours yourself yourselves
+""".split())
+
+def token_budgets() -> Dict[str, int]:
+    budgets = dict(DEFAULT_TOKEN_BUDGETS)
+    for item in os.getenv('LLM_TOKEN_BUDGETS', '').split(','):
+        operation, _, value = item.partition('=')
+        if operation.strip() and value.strip():
+            budgets[operation.strip()] = int(value)
+    return budgets
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count without running a tokenizer
+
+    About four characters per token for ASCII text; each other character
+    (CJK in particular) counts as most of a token.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) * 0.7)
+
+class BudgetedContent(NamedTuple):
+    text: str
+    original_tokens: int
+    tokens: int
+
+    @property
+    def reduced(self) -> bool:
+        return self.tokens < self.original_tokens
+
+def split_sentences(text: str) -> List[str]:
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+
+def _words(text: str) -> List[str]:
+    return [word for word in _WORD.findall(text.lower()) if word not in STOPWORDS and not word.isdigit()]
+
+def fit_to_budget(content: str, budget: int, title: str = '') -> BudgetedContent:
+    """Reduce content to about `budget` tokens by extractive selection
+
+    Keeps the opening sentences, then the most informative of the rest: those
+    dense in the content's frequent terms and in words from the title. Kept
+    sentences stay in their original order.
+    """
+    original_tokens = estimate_tokens(content)
+    if original_tokens <= budget:
+        return BudgetedContent(content, original_tokens, original_tokens)
+
+    sentences = split_sentences(content)
+    costs = [estimate_tokens(sentence) + 1 for sentence in sentences]
+    keep = set()
+    used = 0
+
+    head_budget = budget * HEAD_SHARE
+    for i, cost in enumerate(costs):
+        if used + cost > head_budget:
+            break
+        keep.add(i)
+        used += cost
+
+    frequencies = Counter(_words(content))
+    title_words = set(_words(title))
+
+    def score(i):
+        words = _words(sentences[i])
+        if not words:
+            return 0.0
+        weight = sum(frequencies[word] for word in set(words)) + 2 * sum(
+            frequencies[word] for word in title_words.intersection(words))
+        # Favour dense sentences without letting long ones win on length alone
+        return weight / math.sqrt(len(words))
+
+    for i in sorted(set(range(len(sentences))) - keep, key=score, reverse=True):
+        if used + costs[i] <= budget:
+            keep.add(i)
+            used += costs[i]
+
+    if not keep:
+        # A single sentence longer than the budget; cut it
+        text = content[:budget * 4]
+        return BudgetedContent(text, original_tokens, estimate_tokens(text))
+
+    parts = []
+    previous = None
+    for i in sorted(keep):
+        if previous is not None:
+            parts.append(GAP if i != previous + 1 else ' ')
+        parts.append(sentences[i])
+        previous = i
+    if previous != len(sentences) - 1:
+        parts.append(GAP.rstrip())
+    text = ''.join(parts)
+    return BudgetedContent(text, original_tokens, estimate_tokens(text))
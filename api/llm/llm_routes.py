@@ -27,8 +27,16 @@ class QuestionRequest(BaseModel):
     content: str
     num_questions: Optional[int] = 3
 
-# Initialize LLM service
-llm_service = LLMService()
+# LLM service will be set when the main app starts; a callable returning the
+# service may be set instead when it is created lazily
+llm_service = None
+
+def set_llm_service(service: LLMService):
+    global llm_service
+    llm_service = service
+
+def get_llm_service() -> Optional[LLMService]:
+    return llm_service() if callable(llm_service) else llm_service
 
 @router.post("/categorize")
 async def categorize_content(
@@ -36,6 +44,10 @@ async def categorize_content(
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Categorize content using AI"""
+    llm_service = get_llm_service()
+    if not llm_service:
+        raise HTTPException(status_code=503, detail="LLM service not available")
+    
     try:
         result = await llm_service.categorize_note(
             request.content,
@@ -44,7 +56,7 @@ async def categorize_content(
         )
         return result
     except Exception as e:
-        logger.error(f"Error in categorization: {e}")
+        logger.error("Error in categorization: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/summarize")
@@ -53,11 +65,15 @@ async def summarize_content(
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Generate a summary of content"""
+    llm_service = get_llm_service()
+    if not llm_service:
+        raise HTTPException(status_code=503, detail="LLM service not available")
+    
     try:
         summary = await llm_service.generate_summary(request.content, request.max_length)
         return {"summary": summary}
     except Exception as e:
-        logger.error(f"Error in summarization: {e}")
+        logger.error("Error in summarization: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/keywords")
@@ -66,11 +82,15 @@ async def extract_keywords(
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Extract keywords from content"""
+    llm_service = get_llm_service()
+    if not llm_service:
+        raise HTTPException(status_code=503, detail="LLM service not available")
+    
     try:
         keywords = await llm_service.extract_keywords(request.content, request.max_keywords)
         return {"keywords": keywords}
     except Exception as e:
-        logger.error(f"Error extracting keywords: {e}")
+        logger.error("Error extracting keywords: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/questions")
@@ -79,9 +99,13 @@ async def generate_questions(
     current_user: UserInfo = Depends(AuthService.verify_token)
 ):
     """Generate study questions from content"""
+    llm_service = get_llm_service()
+    if not llm_service:
+        raise HTTPException(status_code=503, detail="LLM service not available")
+    
     try:
         questions = await llm_service.generate_questions(request.content, request.num_questions)
         return {"questions": questions}
     except Exception as e:
-        logger.error(f"Error generating questions: {e}")
+        logger.error("Error generating questions: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -1,24 +1,62 @@
+import hashlib
 import json
 import os
 import logging
-from openai import OpenAI
+import time
 from typing import List, Dict, Any
+from ..core import metrics, tracing
+from .budget import fit_to_budget, token_budgets
 
 logger = logging.getLogger(__name__)
 
+# Categorization results are keyed by the exact prompt, so they never go stale;
+# the TTL only bounds the size of the cache
+CATEGORIZATION_CACHE_TTL = 24 * 3600
+
 class LLMService:
-    def __init__(self):
-        self.client = OpenAI(
-            api_key=os.getenv("DEEPSEEK_API_KEY"), 
-            base_url="https://api.deepseek.com"
-        )
+    def __init__(self, client=None, cache=None, budgets: Dict[str, int] = None):
+        if client is None:
+            # Imported lazily: openai is one of the slowest imports at cold start
+            from openai import OpenAI
+            client = OpenAI(
+                api_key=os.getenv("DEEPSEEK_API_KEY"), 
+                base_url="https://api.deepseek.com"
+            )
+        self.client = client
+        self.cache = cache
+        self.budgets = budgets if budgets is not None else token_budgets()
     
-    async def categorize_note(self, note_content: str, context_data: dict, existing_categories: List[dict]) -> dict:
-        """Categorize a note using AI"""
-        try:
-            existing_categories_formatted = [f"{cat['category']}: {cat['definition']}" for cat in existing_categories]
-            
-            system_prompt = """You are an expert knowledge manager who excels at categorizing content. Your goal is to help users organize their knowledge effectively by assigning relevant, meaningful categories.
+    def _fit_content(self, operation: str, content: str, title: str = '') -> str:
+        """Content reduced to the operation's token budget, with the savings recorded"""
+        budget = self.budgets.get(operation)
+        if budget is None:
+            return content
+        fitted = fit_to_budget(content, budget, title)
+        metrics.record_content_budget(operation, fitted.original_tokens, fitted.tokens)
+        if fitted.reduced:
+            logger.debug("Reduced LLM content", extra={
+                "operation": operation, "original_tokens": fitted.original_tokens, "tokens": fitted.tokens,
+            })
+        return fitted.text
+    
+    def _complete(self, operation: str, **kwargs):
+        """Call the chat completions API, recording latency and token usage"""
+        with tracing.span(f"llm.{operation}", tracing.KIND_CLIENT) as span:
+            start = time.perf_counter()
+            response = self.client.chat.completions.create(model="deepseek-chat", **kwargs)
+            usage = getattr(response, "usage", None)
+            metrics.record_llm_call(operation, time.perf_counter() - start, usage)
+            if usage is not None:
+                span.set_attribute("llm.prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+                span.set_attribute("llm.completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+        return response
+    
+    def build_categorization_messages(self, note_content: str, context_data: dict, existing_categories: List[dict]) -> List[dict]:
+        """Build the chat messages sent to the model for categorization"""
+        note_content = self._fit_content("categorize_note", note_content, context_data.get('title', ''))
+        existing_categories_formatted = [f"{cat['category']}: {cat['definition']}" for cat in existing_categories]
+        
+        system_prompt = """You are an expert knowledge manager who excels at categorizing content. Your goal is to help users organize their knowledge effectively by assigning relevant, meaningful categories.
 
 INSTRUCTIONS:
 1. Analyze the note content and identify ALL relevant topics, themes, and concepts
@@ -62,14 +100,14 @@ For multiple new categories:
 
 Always provide meaningful, specific categories that help organize knowledge effectively."""
 
-            # Build context information for better categorization
-            context_info = f"URL: {context_data.get('url', '')}"
-            if context_data.get('title'):
-                context_info += f"\nPage Title: {context_data['title']}"
-            if context_data.get('domain'):
-                context_info += f"\nWebsite: {context_data['domain']}"
-            
-            user_prompt = f"""Note Content: "{note_content}"
+        # Build context information for better categorization
+        context_info = f"URL: {context_data.get('url', '')}"
+        if context_data.get('title'):
+            context_info += f"\nPage Title: {context_data['title']}"
+        if context_data.get('domain'):
+            context_info += f"\nWebsite: {context_data['domain']}"
+        
+        user_prompt = f"""Note Content: "{note_content}"
 
 Webpage Context:
 {context_info}
@@ -79,19 +117,32 @@ Existing Categories:
 
 Please categorize this note considering both the content and the webpage context, and respond with JSON only."""
 
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+    
+    async def categorize_note(self, note_content: str, context_data: dict, existing_categories: List[dict]) -> dict:
+        """Categorize a note using AI"""
+        try:
+            messages = self.build_categorization_messages(note_content, context_data, existing_categories)
+            cache_key = None
+            if self.cache is not None:
+                cache_key = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+                cached = self.cache.get('categorization', cache_key)
+                if cached is not None:
+                    return cached
+            
+            response = self._complete(
+                "categorize_note",
+                messages=messages,
                 response_format={'type': 'json_object'},
                 temperature=0.1,
                 stream=False
             )
             
             raw_response = response.choices[0].message.content
-            logger.info("DeepSeek API JSON Response: %s", raw_response)
+            logger.debug("DeepSeek categorization response", extra={"raw_response": raw_response})
             
             # Parse the JSON response
             category_data = json.loads(raw_response)
@@ -99,27 +150,122 @@ Please categorize this note considering both the content and the webpage context
             # Validate the response structure
             if "categories" not in category_data:
                 raise ValueError("Response missing required 'categories' field")
-                
-            logger.info("Successfully parsed category data: %s", category_data)
+            
+            # Fallbacks below are not cached so a transient failure is retried
+            if cache_key is not None:
+                self.cache.set('categorization', cache_key, category_data, CATEGORIZATION_CACHE_TTL)
             return category_data
             
         except json.JSONDecodeError as e:
-            logger.error(f"JSON parsing error: {e}")
-            logger.error(f"Raw response: {raw_response}")
+            logger.error("JSON parsing error: %s", e, extra={"raw_response": raw_response})
+            metrics.record_llm_fallback("categorize_note", "json_error")
             return {"categories": ["General"], "definition": "JSON parsing failed"}
         except Exception as e:
-            logger.error(f"API call error: {e}")
+            logger.error("API call error: %s", e)
+            metrics.record_llm_fallback("categorize_note", "error")
             return {"categories": ["General"], "definition": "API call failed"}
 
+    def build_batch_categorization_messages(self, notes: List[dict], existing_categories: List[dict]) -> List[dict]:
+        """Chat messages categorizing several notes at once against a fixed category list
+        
+        The category list goes first, in the system prompt, so consecutive
+        batches share a prompt prefix the provider can cache.
+        """
+        existing_categories_formatted = [f"{cat['category']}: {cat.get('definition', '')}" for cat in existing_categories]
+        system_prompt = f"""You are an expert knowledge manager who organizes notes into a fixed set of categories.
+
+INSTRUCTIONS:
+1. For each note, assign 1-4 categories that best represent its content
+2. Use ONLY categories from the list below, spelled exactly as listed
+3. Consider the webpage context of each note as well as its content
+
+CATEGORIES:
+{json.dumps(existing_categories_formatted, indent=2)}
+
+Respond with JSON only, one entry per note:
+{{
+    "results": [
+        {{"note": 1, "categories": ["Machine Learning", "Research Methods"]}}
+    ]
+}}"""
+        
+        parts = []
+        for number, note in enumerate(notes, 1):
+            content = self._fit_content("recategorize_notes", note.get('content', ''), note.get('title', ''))
+            context_info = f"URL: {note.get('url', '')}"
+            if note.get('title'):
+                context_info += f"\nPage Title: {note['title']}"
+            if note.get('domain'):
+                context_info += f"\nWebsite: {note['domain']}"
+            parts.append(f'Note {number}:\n{context_info}\nContent: "{content}"')
+        
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "\n\n".join(parts)}
+        ]
+    
+    async def categorize_notes(self, notes: List[dict], existing_categories: List[dict]) -> List[Any]:
+        """Categorize several notes in one call, choosing only existing categories
+        
+        Notes are dicts with `content` and optionally `title`, `url` and
+        `domain`. Returns each note's categories in order, or None where the
+        model gave no usable answer. Answers are cached per note and category
+        list, so re-running over the same notes only pays for new ones.
+        """
+        names = {cat['category'].lower(): cat['category'] for cat in existing_categories}
+        results: List[Any] = [None] * len(notes)
+        keys = [None] * len(notes)
+        if self.cache is not None:
+            category_key = sorted(names.values())
+            for i, note in enumerate(notes):
+                keys[i] = hashlib.sha256(json.dumps([note, category_key], sort_keys=True, default=str).encode()).hexdigest()
+                results[i] = self.cache.get('recategorization', keys[i])
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        
+        raw_response = None
+        try:
+            messages = self.build_batch_categorization_messages([notes[i] for i in pending], existing_categories)
+            response = self._complete(
+                "recategorize_notes",
+                messages=messages,
+                response_format={'type': 'json_object'},
+                temperature=0.1,
+                stream=False
+            )
+            raw_response = response.choices[0].message.content
+            for entry in json.loads(raw_response).get("results", []):
+                number = entry.get("note") if isinstance(entry, dict) else None
+                if not isinstance(number, int) or not 1 <= number <= len(pending):
+                    continue
+                categories = list(dict.fromkeys(
+                    names[name.lower()] for name in entry.get("categories") or []
+                    if isinstance(name, str) and name.lower() in names
+                ))
+                if categories:
+                    i = pending[number - 1]
+                    results[i] = categories
+                    if keys[i] is not None:
+                        self.cache.set('recategorization', keys[i], categories, CATEGORIZATION_CACHE_TTL)
+        except json.JSONDecodeError as e:
+            logger.error("JSON parsing error: %s", e, extra={"raw_response": raw_response})
+            metrics.record_llm_fallback("recategorize_notes", "json_error")
+        except Exception as e:
+            logger.error("API call error: %s", e)
+            metrics.record_llm_fallback("recategorize_notes", "error")
+        return results
+
     async def generate_summary(self, content: str, max_length: int = 150) -> str:
         """Generate a summary of the given content"""
         try:
+            content = self._fit_content("generate_summary", content)
             system_prompt = f"""You are an expert at creating concise, informative summaries. 
             Create a summary of the provided content in {max_length} characters or less. 
             Focus on the key points and main ideas."""
             
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
+            response = self._complete(
+                "generate_summary",
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": f"Please summarize this content: {content}"}
@@ -131,17 +277,19 @@ Please categorize this note considering both the content and the webpage context
             return response.choices[0].message.content.strip()
             
         except Exception as e:
-            logger.error(f"Error generating summary: {e}")
+            logger.error("Error generating summary: %s", e)
+            metrics.record_llm_fallback("generate_summary", "error")
             return content[:max_length] + "..." if len(content) > max_length else content
 
     async def extract_keywords(self, content: str, max_keywords: int = 10) -> List[str]:
         """Extract keywords from content"""
         try:
+            content = self._fit_content("extract_keywords", content)
             system_prompt = f"""Extract the {max_keywords} most important keywords or phrases from the given content. 
             Return them as a JSON array of strings. Focus on technical terms, proper nouns, and key concepts."""
             
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
+            response = self._complete(
+                "extract_keywords",
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": f"Extract keywords from: {content}"}
@@ -154,18 +302,20 @@ Please categorize this note considering both the content and the webpage context
             return result.get("keywords", [])
             
         except Exception as e:
-            logger.error(f"Error extracting keywords: {e}")
+            logger.error("Error extracting keywords: %s", e)
+            metrics.record_llm_fallback("extract_keywords", "error")
             return []
 
     async def generate_questions(self, content: str, num_questions: int = 3) -> List[str]:
         """Generate study questions based on content"""
         try:
+            content = self._fit_content("generate_questions", content)
             system_prompt = f"""Generate {num_questions} thoughtful study questions based on the provided content. 
             The questions should help someone understand and remember the key concepts. 
             Return as a JSON array of strings."""
             
-            response = self.client.chat.completions.create(
-                model="deepseek-chat",
+            response = self._complete(
+                "generate_questions",
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": f"Generate study questions for: {content}"}
@@ -178,5 +328,6 @@ Please categorize this note considering both the content and the webpage context
             return result.get("questions", [])
             
         except Exception as e:
-            logger.error(f"Error generating questions: {e}")
+            logger.error("Error generating questions: %s", e)
+            metrics.record_llm_fallback("generate_questions", "error")
             return []
\ No newline at end of file
@@ -1,9 +1,11 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Depends, Header, status, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import uvicorn
-import json
+import asyncio
+import hashlib
 import os
 from dotenv import load_dotenv
 from typing import List, Optional
@@ -11,41 +13,93 @@ import logging
 from datetime import datetime, timedelta
 import sys
 import jwt
-import requests
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+import time
+from contextlib import asynccontextmanager
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from api.core import profiling, tracing
+from api.core.compression import CompressionMiddleware
+from api.core.concurrency import AdaptiveConcurrencyMiddleware
+from api.core.file_store import CategoryFileStore
+from api.core.idempotency import IdempotencyMiddleware
+from api.core.logging_config import setup_logging
+from api.core.metrics import MetricsMiddleware, render_latest
+from api.core.rate_limit import RateLimitMiddleware
+from api.core.responses import CONDITIONAL_CACHE_CONTROL, FastJSONResponse, etag_matches, make_etag, not_modified
+from api.core.services import ServiceRegistry
+from api.database import db_routes
+from api.database.category_index import IndexNotReady
+from api.database.category_jobs import RECATEGORIZE_JOB, REWRITE_JOB, rewrite_params
+from api.database.dedup import DEDUP_JOB, DEDUP_POLICY, POLICIES as DEDUP_POLICIES, note_fingerprint
+from api.database.db_service import parse_note_fields
+from api.database.lookup import LOOKUP_JOB
+from api.database.related import RELATED_JOB
+from api.database.sync import InvalidSyncToken, sync_changes
+from api.llm import llm_routes
+
+# Configure logging: structured, sampled and written off the event loop
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Firebase, DatabaseService and LLMService are created lazily (see ServiceRegistry)
+services = ServiceRegistry()
+
+# Set WARMUP_ON_STARTUP=false to skip the background warmup (e.g. in scripts)
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true"
+
+# Set PREFETCH_ON_LOGIN=false to stop logins from warming the user's cached data
+PREFETCH_ON_LOGIN = os.getenv("PREFETCH_ON_LOGIN", "true").lower() == "true"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm clients in the background so startup does not delay accepting traffic"""
+    warmup_task = None
+    if WARMUP_ON_STARTUP:
+        warmup_task = asyncio.create_task(asyncio.to_thread(services.warmup))
+    yield
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+
 app = FastAPI(
     title="Knowledge Weaver API",
     description="API for categorizing notes and managing categories with knowledge graph",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
-# Initialize Firebase Admin SDK
-try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
-    
-    # Use service account file (local) or service account from environment (Cloud Run)
-    if os.path.exists("config/kg-note-credential.json"):
-        cred = credentials.Certificate("config/kg-note-credential.json")
-    else:
-        # Use default service account in Cloud Run
-        cred = credentials.ApplicationDefault()
-    firebase_app = firebase_admin.initialize_app(cred)
-    db = firestore.client(database_id="kg-note")
-    logger.info("Firebase Admin SDK initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize Firebase Admin SDK: {e}")
-    db = None
+# Retries carrying the same Idempotency-Key get the first attempt's response
+# instead of repeating its LLM call and writes
+app.add_middleware(
+    IdempotencyMiddleware,
+    cache=lambda: services.cache,
+    identify=lambda authorization: token_user_id(authorization),
+    paths=["/notes", "/categorize"],
+    prefixes=["/llm/"],
+)
+
+# Bounds requests in flight per worker from observed latency and sheds the
+# excess with 503/Retry-After, LLM-backed writes first; inside CORS so
+# browsers can read the rejection
+app.add_middleware(
+    AdaptiveConcurrencyMiddleware,
+    exempt=["/health", "/ready", "/metrics"],
+    llm_paths=["/notes", "/categorize"],
+    llm_prefixes=["/llm/"],
+)
+
+# Per-user, per-route token buckets (RATE_LIMITS), checked before a request
+# takes a concurrency slot; over the limit gets 429/Retry-After
+app.add_middleware(
+    RateLimitMiddleware,
+    store=lambda: services.rate_limits,
+    identify=lambda authorization: token_user_id(authorization),
+    exempt=["/health", "/ready", "/metrics"],
+    llm_paths=["/notes", "/categorize"],
+    llm_prefixes=["/llm/"],
+)
 
 # Add CORS middleware for browser requests
 app.add_middleware(
@@ -65,14 +119,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# br/gzip for large JSON bodies, negotiated from Accept-Encoding
+app.add_middleware(CompressionMiddleware)
+
+# Per-route latency and in-flight metrics, exposed on /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Sampled request tracing, recent traces of this worker on /debug/traces
+app.add_middleware(tracing.TracingMiddleware)
+
+# One-shot cProfile of requests carrying an armed X-Profile-Request token;
+# tokens and results are kept in the cache, shared by all workers
+request_profiler = profiling.RequestProfiler(cache=lambda: services.cache)
+app.add_middleware(profiling.RequestProfilerMiddleware, profiler=request_profiler)
+
+# /db/* note queries; the service is looked up lazily from the registry
+db_routes.set_db_service(lambda: services.db_service)
+app.include_router(db_routes.router)
+
+# /llm/* content tools, sharing the lazily created LLM service
+llm_routes.set_llm_service(lambda: services.llm_service)
+app.include_router(llm_routes.router)
+
 # JWT Configuration
 JWT_SECRET = os.getenv("JWT_SECRET", "your-super-secret-jwt-key-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 days
+TOKEN_CACHE_TTL = 300  # Verified tokens are reused for at most 5 minutes
 
 # Google OAuth Configuration
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 
+# Debug endpoints are limited to these user IDs (comma-separated)
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+
 # Security
 security = HTTPBearer()
 
@@ -94,6 +174,10 @@ class Category(BaseModel):
     category: str
     definition: str
 
+class CategoryMergeRequest(BaseModel):
+    source_ids: List[str]
+    target_id: str
+
 class GoogleLoginRequest(BaseModel):
     id_token: str
 
@@ -119,16 +203,14 @@ class UserInfo(BaseModel):
 # Legacy file-based category management
 CATEGORIES_FILE = "../../data/categories.json"
 
+# Carries all category traffic while Firestore is unavailable
+category_file_store = CategoryFileStore(CATEGORIES_FILE)
+
 def read_categories():
-    if not os.path.exists(CATEGORIES_FILE):
-        return []
-    with open(CATEGORIES_FILE, "r") as f:
-        return json.load(f)
+    return category_file_store.all()
 
 def write_categories(categories):
-    os.makedirs(os.path.dirname(CATEGORIES_FILE), exist_ok=True)
-    with open(CATEGORIES_FILE, "w") as f:
-        json.dump(categories, f, indent=2)
+    category_file_store.replace(categories)
 
 # JWT Functions
 def create_access_token(user_data: dict) -> str:
@@ -148,14 +230,28 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
     """Verify and decode JWT token"""
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        token_key = hashlib.sha256(token.encode()).hexdigest()
+        cached = services.cache.get("tokens", token_key, local=True)
+        if cached is not None:
+            user_info, expires_at = cached
+            if expires_at > time.time():
+                return user_info
+
+        with tracing.span("auth.verify_token"):
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         
-        return UserInfo(
+        user_info = UserInfo(
             user_id=payload["user_id"],
             email=payload["email"],
             name=payload["name"],
             is_anonymous=payload.get("is_anonymous", False)
         )
+        # Never cache a token past its own expiry
+        expires_at = payload.get("exp", time.time() + TOKEN_CACHE_TTL)
+        ttl = min(TOKEN_CACHE_TTL, expires_at - time.time())
+        if ttl > 0:
+            services.cache.set("tokens", token_key, (user_info, expires_at), ttl, local=True)
+        return user_info
     except jwt.ExpiredSignatureError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -169,6 +265,25 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security))
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+def token_user_id(authorization: str) -> Optional[str]:
+    """User id of a valid bearer token in an Authorization header, otherwise None"""
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return verify_token(HTTPAuthorizationCredentials(scheme=scheme, credentials=token)).user_id
+    except HTTPException:
+        return None
+
+def require_admin(current_user: UserInfo = Depends(verify_token)) -> UserInfo:
+    """Allow only users listed in ADMIN_USER_IDS"""
+    if current_user.user_id not in ADMIN_USER_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return current_user
+
 def verify_google_token(id_token_str: str) -> dict:
     """Verify Google ID token and return user info"""
     try:
@@ -178,6 +293,9 @@ def verify_google_token(id_token_str: str) -> dict:
                 detail="Google Client ID not configured"
             )
         
+        from google.oauth2 import id_token
+        from google.auth.transport import requests as google_requests
+        
         # Verify the token
         idinfo = id_token.verify_oauth2_token(
             id_token_str, 
@@ -211,48 +329,98 @@ def verify_google_token(id_token_str: str) -> dict:
 async def verify_chrome_access_token(access_token: str) -> bool:
     """Verify Chrome extension access token with Google"""
     try:
+        import requests
+        
         response = requests.get(
             'https://www.googleapis.com/oauth2/v1/tokeninfo',
             params={'access_token': access_token}
         )
         return response.status_code == 200
     except Exception as e:
-        logger.error(f"Token verification error: {e}")
+        logger.error("Token verification error: %s", e)
         return False
 
-# Try to import and initialize modular services
-try:
-    from api.llm.llm_service import LLMService
-    from api.database.db_service import DatabaseService
-    
-    # Initialize services if available
-    llm_service = LLMService() if os.getenv("DEEPSEEK_API_KEY") else None
-    db_service = DatabaseService(db) if db else None
-    
-    logger.info("Modular services loaded successfully")
-except ImportError as e:
-    logger.warning(f"Could not load modular services: {e}")
-    llm_service = None
-    db_service = None
-
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    firebase_status = "connected" if db else "disconnected"
+    """Health check endpoint (liveness; does not wait for or trigger initialization)"""
+    status_info = services.describe()
     return {
         "status": "healthy", 
         "message": "Knowledge Weaver API is running",
-        "firebase": firebase_status,
+        "firebase": status_info["firebase"],
         "services": {
-            "llm": "available" if llm_service else "unavailable",
-            "database": "available" if db_service else "unavailable"
+            "llm": status_info["llm"],
+            "database": status_info["database"]
         }
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: 200 once clients are created and connections warmed"""
+    if not services.ready:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready", "warmup_seconds": services.warmup_seconds}
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus metrics endpoint"""
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/debug/traces", include_in_schema=False)
+async def debug_traces(limit: int = 20, min_ms: float = 0.0, admin: UserInfo = Depends(require_admin)):
+    """Slowest recently sampled requests with their span breakdown
+
+    Only covers the worker that served this request; worker_pid says which one.
+    """
+    traces = tracing.tracer.recent.slowest(limit, min_ms)
+    return {
+        "worker_pid": os.getpid(),
+        "sample_rate": tracing.tracer.sample_rate,
+        "traces": [trace.to_summary() for trace in traces]
+    }
+
+@app.get("/debug/profile", include_in_schema=False)
+async def debug_profile(seconds: float = 10, interval_ms: float = 10, admin: UserInfo = Depends(require_admin)):
+    """Sample all threads of this process and return collapsed stacks for flamegraphs"""
+    if seconds <= 0 or seconds > profiling.MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {profiling.MAX_PROFILE_SECONDS}")
+    try:
+        # Sample from a worker thread so the event loop keeps serving the traffic being profiled
+        output = await asyncio.to_thread(profiling.sampler.profile, seconds, max(interval_ms, 1) / 1000)
+    except profiling.ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(output)
+
+@app.post("/debug/profile/request", include_in_schema=False)
+async def arm_request_profile(admin: UserInfo = Depends(require_admin)):
+    """Arm a one-time token; the next request sending it is run under cProfile"""
+    token = request_profiler.arm()
+    return {"token": token, "header": "X-Profile-Request", "result": f"/debug/profile/request/{token}"}
+
+@app.get("/debug/profile/request/{token}", include_in_schema=False)
+async def get_request_profile(token: str, admin: UserInfo = Depends(require_admin)):
+    """cProfile output of a flagged request"""
+    result = request_profiler.result(token)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No profile recorded for this token")
+    return PlainTextResponse(result)
+
+async def prefetch_user_data(user_id: str):
+    """Warm the cache with what clients load right after login; a background task run after the response"""
+    db_service = services.db_service
+    if not db_service:
+        return
+    try:
+        await db_service.prefetch_user_data(user_id)
+    except Exception as e:
+        logger.warning("Prefetch after login failed: %s", e)
+
 # Authentication Endpoints
 @app.post("/auth/google", response_model=AuthResponse)
-async def google_login(login_request: GoogleLoginRequest):
+async def google_login(login_request: GoogleLoginRequest, background_tasks: BackgroundTasks):
     """Login with Google OAuth"""
+    db = services.db
     try:
         # Verify Google token and get user info
         user_info = verify_google_token(login_request.id_token)
@@ -279,6 +447,8 @@ async def google_login(login_request: GoogleLoginRequest):
         
         # Create JWT token
         access_token = create_access_token(user_info)
+        if PREFETCH_ON_LOGIN:
+            background_tasks.add_task(prefetch_user_data, user_info["user_id"])
         
         return AuthResponse(
             access_token=access_token,
@@ -290,15 +460,16 @@ async def google_login(login_request: GoogleLoginRequest):
         )
         
     except Exception as e:
-        logger.error(f"Google login error: {e}")
+        logger.error("Google login error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Google authentication failed"
         )
 
 @app.post("/auth/chrome-extension", response_model=AuthResponse)
-async def chrome_extension_login(auth_request: ChromeExtensionAuthRequest):
+async def chrome_extension_login(auth_request: ChromeExtensionAuthRequest, background_tasks: BackgroundTasks):
     """Login from Chrome extension using access token and user info"""
+    db = services.db
     try:
         # Verify the access token with Google
         verify_response = await verify_chrome_access_token(auth_request.access_token)
@@ -349,6 +520,8 @@ async def chrome_extension_login(auth_request: ChromeExtensionAuthRequest):
         
         # Create JWT token
         access_token = create_access_token(standardized_user_info)
+        if PREFETCH_ON_LOGIN:
+            background_tasks.add_task(prefetch_user_data, standardized_user_info["user_id"])
         
         return AuthResponse(
             access_token=access_token,
@@ -362,7 +535,7 @@ async def chrome_extension_login(auth_request: ChromeExtensionAuthRequest):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Chrome extension login error: {e}")
+        logger.error("Chrome extension login error: %s", e)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Chrome extension authentication failed"
@@ -374,21 +547,61 @@ async def get_current_user(current_user: UserInfo = Depends(verify_token)):
     return current_user
 
 # Notes Management
+async def category_suggestions(db_service, user_id: str, categories: List[str]) -> List[dict]:
+    """Categories often used with the chosen ones; empty when the index cannot be read"""
+    if not db_service or not categories:
+        return []
+    try:
+        return await db_service.category_index.suggest(user_id, categories)
+    except IndexNotReady:
+        return []
+    except Exception as e:
+        logger.error("Error getting category suggestions: %s", e)
+        return []
+
 @app.post("/notes")
-async def create_note(note: Note, current_user: UserInfo = Depends(verify_token)):
-    """Create a new note for a user"""
-    logger.info(f"🔍 CREATE_NOTE called by user: {current_user.user_id}")
-    logger.info(f"🔍 DB available: {db is not None}")
-    logger.info(f"🔍 DB Service available: {db_service is not None}")
-    logger.info(f"🔍 LLM Service available: {llm_service is not None}")
+async def create_note(note: Note, on_duplicate: Optional[str] = None, current_user: UserInfo = Depends(verify_token)):
+    """Create a new note for a user
     
-    if not db:
+    A near-duplicate of an existing note is handled by `on_duplicate` (default
+    DEDUP_POLICY, off unless configured): `link` saves it with the existing note's categories and no
+    LLM call, `merge` returns the existing note instead, `off` saves it as usual.
+    """
+    db_service = services.db_service
+    llm_service = services.llm_service
+    if not db_service:
         raise HTTPException(status_code=503, detail="Database not available")
     
+    policy = on_duplicate or DEDUP_POLICY
+    if policy not in DEDUP_POLICIES:
+        raise HTTPException(status_code=400, detail=f"on_duplicate must be one of: {', '.join(DEDUP_POLICIES)}")
+    
     try:
+        url = note.metadata.url if note.metadata else note.url
+        fingerprint = note_fingerprint(note.content, url)
+        duplicate = None
+        if policy != "off" and fingerprint:
+            try:
+                duplicate_id = await db_service.duplicates.find(current_user.user_id, fingerprint)
+                duplicate = await db_service.get_note_by_id(current_user.user_id, duplicate_id) if duplicate_id else None
+            except Exception as e:
+                logger.error("Duplicate check failed: %s", e)
+        
+        if duplicate and policy == "merge":
+            logger.info("Duplicate note merged", extra={"user_id": current_user.user_id, "note_id": duplicate["id"]})
+            return {
+                "noteId": duplicate["id"],
+                "categories": duplicate.get("categories", []),
+                "duplicateOf": duplicate["id"],
+                "message": "Note already saved"
+            }
+        
         # Get categorization using user-specific categories from database
         categories = ["General"]
-        if llm_service:
+        if duplicate:
+            # A near-identical note was already categorized; skip the LLM call
+            categories = duplicate.get("categories") or categories
+        elif llm_service:
             try:
                 context_data = {
                     'url': note.metadata.url if note.metadata else note.url,
@@ -400,9 +613,9 @@ async def create_note(note: Note, current_user: UserInfo = Depends(verify_token)
                 if db_service:
                     try:
                         existing_categories = await db_service.get_user_categories(current_user.user_id)
-                        logger.info(f"🔍 Found {len(existing_categories)} user categories for categorization")
+                        logger.debug("Found %d user categories for categorization", len(existing_categories))
                     except Exception as e:
-                        logger.error(f"Error getting user categories: {e}")
+                        logger.error("Error getting user categories: %s", e)
                         existing_categories = read_categories()
                 else:
                     existing_categories = read_categories()
@@ -424,14 +637,14 @@ async def create_note(note: Note, current_user: UserInfo = Depends(verify_token)
                             
                             if new_cat["category"].lower() not in existing_names:
                                 await db_service.create_category(current_user.user_id, new_cat)
-                                logger.info(f"✅ Added new category to database: {new_cat['category']}")
+                                logger.info("Added new category to database: %s", new_cat['category'])
                             else:
-                                logger.info(f"⚠️ Category already exists: {new_cat['category']}")
+                                logger.debug("Category already exists: %s", new_cat['category'])
                         except Exception as e:
-                            logger.error(f"Error adding new category to database: {e}")
+                            logger.error("Error adding new category to database: %s", e)
                 
             except Exception as e:
-                logger.error(f"LLM categorization failed: {e}")
+                logger.error("LLM categorization failed: %s", e)
         
         # Prepare note data
         note_data = {
@@ -447,95 +660,183 @@ async def create_note(note: Note, current_user: UserInfo = Depends(verify_token)
             'updatedAt': datetime.now(),
             'userId': current_user.user_id
         }
-        
-        logger.info(f"📝 Saving note to database for user: {current_user.user_id}")
-        logger.info(f"📝 Note categories: {categories}")
-        logger.info(f"📝 Note content length: {len(note.content)}")
+        if fingerprint:
+            note_data['fingerprint'] = fingerprint
+        if duplicate:
+            note_data['duplicateOf'] = duplicate["id"]
         
         # Save to Firestore
-        notes_collection = db.collection('users').document(current_user.user_id).collection('notes')
-        doc_ref = notes_collection.add(note_data)
+        note_id = await db_service.create_note(current_user.user_id, note_data)
         
-        logger.info(f"✅ Note saved successfully with ID: {doc_ref[1].id}")
+        logger.info("Note created", extra={
+            "user_id": current_user.user_id,
+            "note_id": note_id,
+            "categories": categories,
+            "content_length": len(note.content)
+        })
         
         return {
-            "noteId": doc_ref[1].id,
+            "noteId": note_id,
             "categories": categories,
+            "suggestions": await category_suggestions(db_service, current_user.user_id, categories),
+            "duplicateOf": duplicate["id"] if duplicate else None,
             "message": "Note created successfully"
         }
         
     except Exception as e:
-        logger.error(f"Error creating note: {e}")
+        logger.error("Error creating note: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/notes/dedup")
+async def dedup_notes(policy: str = "link", current_user: UserInfo = Depends(verify_token)):
+    """Find near-duplicate notes among everything saved so far
+    
+    Runs as a background job, returned as `job`. With `link` later copies are
+    marked duplicateOf the oldest; with `merge` their categories are added to
+    the oldest and they are deleted.
+    """
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    if policy not in ("link", "merge"):
+        raise HTTPException(status_code=400, detail="policy must be link or merge")
+    
+    try:
+        job = await jobs.submit(current_user.user_id, DEDUP_JOB, {"policy": policy})
+        return FastJSONResponse({"job": job})
+    except Exception as e:
+        logger.error("Error starting dedup: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/notes/related/rebuild")
+async def rebuild_related_notes(current_user: UserInfo = Depends(verify_token)):
+    """Recompute every note's related notes, returned as a background `job`"""
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        job = await jobs.submit(current_user.user_id, RELATED_JOB, {})
+        return FastJSONResponse({"job": job})
+    except Exception as e:
+        logger.error("Error starting related notes rebuild: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/notes/lookup/backfill")
+async def backfill_note_lookup_keys(current_user: UserInfo = Depends(verify_token)):
+    """Store the URL and domain keys /db/notes/query filters on for older notes, returned as a background `job`"""
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        job = await jobs.submit(current_user.user_id, LOOKUP_JOB, {})
+        return FastJSONResponse({"job": job})
+    except Exception as e:
+        logger.error("Error starting note lookup backfill: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/notes")
-async def get_user_notes(current_user: UserInfo = Depends(verify_token), limit: int = 50):
-    """Get all notes for a user"""
-    if not db:
+async def get_user_notes(
+    current_user: UserInfo = Depends(verify_token),
+    limit: int = 50,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    """Get all notes for a user; ?fields=summary,preview returns a compact list view"""
+    db_service = services.db_service
+    if not db_service:
         raise HTTPException(status_code=503, detail="Database not available")
     
     try:
-        notes_collection = db.collection('users').document(current_user.user_id).collection('notes')
-        notes_query = notes_collection.order_by('createdAt', direction=firestore.Query.DESCENDING).limit(limit)
-        
-        notes = []
-        for doc in notes_query.stream():
-            note_data = doc.to_dict()
-            note_data['id'] = doc.id
-            notes.append(note_data)
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        # One small read answers unchanged re-fetches without scanning notes
+        version = await db_service.get_data_version(current_user.user_id)
+        etag = make_etag(current_user.user_id, version, "notes", limit, field_paths)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
         
-        return {"notes": notes}
+        notes = await db_service.get_user_notes(current_user.user_id, limit, fields=field_paths, version=version)
+        return FastJSONResponse({"notes": notes}, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
         
     except Exception as e:
-        logger.error(f"Error getting notes: {e}")
+        logger.error("Error getting notes: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/sync")
+async def sync(
+    current_user: UserInfo = Depends(verify_token),
+    since: Optional[str] = None,
+    limit: int = 200,
+    fields: Optional[str] = None
+):
+    """Notes and categories changed or deleted since a sync token
+    
+    Call without `since` for a full download, then pass the returned `next`
+    token; repeat while `has_more` is true. On `full_resync` drop local data
+    and start again without a token.
+    """
+    db_service = services.db_service
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        field_paths = parse_note_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        result = await sync_changes(db_service, current_user.user_id, since, max(1, min(limit, 1000)), field_paths)
+        return FastJSONResponse(result)
+    except InvalidSyncToken as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Error syncing: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # Category Management Endpoints
 @app.get("/categories")
-async def get_user_categories(current_user: UserInfo = Depends(verify_token)):
+async def get_user_categories(current_user: UserInfo = Depends(verify_token), if_none_match: Optional[str] = Header(None)):
     """Get all categories for a user"""
-    logger.info(f"🔍 GET_CATEGORIES called by user: {current_user.user_id}")
-    logger.info(f"🔍 DB Service available: {db_service is not None}")
-    
+    db_service = services.db_service
     if not db_service:
         # Fallback to file-based categories
         return {"categories": read_categories()}
     
     try:
+        version = await db_service.get_data_version(current_user.user_id)
+        etag = make_etag(current_user.user_id, version, "categories")
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+        
         categories = await db_service.get_user_categories(current_user.user_id)
-        return {"categories": categories}
+        return FastJSONResponse({"categories": categories}, headers={"ETag": etag, "Cache-Control": CONDITIONAL_CACHE_CONTROL})
         
     except Exception as e:
-        logger.error(f"Error getting categories: {e}")
+        logger.error("Error getting categories: %s", e)
         # Fallback to file-based categories
         return {"categories": read_categories()}
 
 @app.post("/categories")
 async def add_category(category: Category, current_user: UserInfo = Depends(verify_token)):
     """Add a new category"""
-    logger.info(f"🔍 ADD_CATEGORY called by user: {current_user.user_id}")
-    logger.info(f"🔍 Category data: {category.model_dump()}")
-    logger.info(f"🔍 DB Service available: {db_service is not None}")
+    db_service = services.db_service
+    logger.info("Adding category", extra={"user_id": current_user.user_id, "category": category.category})
     
     if not db_service:
-        # Fallback to file-based categories
-        categories = read_categories()
-        
-        # Check if category already exists
-        for existing in categories:
-            if existing["category"].lower() == category.category.lower():
-                raise HTTPException(status_code=400, detail="Category already exists")
-        
-        categories.append(category.model_dump())
-        write_categories(categories)
+        # Fallback to file-based categories; the duplicate check and write are atomic
+        if not category_file_store.add(category.model_dump()):
+            raise HTTPException(status_code=400, detail="Category already exists")
         return {"message": "Category added successfully", "category": category.model_dump()}
     
     try:
         # Check if category already exists
-        existing_categories = await db_service.get_user_categories(current_user.user_id)
-        for existing in existing_categories:
-            if existing["category"].lower() == category.category.lower():
-                raise HTTPException(status_code=400, detail="Category already exists")
+        if await db_service.category_name_exists(current_user.user_id, category.category):
+            raise HTTPException(status_code=400, detail="Category already exists")
         
         category_data = category.model_dump()
         category_id = await db_service.create_category(current_user.user_id, category_data)
@@ -543,12 +844,13 @@ async def add_category(category: Category, current_user: UserInfo = Depends(veri
         return {"message": "Category added successfully", "category_id": category_id, "category": category_data}
         
     except Exception as e:
-        logger.error(f"Error adding category: {e}")
+        logger.error("Error adding category: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/categories/{category_id}")
 async def update_category(category_id: str, category: Category, current_user: UserInfo = Depends(verify_token)):
     """Update a category by ID"""
+    db_service = services.db_service
     if not db_service:
         raise HTTPException(status_code=503, detail="Database service not available for updates")
     
@@ -559,23 +861,35 @@ async def update_category(category_id: str, category: Category, current_user: Us
             raise HTTPException(status_code=404, detail="Category not found")
         
         # Check if new name conflicts with existing categories (excluding current one)
-        existing_categories = await db_service.get_user_categories(current_user.user_id)
-        for existing in existing_categories:
-            if existing["id"] != category_id and existing["category"].lower() == category.category.lower():
-                raise HTTPException(status_code=400, detail="Category name already exists")
+        if await db_service.category_name_exists(current_user.user_id, category.category, exclude_id=category_id):
+            raise HTTPException(status_code=400, detail="Category name already exists")
         
         update_data = category.model_dump()
         await db_service.update_category(current_user.user_id, category_id, update_data)
         
-        return {"message": "Category updated successfully", "category": update_data}
+        # Notes still carry the old name; move them over in the background
+        job = None
+        if existing_category["category"] != category.category:
+            job = await services.jobs.submit(
+                current_user.user_id, REWRITE_JOB, rewrite_params([existing_category["category"]], category.category)
+            )
+        
+        return FastJSONResponse({"message": "Category updated successfully", "category": update_data, "job": job})
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error updating category: {e}")
+        logger.error("Error updating category: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/categories/{category_id}")
-async def delete_category(category_id: str, current_user: UserInfo = Depends(verify_token)):
-    """Delete a category by ID"""
+async def delete_category(category_id: str, cascade: bool = False, current_user: UserInfo = Depends(verify_token)):
+    """Delete a category by ID
+    
+    With `cascade=true` the category is also removed from every note, by a
+    background job returned as `job`.
+    """
+    db_service = services.db_service
     if not db_service:
         raise HTTPException(status_code=503, detail="Database service not available for deletions")
     
@@ -587,15 +901,149 @@ async def delete_category(category_id: str, current_user: UserInfo = Depends(ver
         
         await db_service.delete_category(current_user.user_id, category_id)
         
-        return {"message": "Category deleted successfully", "deleted_category": existing_category}
+        job = None
+        if cascade:
+            job = await services.jobs.submit(
+                current_user.user_id, REWRITE_JOB, rewrite_params([existing_category["category"]], None)
+            )
+        
+        return FastJSONResponse({"message": "Category deleted successfully", "deleted_category": existing_category, "job": job})
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error deleting category: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/categories/merge")
+async def merge_categories(request: CategoryMergeRequest, current_user: UserInfo = Depends(verify_token)):
+    """Merge categories into one
+    
+    The source categories are deleted and their notes are moved to the target
+    by a background job, returned as `job`; poll it at /jobs/{job_id}.
+    """
+    db_service = services.db_service
+    if not db_service:
+        raise HTTPException(status_code=503, detail="Database service not available for updates")
+    
+    source_ids = [source_id for source_id in dict.fromkeys(request.source_ids) if source_id != request.target_id]
+    if not source_ids:
+        raise HTTPException(status_code=400, detail="At least one source category other than the target is required")
+    
+    try:
+        target = await db_service.get_category_by_id(current_user.user_id, request.target_id)
+        if not target:
+            raise HTTPException(status_code=404, detail="Target category not found")
+        sources = []
+        for source_id in source_ids:
+            source = await db_service.get_category_by_id(current_user.user_id, source_id)
+            if not source:
+                raise HTTPException(status_code=404, detail=f"Category not found: {source_id}")
+            sources.append(source)
+        
+        # Submitted first so an interrupted merge can be resumed from the job
+        job = await services.jobs.submit(
+            current_user.user_id, REWRITE_JOB, rewrite_params([source["category"] for source in sources], target["category"])
+        )
+        for source in sources:
+            await db_service.delete_category(current_user.user_id, source["id"])
+        
+        return FastJSONResponse({"message": "Categories merged", "category": target, "merged_categories": sources, "job": job})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error merging categories: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/categories/recategorize")
+async def recategorize_notes(current_user: UserInfo = Depends(verify_token)):
+    """Re-run every note through the LLM against the user's current categories
+    
+    Runs as a background job, returned as `job`; poll /jobs/{job_id} for
+    progress, throughput and ETA, or cancel it at /jobs/{job_id}/cancel.
+    Submitting again while it runs returns the same job.
+    """
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    if not services.llm_service:
+        raise HTTPException(status_code=503, detail="LLM service not available")
+    
+    try:
+        job = await jobs.submit(current_user.user_id, RECATEGORIZE_JOB, {})
+        return FastJSONResponse({"job": job})
+    except Exception as e:
+        logger.error("Error starting re-categorization: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Background job endpoints
+@app.get("/jobs")
+async def list_jobs(limit: int = 20, current_user: UserInfo = Depends(verify_token)):
+    """Most recent background jobs of the user"""
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        return FastJSONResponse({"jobs": await jobs.list(current_user.user_id, max(1, min(limit, 100)))})
+    except Exception as e:
+        logger.error("Error listing jobs: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: UserInfo = Depends(verify_token)):
+    """Status and progress of a background job"""
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        job = await jobs.get(current_user.user_id, job_id)
+    except Exception as e:
+        logger.error("Error getting job: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return FastJSONResponse({"job": job})
+
+@app.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str, current_user: UserInfo = Depends(verify_token)):
+    """Restart a failed or abandoned job from its recorded progress"""
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        job = await jobs.resume(current_user.user_id, job_id)
+    except Exception as e:
+        logger.error("Error resuming job: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return FastJSONResponse({"job": job})
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, current_user: UserInfo = Depends(verify_token)):
+    """Stop a background job at its next checkpoint; it can be resumed later"""
+    jobs = services.jobs
+    if not jobs:
+        raise HTTPException(status_code=503, detail="Database not available")
+    
+    try:
+        job = await jobs.cancel(current_user.user_id, job_id)
     except Exception as e:
-        logger.error(f"Error deleting category: {e}")
+        logger.error("Error cancelling job: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return FastJSONResponse({"job": job})
 
 @app.post("/categorize")
 async def categorize_note(note: Note, current_user: UserInfo = Depends(verify_token)):
     """Categorize a note"""
+    db_service = services.db_service
+    llm_service = services.llm_service
     try:
         if llm_service:
             context_data = {
@@ -609,7 +1057,7 @@ async def categorize_note(note: Note, current_user: UserInfo = Depends(verify_to
                 try:
                     existing_categories = await db_service.get_user_categories(current_user.user_id)
                 except Exception as e:
-                    logger.error(f"Error getting user categories: {e}")
+                    logger.error("Error getting user categories: %s", e)
                     existing_categories = read_categories()
             else:
                 existing_categories = read_categories()
@@ -621,16 +1069,18 @@ async def categorize_note(note: Note, current_user: UserInfo = Depends(verify_to
                 for new_cat in result["new_categories"]:
                     try:
                         await db_service.create_category(current_user.user_id, new_cat)
-                        logger.info(f"Added new category to database: {new_cat['category']}")
+                        logger.info("Added new category to database: %s", new_cat['category'])
                     except Exception as e:
-                        logger.error(f"Error adding new category to database: {e}")
+                        logger.error("Error adding new category to database: %s", e)
             
-            return result
+            suggestions = await category_suggestions(db_service, current_user.user_id, result.get("categories", []))
+            return {**result, "suggestions": suggestions}
         else:
             return {"categories": ["General"]}
     except Exception as e:
-        logger.error(f"Error in categorization: {e}")
+        logger.error("Error in categorization: %s", e)
         return {"categories": ["General"]}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    # log_config=None lets uvicorn's loggers propagate into the queued pipeline
+    uvicorn.run(app, host="0.0.0.0", port=8080, log_config=None)
\ No newline at end of file
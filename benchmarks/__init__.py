@@ -0,0 +1 @@
+# Benchmark suite for storage and LLM hot paths
@@ -0,0 +1,136 @@
+import asyncio
+import json
+from typing import Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from api.core.responses import FastJSONResponse
+from api.database.db_service import DatabaseService, parse_note_fields
+from api.llm.llm_service import LLMService
+
+from .datasets import build_user
+from .local_store import LocalFirestore
+
+class _CannedCompletions:
+    """Returns a fixed categorization so only local work is measured"""
+
+    def __init__(self):
+        self.last_messages = None
+
+    def create(self, **kwargs):
+        self.last_messages = kwargs["messages"]
+        content = json.dumps({"categories": ["General"]})
+        message = type("Message", (), {"content": content})()
+        choice = type("Choice", (), {"message": message})()
+        usage = type("Usage", (), {"prompt_tokens": 0, "completion_tokens": 0})()
+        return type("Completion", (), {"choices": [choice], "usage": usage})()
+
+class CannedLLMClient:
+    def __init__(self):
+        self.completions = _CannedCompletions()
+        self.chat = type("Chat", (), {"completions": self.completions})()
+
+class Fixture:
+    """One synthetic user loaded into a fresh local store"""
+
+    def __init__(self, note_count: int, category_count: int, seed: int):
+        self.note_count = note_count
+        self.category_count = category_count
+        self.user_id = f"bench_user_{note_count}_{category_count}"
+        self.store = LocalFirestore()
+        self.categories = build_user(self.store, self.user_id, note_count, category_count, seed)
+        self.db_service = DatabaseService(self.store)
+        # Built up front, as the rebuild job would before the first index read
+        asyncio.run(self.db_service.category_index.rebuild(self.user_id))
+        self.llm_client = CannedLLMClient()
+        self.llm_service = LLMService(client=self.llm_client)
+
+        first = next(iter(self.store.collection("users").document(self.user_id).collection("categories").stream()))
+        self.store.ops.reset()
+        self.category_id = first.id
+        self.category_name = first.to_dict()["category"]
+        self.note_content = "Async index caches cut query latency for knowledge graph notes. " * 20
+        self.article_content = " ".join(
+            f"Section {i} explains how knowledge graph caching shapes query latency for note {i % 37}." for i in range(1500)
+        )
+
+# Each case is an async callable taking a Fixture
+CASES: Dict[str, Callable] = {}
+
+def case(name: str):
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+@case("search_notes.miss")
+async def search_notes_miss(fx: Fixture):
+    # A query that never matches forces the full collection scan
+    return await fx.db_service.search_notes(fx.user_id, "no-such-term", limit=20)
+
+@case("search_notes.hit")
+async def search_notes_hit(fx: Fixture):
+    return await fx.db_service.search_notes(fx.user_id, "graph knowledge", limit=20)
+
+@case("get_notes_statistics")
+async def get_notes_statistics(fx: Fixture):
+    return await fx.db_service.get_notes_statistics(fx.user_id)
+
+@case("get_user_notes.first_page")
+async def get_user_notes_first_page(fx: Fixture):
+    return await fx.db_service.get_user_notes(fx.user_id, limit=50)
+
+@case("get_user_notes.deep_offset")
+async def get_user_notes_deep_offset(fx: Fixture):
+    return await fx.db_service.get_user_notes(fx.user_id, limit=50, offset=fx.note_count // 2)
+
+@case("get_notes_by_category")
+async def get_notes_by_category(fx: Fixture):
+    return await fx.db_service.get_notes_by_category(fx.user_id, fx.category_name, limit=50)
+
+@case("add_category.duplicate_check")
+async def add_category_duplicate_check(fx: Fixture):
+    return await fx.db_service.category_name_exists(fx.user_id, "Brand New Category")
+
+@case("update_category.duplicate_check")
+async def update_category_duplicate_check(fx: Fixture):
+    return await fx.db_service.category_name_exists(fx.user_id, fx.category_name, exclude_id=fx.category_id)
+
+@case("categorize_note.prompt")
+async def categorize_note_prompt(fx: Fixture):
+    context = {"url": "https://example.com/post", "title": "Example", "domain": "example.com"}
+    return await fx.llm_service.categorize_note(fx.note_content, context, fx.categories)
+
+@case("categorize_note.long_article")
+async def categorize_note_long_article(fx: Fixture):
+    # A whole captured article, far over the categorization token budget
+    context = {"url": "https://example.com/article", "title": "Knowledge graph caching", "domain": "example.com"}
+    return await fx.llm_service.categorize_note(fx.article_content, context, fx.categories)
+
+@case("render_notes.jsonable_encoder")
+async def render_notes_jsonable_encoder(fx: Fixture):
+    # What FastAPI does with a returned dict: encode a copy, then stdlib json
+    notes = await fx.db_service.get_user_notes(fx.user_id, limit=500)
+    return len(JSONResponse(jsonable_encoder({"notes": notes})).body)
+
+@case("render_notes.orjson")
+async def render_notes_orjson(fx: Fixture):
+    notes = await fx.db_service.get_user_notes(fx.user_id, limit=500)
+    return len(FastJSONResponse({"notes": notes}).body)
+
+@case("render_notes.summary_projection")
+async def render_notes_summary_projection(fx: Fixture):
+    fields = parse_note_fields("summary,preview")
+    notes = await fx.db_service.get_user_notes(fx.user_id, limit=500, fields=fields)
+    return len(FastJSONResponse({"notes": notes}).body)
+
+def prompt_chars(fx: Fixture) -> int:
+    """Size of the last prompt sent to the canned client"""
+    messages = fx.llm_client.completions.last_messages or []
+    return sum(len(message["content"]) for message in messages)
+
+def select_cases(patterns: List[str]) -> Dict[str, Callable]:
+    if not patterns:
+        return dict(CASES)
+    return {name: func for name, func in CASES.items() if any(p in name for p in patterns)}
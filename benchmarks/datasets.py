@@ -0,0 +1,69 @@
+import random
+from datetime import datetime, timedelta
+from typing import List
+
+from .local_store import LocalFirestore
+
+WORDS = (
+    "graph knowledge note python async index cache query latency vector model "
+    "research browser extension category domain storage token prompt summary "
+    "design pattern database search learning network protocol compiler memory "
+    "thread process kernel history economics biology physics chemistry music"
+).split()
+
+DOMAINS = [
+    "github.com", "stackoverflow.com", "wikipedia.org", "arxiv.org", "youtube.com",
+    "medium.com", "news.ycombinator.com", "docs.python.org", "developer.mozilla.org",
+    "nytimes.com", "substack.com", "reddit.com",
+]
+
+BASE_TIME = datetime(2025, 1, 1)
+
+def make_categories(rng: random.Random, count: int) -> List[dict]:
+    """Generate category documents with unique names"""
+    categories = []
+    for i in range(count):
+        name = f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {i}"
+        categories.append({
+            "category": name,
+            "definition": " ".join(rng.choices(WORDS, k=12)),
+            "createdAt": BASE_TIME,
+            "updatedAt": BASE_TIME,
+        })
+    return categories
+
+def make_note(rng: random.Random, user_id: str, index: int, category_names: List[str]) -> dict:
+    """Generate a note document shaped like the ones create_note writes"""
+    domain = rng.choice(DOMAINS)
+    created = BASE_TIME + timedelta(minutes=index * 7 + rng.randint(0, 6))
+    return {
+        "content": " ".join(rng.choices(WORDS, k=rng.randint(20, 400))),
+        "categories": rng.sample(category_names, k=min(len(category_names), rng.randint(1, 4))),
+        "metadata": {
+            "title": " ".join(rng.choices(WORDS, k=6)).title(),
+            "url": f"https://{domain}/{rng.choice(WORDS)}/{index}",
+            "domain": domain,
+            "summary": "",
+        },
+        "createdAt": created,
+        "updatedAt": created,
+        "userId": user_id,
+    }
+
+def build_user(store: LocalFirestore, user_id: str, note_count: int, category_count: int, seed: int = 0) -> List[dict]:
+    """Populate the store with one synthetic user and return its categories"""
+    rng = random.Random(f"{seed}:{user_id}:{note_count}:{category_count}")
+    user_ref = store.collection("users").document(user_id)
+    user_ref.set({"email": f"{user_id}@example.com", "name": user_id})
+
+    categories = make_categories(rng, category_count)
+    for category in categories:
+        user_ref.collection("categories").add(category)
+
+    names = [category["category"] for category in categories]
+    notes = user_ref.collection("notes")
+    for i in range(note_count):
+        notes.add(make_note(rng, user_id, i, names))
+
+    store.ops.reset()
+    return categories
@@ -0,0 +1,74 @@
+"""Import-time profile of the API entry point
+
+Runs `python -X importtime -c "import api_simple"` in a fresh interpreter and
+reports the total import time and the slowest modules. Fails when a module that
+must stay lazy (Firebase, gRPC, OpenAI, google-auth) is imported at startup or
+when the total exceeds --budget-ms.
+
+Usage:
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --top 30 --budget-ms 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy packages that must only be imported when a client is first needed
+LAZY_MODULES = ["firebase_admin", "google.cloud.firestore", "grpc", "openai", "google.oauth2.id_token"]
+
+def profile_imports(module: str = "api_simple", runs: int = 3):
+    """Return (total_ms, {module: cumulative_ms}) for the fastest of several runs"""
+    best = None
+    env = dict(os.environ, WARMUP_ON_STARTUP="false")
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            parts = [part.strip() for part in line[len("import time:"):].split("|")]
+            if not parts[1].isdigit():
+                continue  # header line
+            name = parts[2].strip()
+            cumulative[name] = int(parts[1]) / 1000
+
+        total = cumulative.get(module, 0.0)
+        if best is None or total < best[0]:
+            best = (total, cumulative)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile import time of the API entry point")
+    parser.add_argument("--module", default="api_simple")
+    parser.add_argument("--top", type=int, default=20, help="Number of slowest modules to show")
+    parser.add_argument("--runs", type=int, default=3, help="Best-of-N interpreter runs")
+    parser.add_argument("--budget-ms", type=float, help="Fail if total import time exceeds this")
+    args = parser.parse_args()
+
+    total, cumulative = profile_imports(args.module, args.runs)
+    print(f"{args.module}: {total:.1f} ms total import time (best of {args.runs})")
+    for name, ms in sorted(cumulative.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {ms:>9.1f} ms  {name}")
+
+    failures = []
+    eager = [name for name in LAZY_MODULES if name in cumulative]
+    if eager:
+        failures.append(f"imported at startup but should be lazy: {', '.join(eager)}")
+    if args.budget_ms is not None and total > args.budget_ms:
+        failures.append(f"total {total:.1f} ms exceeds budget {args.budget_ms:.1f} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import copy
+import itertools
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+# Direction constants match firestore.Query.ASCENDING / DESCENDING
+ASCENDING = "ASCENDING"
+DESCENDING = "DESCENDING"
+
+_id_counter = itertools.count(1)
+
+def _new_id() -> str:
+    return f"doc{next(_id_counter):012d}"
+
+# Orders on this field path sort by document id, as firestore.FieldPath.document_id()
+DOCUMENT_ID = "__name__"
+
+def _get_field(data: dict, path: str) -> Any:
+    value = data
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+class _Missing:
+    pass
+
+_MISSING = _Missing()
+
+def _is_increment(value) -> bool:
+    # Duck-typed so google.cloud.firestore sentinels work without importing them here
+    return type(value).__name__ == "Increment" and hasattr(value, "value")
+
+def _is_delete_field(value) -> bool:
+    return type(value).__name__ == "Sentinel" and "delete" in getattr(value, "description", "").lower()
+
+def _normalize(value):
+    """Store values the way Firestore returns them: datetimes become aware UTC"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return copy.deepcopy(value)
+
+def _apply(existing: dict, data: dict, deep: bool = False) -> dict:
+    """Write data into existing, resolving Increment and DELETE_FIELD
+
+    With ``deep`` nested maps are merged key by key, as set(merge=True) does.
+    """
+    for key, value in data.items():
+        if _is_increment(value):
+            current = existing.get(key, 0)
+            existing[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+        elif _is_delete_field(value):
+            existing.pop(key, None)
+        elif deep and isinstance(value, dict) and isinstance(existing.get(key), dict):
+            _apply(existing[key], value, deep=True)
+        elif deep and isinstance(value, dict):
+            existing[key] = _apply({}, value, deep=True)
+        else:
+            existing[key] = _normalize(value)
+    return existing
+
+class OpCounter:
+    """Counts billed storage operations the same way Firestore does"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.reads = 0
+        self.writes = 0
+        self.deletes = 0
+        self.queries = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "reads": self.reads,
+            "writes": self.writes,
+            "deletes": self.deletes,
+            "queries": self.queries,
+        }
+
+class DocumentSnapshot:
+    def __init__(self, doc_id: str, data: Optional[dict], reference=None):
+        self.id = doc_id
+        self._data = data
+        self.reference = reference
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[dict]:
+        # Firestore decodes a fresh dict for every read
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        value = _get_field(self._data or {}, field_path)
+        return None if value is _MISSING else value
+
+class DocumentReference:
+    def __init__(self, store: "LocalFirestore", path: tuple):
+        self._store = store
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    @property
+    def path(self) -> str:
+        return "/".join(self._path)
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._store, self._path + (name,))
+
+    def get(self, field_paths=None, transaction=None) -> DocumentSnapshot:
+        self._store.ops.reads += 1
+        return DocumentSnapshot(self.id, self._store._docs.get(self._path), self)
+
+    def set(self, data: dict, merge: bool = False):
+        with self._store._lock:
+            self._store.ops.writes += 1
+            if merge and self._path in self._store._docs:
+                _apply(self._store._docs[self._path], data, deep=True)
+            else:
+                self._store._docs[self._path] = _apply({}, data, deep=True)
+
+    def update(self, data: dict):
+        with self._store._lock:
+            if self._path not in self._store._docs:
+                raise KeyError(f"No document to update: {self.path}")
+            self._store.ops.writes += 1
+            _apply(self._store._docs[self._path], data)
+
+    def delete(self):
+        with self._store._lock:
+            self._store.ops.deletes += 1
+            self._store._docs.pop(self._path, None)
+
+class Query:
+    _OPERATORS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "in": lambda a, b: a in b,
+        "array_contains": lambda a, b: isinstance(a, list) and b in a,
+        "array_contains_any": lambda a, b: isinstance(a, list) and any(v in a for v in b),
+    }
+
+    def __init__(self, store: "LocalFirestore", path: tuple, filters=None, orders=None,
+                 limit_count=None, offset_count=0, fields=None, cursor=None):
+        self._store = store
+        self._path = path
+        self._filters = filters or []
+        self._orders = orders or []
+        self._limit = limit_count
+        self._offset = offset_count
+        self._fields = fields
+        self._cursor = cursor
+
+    def _copy(self, **changes) -> "Query":
+        params = {
+            "filters": list(self._filters),
+            "orders": list(self._orders),
+            "limit_count": self._limit,
+            "offset_count": self._offset,
+            "fields": self._fields,
+            "cursor": self._cursor,
+        }
+        params.update(changes)
+        return Query(self._store, self._path, **params)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> "Query":
+        if op_string not in self._OPERATORS:
+            raise ValueError(f"Unsupported operator: {op_string}")
+        return self._copy(filters=self._filters + [(field_path, op_string, _normalize(value))])
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "Query":
+        return self._copy(orders=self._orders + [(field_path, direction)])
+
+    def limit(self, count: int) -> "Query":
+        return self._copy(limit_count=count)
+
+    def offset(self, count: int) -> "Query":
+        return self._copy(offset_count=count)
+
+    def select(self, field_paths: List[str]) -> "Query":
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields: dict) -> "Query":
+        return self._copy(cursor=dict(document_fields))
+
+    @staticmethod
+    def _order_value(path: tuple, data: dict, field: str) -> Any:
+        return path[-1] if field == DOCUMENT_ID else _get_field(data, field)
+
+    def _after_cursor(self, path: tuple, data: dict) -> bool:
+        for field, direction in self._orders:
+            if field not in self._cursor:
+                break
+            value, bound = self._order_value(path, data, field), self._cursor[field]
+            # Document ids may be given as ids or references
+            bound = getattr(bound, "id", bound) if field == DOCUMENT_ID else _normalize(bound)
+            if value != bound:
+                return value < bound if direction == DESCENDING else value > bound
+        return False
+
+    def _matches(self, data: dict) -> bool:
+        for field_path, op_string, value in self._filters:
+            current = _get_field(data, field_path)
+            if current is _MISSING or not self._OPERATORS[op_string](current, value):
+                return False
+        # Firestore drops documents missing an order_by field
+        return all(field == DOCUMENT_ID or _get_field(data, field) is not _MISSING for field, _ in self._orders)
+
+    def _project(self, data: dict) -> dict:
+        if self._fields is None:
+            return data
+        projected = {}
+        for field in self._fields:
+            value = _get_field(data, field)
+            if value is _MISSING:
+                continue
+            target = projected
+            parts = field.split(".")
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+        return projected
+
+    def stream(self, transaction=None) -> Iterator[DocumentSnapshot]:
+        self._store.ops.queries += 1
+        depth = len(self._path) + 1
+        with self._store._lock:
+            matches = [
+                (path, data) for path, data in self._store._docs.items()
+                if len(path) == depth and path[:-1] == self._path and self._matches(data)
+            ]
+        # Default ordering is by document id, as in Firestore
+        matches.sort(key=lambda item: item[0][-1])
+        for field, direction in reversed(self._orders):
+            matches.sort(key=lambda item: self._order_value(item[0], item[1], field), reverse=direction == DESCENDING)
+        if self._cursor is not None:
+            matches = [item for item in matches if self._after_cursor(*item)]
+
+        # Skipped offset documents are still billed as reads
+        skipped = min(self._offset, len(matches))
+        self._store.ops.reads += skipped
+        matches = matches[self._offset:]
+        if self._limit is not None:
+            matches = matches[:self._limit]
+
+        for path, data in matches:
+            self._store.ops.reads += 1
+            yield DocumentSnapshot(path[-1], self._project(data), DocumentReference(self._store, path))
+
+    def get(self, transaction=None) -> List[DocumentSnapshot]:
+        return list(self.stream())
+
+class CollectionReference(Query):
+    def __init__(self, store: "LocalFirestore", path: tuple):
+        super().__init__(store, path)
+
+    @property
+    def id(self) -> str:
+        return self._path[-1]
+
+    def document(self, document_id: Optional[str] = None) -> DocumentReference:
+        return DocumentReference(self._store, self._path + (document_id or _new_id(),))
+
+    def add(self, document_data: dict, document_id: Optional[str] = None):
+        doc_ref = self.document(document_id)
+        doc_ref.set(document_data)
+        return None, doc_ref
+
+class WriteBatch:
+    """Applies queued writes together on commit, all or nothing, like a Firestore batch"""
+
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference: DocumentReference, data: dict, merge: bool = False):
+        self._writes.append(("set", reference, data, merge))
+
+    def update(self, reference: DocumentReference, data: dict):
+        self._writes.append(("update", reference, data, False))
+
+    def delete(self, reference: DocumentReference):
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        if not writes:
+            return
+        with writes[0][1]._store._lock:
+            for kind, reference, _, _ in writes:
+                if kind == "update" and reference._path not in reference._store._docs:
+                    raise KeyError(f"No document to update: {reference.path}")
+            for kind, reference, data, merge in writes:
+                if kind == "set":
+                    reference.set(data, merge=merge)
+                elif kind == "update":
+                    reference.update(data)
+                else:
+                    reference.delete()
+
+class LocalFirestore:
+    """In-memory stand-in for a Firestore client that counts billed operations
+
+    Supports the subset of the client API used by DatabaseService, so the service
+    can be benchmarked without network access or credentials.
+    """
+
+    def __init__(self):
+        self._docs: Dict[tuple, dict] = {}
+        self.ops = OpCounter()
+        # Batches from background jobs commit from worker threads
+        self._lock = threading.RLock()
+
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self, (name,))
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch()
+
+    def get_all(self, references, field_paths=None, transaction=None) -> Iterator[DocumentSnapshot]:
+        for reference in references:
+            self.ops.reads += 1
+            data = self._docs.get(reference._path)
+            if data is not None and field_paths is not None:
+                data = Query(self, reference._path[:-1]).select(field_paths)._project(data)
+            yield DocumentSnapshot(reference.id, data, reference)
+
+    def document_count(self) -> int:
+        return len(self._docs)
@@ -0,0 +1,161 @@
+"""Run the storage and LLM hot-path benchmarks
+
+Usage:
+    python -m benchmarks.run                         # full matrix, print results
+    python -m benchmarks.run --notes 1000 --cases search
+    python -m benchmarks.run --save-baseline main    # store results as a baseline
+    python -m benchmarks.run --compare main          # fail on regressions vs a baseline
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.cases import Fixture, prompt_chars, select_cases
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+DEFAULT_NOTES = [1000, 10000, 100000]
+DEFAULT_CATEGORIES = [10, 100, 1000]
+
+def _int_list(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+def measure(loop, func, fixture: Fixture, repeat: int) -> dict:
+    """Time a case, count storage ops per call and record peak memory"""
+    loop.run_until_complete(func(fixture))  # warm-up
+
+    timings = []
+    ops = None
+    for _ in range(repeat):
+        fixture.store.ops.reset()
+        gc.collect()
+        start = time.perf_counter()
+        loop.run_until_complete(func(fixture))
+        timings.append(time.perf_counter() - start)
+        ops = fixture.store.ops.snapshot()
+
+    gc.collect()
+    tracemalloc.start()
+    loop.run_until_complete(func(fixture))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "wall_ms_median": statistics.median(timings) * 1000,
+        "wall_ms_min": min(timings) * 1000,
+        "storage_reads": ops["reads"],
+        "storage_writes": ops["writes"] + ops["deletes"],
+        "storage_queries": ops["queries"],
+        "peak_kib": peak / 1024,
+    }
+    if func.__name__.startswith("categorize_note"):
+        result["prompt_chars"] = prompt_chars(fixture)
+    return result
+
+def run(args) -> dict:
+    cases = select_cases(args.cases)
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for note_count in args.notes:
+            for category_count in args.categories:
+                fixture = Fixture(note_count, category_count, args.seed)
+                for name, func in cases.items():
+                    key = f"{name}[notes={note_count},categories={category_count}]"
+                    results[key] = measure(loop, func, fixture, args.repeat)
+                    print(_format_line(key, results[key]), flush=True)
+                del fixture
+                gc.collect()
+    finally:
+        loop.close()
+    return results
+
+def _format_line(key: str, result: dict) -> str:
+    line = (
+        f"{key:<70} {result['wall_ms_median']:>10.2f} ms "
+        f"{result['storage_reads']:>8} reads {result['peak_kib']:>10.1f} KiB"
+    )
+    if "prompt_chars" in result:
+        line += f" {result['prompt_chars']:>8} prompt chars"
+    return line
+
+def save_baseline(name: str, results: dict, args):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    payload = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "note": args.note,
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+    print(f"Saved baseline to {path}")
+
+def compare(name: str, results: dict, threshold: float) -> int:
+    """Print deltas against a stored baseline; return the number of regressions"""
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = 0
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        time_ratio = current["wall_ms_median"] / max(previous["wall_ms_median"], 1e-6)
+        # Storage reads are deterministic, so any increase is a regression
+        reads_regressed = current["storage_reads"] > previous["storage_reads"]
+        # Ignore jitter on sub-millisecond cases
+        time_regressed = time_ratio > 1 + threshold and current["wall_ms_median"] - previous["wall_ms_median"] > 1.0
+        marker = "REGRESSION" if reads_regressed or time_regressed else "ok"
+        regressions += marker != "ok"
+        print(
+            f"{key:<70} time x{time_ratio:5.2f} "
+            f"reads {previous['storage_reads']:>8} -> {current['storage_reads']:<8} {marker}"
+        )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DatabaseService and LLMService hot paths")
+    parser.add_argument("--notes", type=_int_list, default=DEFAULT_NOTES, help="Comma-separated note counts")
+    parser.add_argument("--categories", type=_int_list, default=DEFAULT_CATEGORIES, help="Comma-separated category counts")
+    parser.add_argument("--cases", nargs="*", default=[], help="Only run cases whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case")
+    parser.add_argument("--seed", type=int, default=0, help="Dataset seed")
+    parser.add_argument("--save-baseline", metavar="NAME", help="Store results under benchmarks/baselines/NAME.json")
+    parser.add_argument("--note", help="Where the results were recorded, stored with a saved baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Compare against benchmarks/baselines/NAME.json")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed relative wall-time slowdown")
+    parser.add_argument("--output", help="Also write raw results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results, args)
+    if args.compare:
+        regressions = compare(args.compare, results, args.threshold)
+        if regressions:
+            print(f"{regressions} regression(s) against baseline '{args.compare}'")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Production serving mode: several uvicorn workers sharing one node
+
+    gunicorn -c gunicorn.conf.py api_simple:app
+
+The app is imported once in the master and forked into each worker. Clients
+(Firestore, DeepSeek) are still created per worker, by the lifespan warmup.
+Workers share the SQLite cache (CACHE_BACKEND=sqlite), so categories,
+categorization results and verified tokens are fetched once per node rather
+than once per worker, and Prometheus metrics are aggregated across workers.
+Rate-limit buckets, idempotent replays and X-Profile-Request tokens and
+results go through the same file.
+
+Some state still lives in each worker, and is only ever that worker's view:
+
+- /debug/traces: the trace ring buffer (the response carries worker_pid);
+  export with TRACE_EXPORTERS for every worker's traces
+- /debug/profile: the sampler sees the threads of the worker it runs in
+- the adaptive concurrency limiter: each worker tunes its own AIMD limit
+  and queue, so the node admits up to WEB_CONCURRENCY times the limit
+- the knowledge graph cache and the in-process tier of the cache
+- jobs: run on the thread pool of the worker that accepted them. Liveness
+  is the Firestore heartbeat (updatedAt), never that worker's memory, so
+  every worker reports the same status
+- rate limits, if RATE_LIMIT_STORE=memory
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+preload_app = True
+
+# LLM categorization can take tens of seconds
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Uvicorn's loggers propagate into the app's queued logging pipeline
+accesslog = None
+errorlog = "-"
+
+# Must be set before the app (and prometheus_client) is imported by preload
+os.environ.setdefault("CACHE_BACKEND", "sqlite")
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "kg-note-metrics"))
+
+def on_starting(server):
+    # Samples and cache entries from a previous run must not leak into this one
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    from api.core.cache import default_shared_cache_path
+
+    cache_path = os.getenv("SHARED_CACHE_PATH") or default_shared_cache_path()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(cache_path + suffix):
+            os.remove(cache_path + suffix)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)